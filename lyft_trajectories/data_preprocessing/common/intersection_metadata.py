@@ -0,0 +1,63 @@
+import json
+import os
+from collections import defaultdict
+from typing import Dict, List
+
+from lyft_trajectories.data_preprocessing.common.map_cache import atomic_write
+
+# small subset of the compiled map needed by the traffic light predictor, stored separately to be loaded in milliseconds
+INTERSECTION_METADATA_PATH = "input/intersection_metadata.json"
+
+
+def get_tl_signal_idx_2_master_intersection_idx(
+    master_intersection_idx_2_tl_signal_indices: Dict[int, List[int]]
+):
+    tl_signal_idx_2_master_intersection_idx = dict()
+    for (
+        intersection_i,
+        tl_signal_indices,
+    ) in master_intersection_idx_2_tl_signal_indices.items():
+        for tl_signal_i in tl_signal_indices:
+            tl_signal_idx_2_master_intersection_idx[tl_signal_i] = intersection_i
+    return tl_signal_idx_2_master_intersection_idx
+
+
+def save_intersection_metadata(
+    master_intersection_idx_2_tl_signal_indices: Dict[int, List[int]],
+    key: str,
+    path: str = INTERSECTION_METADATA_PATH,
+):
+    # json object keys are strings only, hence the list of pairs
+    metadata = {
+        "key": key,
+        "master_intersection_idx_2_tl_signal_indices": sorted(
+            [
+                [int(intersection_i), [int(x) for x in tl_signal_indices]]
+                for intersection_i, tl_signal_indices in master_intersection_idx_2_tl_signal_indices.items()
+            ]
+        ),
+    }
+    atomic_write(path, lambda f: json.dump(metadata, f), binary=False)
+
+
+def is_intersection_metadata_current(
+    key: str, path: str = INTERSECTION_METADATA_PATH
+) -> bool:
+    if not os.path.exists(path):
+        return False
+    with open(path, "r") as f:
+        return json.load(f).get("key") == key
+
+
+def load_intersection_metadata(path: str = INTERSECTION_METADATA_PATH):
+    if not os.path.exists(path):
+        # the metadata is written when compiling the map (the full map import is needed once only)
+        import lyft_trajectories.data_preprocessing.common.map_traffic_lights_data  # noqa: F401
+    with open(path, "r") as f:
+        metadata = json.load(f)
+    master_intersection_idx_2_tl_signal_indices = defaultdict(list)
+    for intersection_i, tl_signal_indices in metadata[
+        "master_intersection_idx_2_tl_signal_indices"
+    ]:
+        master_intersection_idx_2_tl_signal_indices[intersection_i] = tl_signal_indices
+    return master_intersection_idx_2_tl_signal_indices
@@ -0,0 +1,258 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+LANE_GRAPH_EDGE_TYPES = ("forward", "backward", "left", "right")
+
+
+def get_csr(adjacency_lists: List[List[int]]) -> Tuple[np.ndarray, np.ndarray]:
+    offsets = np.zeros(len(adjacency_lists) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in adjacency_lists], out=offsets[1:])
+    indices = np.array(
+        [neighbour for x in adjacency_lists for neighbour in x], dtype=np.int32
+    )
+    return offsets, indices
+
+
+def expand_csr(
+    offsets: np.ndarray, indices: np.ndarray, lane_indices: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Gathers neighbours of all the given lanes at once.
+
+    Returns:
+        tuple of the neighbour indices (in the order of lane_indices and then of the adjacency)
+        and the positions in lane_indices of their source lanes
+    """
+    starts = offsets[lane_indices]
+    counts = offsets[lane_indices + 1] - starts
+    source_positions = np.repeat(np.arange(len(lane_indices)), counts)
+    neighbour_positions = (
+        np.arange(counts.sum())
+        - np.repeat(np.cumsum(counts) - counts, counts)
+        + np.repeat(starts, counts)
+    )
+    return indices[neighbour_positions], source_positions
+
+
+def is_bit_set(bitsets: np.ndarray, row_idx: int, bit_idx: int) -> bool:
+    # bitsets as rows of uint64 words, see LaneGraph.get_reachability_bitsets
+    return bool((int(bitsets[row_idx, bit_idx // 64]) >> (bit_idx % 64)) & 1)
+
+
+def get_set_bit_indices(bitset: np.ndarray) -> np.ndarray:
+    # positions of the set bits of a row of uint64 words, see is_bit_set
+    return np.flatnonzero(
+        np.unpackbits(bitset.astype("<u8").view(np.uint8), bitorder="little")
+    )
+
+
+class LaneGraph:
+    """
+    Lane topology over dense integer lane indices (positions in the compiled lane_ids_all).
+    Edges of each type are stored in CSR format: the neighbours of the lane i are
+    {edge_type}_indices[{edge_type}_offsets[i]:{edge_type}_offsets[i + 1]], in the semantic map order.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.lane_lens = arrays["lane_lens"]
+        self.is_bike = arrays["is_bike"]
+        self.n_lanes = len(self.lane_lens)
+        self._csr = {
+            (edge_type,): (
+                arrays[f"{edge_type}_offsets"],
+                arrays[f"{edge_type}_indices"],
+            )
+            for edge_type in LANE_GRAPH_EDGE_TYPES
+        }
+
+    @classmethod
+    def from_adjacency_lists(
+        cls,
+        lane_ids: List[str],
+        adjacency_lists: Dict[str, List[List[str]]],
+        lane_lens: np.ndarray,
+        is_bike: np.ndarray,
+    ):
+        """
+        Args:
+            lane_ids (List[str]): lane ids, their positions become the lane indices
+            adjacency_lists (Dict[str, List[List[str]]]): per edge type, neighbour lane ids of each lane in lane_ids
+            lane_lens (np.ndarray): number of center line points per lane
+            is_bike (np.ndarray): bike only lane flags
+
+        Returns:
+            LaneGraph
+        """
+        lane_id_2_idx = {lane_id: i for i, lane_id in enumerate(lane_ids)}
+        arrays = {
+            "lane_lens": np.asarray(lane_lens, dtype=np.int64),
+            "is_bike": np.asarray(is_bike, dtype=bool),
+        }
+        for edge_type in LANE_GRAPH_EDGE_TYPES:
+            if len(adjacency_lists[edge_type]) != len(lane_ids):
+                raise AssertionError
+            for neighbour_ids in adjacency_lists[edge_type]:
+                for neighbour_id in neighbour_ids:
+                    if neighbour_id not in lane_id_2_idx:
+                        raise ValueError(f"Unknown {edge_type} lane {neighbour_id}")
+            offsets, indices = get_csr(
+                [
+                    [lane_id_2_idx[neighbour_id] for neighbour_id in neighbour_ids]
+                    for neighbour_ids in adjacency_lists[edge_type]
+                ]
+            )
+            arrays[f"{edge_type}_offsets"] = offsets
+            arrays[f"{edge_type}_indices"] = indices
+        return cls(arrays)
+
+    def get_csr(self, edge_types: Sequence[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        CSR of the union of edge types, the neighbours of a lane are concatenated in the order of edge_types.
+        """
+        edge_types = tuple(edge_types)
+        if edge_types not in self._csr:
+            counts_per_type = [
+                np.diff(self._csr[(edge_type,)][0]) for edge_type in edge_types
+            ]
+            offsets = np.zeros(self.n_lanes + 1, dtype=np.int64)
+            np.cumsum(np.sum(counts_per_type, axis=0), out=offsets[1:])
+            indices = np.empty(offsets[-1], dtype=np.int32)
+            lane_positions_used = offsets[:-1].copy()
+            for edge_type, counts in zip(edge_types, counts_per_type):
+                type_offsets, type_indices = self._csr[(edge_type,)]
+                source_lanes = np.repeat(np.arange(self.n_lanes), counts)
+                indices[
+                    lane_positions_used[source_lanes]
+                    + np.arange(len(type_indices))
+                    - type_offsets[source_lanes]
+                ] = type_indices
+                lane_positions_used += counts
+            self._csr[edge_types] = offsets, indices
+        return self._csr[edge_types]
+
+    def get_neighbours(self, lane_idx: int, edge_type: str) -> np.ndarray:
+        offsets, indices = self._csr[(edge_type,)]
+        return indices[offsets[lane_idx] : offsets[lane_idx + 1]]
+
+    def traverse(
+        self,
+        start_indices: Sequence[int],
+        start_dists: Sequence[int],
+        edge_types: Sequence[str],
+        max_dist: int,
+        expand_mask: Optional[np.ndarray] = None,
+        closed_mask: Optional[np.ndarray] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Breadth-first traversal, processed level by level with array operations.
+        The distance of a reached lane is the distance of its source lane plus its own length (in lane points),
+        a lane is expanded while its distance is below max_dist.
+        The visiting order is the one of the queue-based bfs.
+
+        Args:
+            start_indices (Sequence[int]): lane indices to start from
+            start_dists (Sequence[int]): their initial distances
+            edge_types (Sequence[str]): edge types to follow, see LANE_GRAPH_EDGE_TYPES
+            max_dist (int): distance limit for the expansion
+            expand_mask (Optional[np.ndarray]): if given, lanes with False are visited but not expanded
+            closed_mask (Optional[np.ndarray]): if given, lanes with True are not reached,
+                the reached lanes are marked in-place (without it, a lane reachable via several paths is visited
+                once per path, like in the bfs without the closed set)
+
+        Returns:
+            tuple of the visited lane indices and their distances in the visiting order
+        """
+        offsets, indices = self.get_csr(edge_types)
+        frontier_indices = np.asarray(start_indices, dtype=np.int64)
+        frontier_dists = np.asarray(start_dists, dtype=np.int64)
+        visited_indices, visited_dists = [], []
+        while len(frontier_indices):
+            visited_indices.append(frontier_indices)
+            visited_dists.append(frontier_dists)
+            is_expanded = frontier_dists < max_dist
+            if expand_mask is not None:
+                is_expanded &= expand_mask[frontier_indices]
+            next_indices, source_positions = expand_csr(
+                offsets, indices, frontier_indices[is_expanded]
+            )
+            next_indices = next_indices.astype(np.int64)
+            next_dists = (
+                frontier_dists[is_expanded][source_positions]
+                + self.lane_lens[next_indices]
+            )
+            if closed_mask is not None:
+                is_open = ~closed_mask[next_indices]
+                next_indices, next_dists = next_indices[is_open], next_dists[is_open]
+                # the first occurrence is the one enqueued by the queue-based bfs
+                _, first_positions = np.unique(next_indices, return_index=True)
+                first_positions.sort()
+                next_indices, next_dists = (
+                    next_indices[first_positions],
+                    next_dists[first_positions],
+                )
+                closed_mask[next_indices] = True
+            frontier_indices, frontier_dists = next_indices, next_dists
+        if not len(visited_indices):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        return np.concatenate(visited_indices), np.concatenate(visited_dists)
+
+    def is_reachable(
+        self, from_idx: int, to_idx: int, edge_type: str, max_depth: int
+    ) -> bool:
+        """
+        Whether to_idx is reached from from_idx in 1 to max_depth - 1 steps.
+        """
+        offsets, indices = self.get_csr((edge_type,))
+        is_seen = np.zeros(self.n_lanes, dtype=bool)
+        frontier_indices = np.array([from_idx], dtype=np.int64)
+        for _ in range(max_depth - 1):
+            next_indices, _ = expand_csr(offsets, indices, frontier_indices)
+            if np.any(next_indices == to_idx):
+                return True
+            next_indices = np.unique(next_indices[~is_seen[next_indices]])
+            if not len(next_indices):
+                return False
+            is_seen[next_indices] = True
+            frontier_indices = next_indices.astype(np.int64)
+        return False
+
+    def get_reachability_bitsets(
+        self, target_indices: Sequence[int], edge_type: str, max_depth: int
+    ) -> np.ndarray:
+        """
+        Bounded-depth transitive closure towards the target lanes, as bitsets (see is_bit_set):
+        the bit j of the lane i is set if target_indices[j] is reached from the lane i in 1 to max_depth - 1 steps,
+        same as is_reachable.
+
+        Returns:
+            (n_lanes, n_words) uint64 bitsets, 64 targets per word
+        """
+        offsets, indices = self.get_csr((edge_type,))
+        target_positions = np.arange(len(target_indices))
+        target_bitsets = np.zeros(
+            (self.n_lanes, max((len(target_indices) + 63) // 64, 1)), dtype=np.uint64
+        )
+        np.bitwise_or.at(
+            target_bitsets,
+            (np.asarray(target_indices, dtype=np.int64), target_positions // 64),
+            np.left_shift(np.uint64(1), (target_positions % 64).astype(np.uint64)),
+        )
+        source_indices = np.repeat(np.arange(self.n_lanes), np.diff(offsets))
+        reached_bitsets = np.zeros_like(target_bitsets)
+        # after k iterations, the targets reached in 1 to k steps
+        for _ in range(max_depth - 1):
+            next_reached_bitsets = np.zeros_like(target_bitsets)
+            np.bitwise_or.at(
+                next_reached_bitsets,
+                source_indices,
+                target_bitsets[indices] | reached_bitsets[indices],
+            )
+            if np.array_equal(next_reached_bitsets, reached_bitsets):
+                break
+            reached_bitsets = next_reached_bitsets
+        return reached_bitsets
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return dict(self.arrays)
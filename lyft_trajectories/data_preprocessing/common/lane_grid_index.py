@@ -0,0 +1,106 @@
+from typing import Dict, Tuple
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from lyft_trajectories.data_preprocessing.common.lane_graph import expand_csr, get_csr
+
+
+class LaneGridIndex:
+    """
+    Uniform grid over the lane points for batch candidate lookups.
+    Each cell lists the points within radius of any location inside the cell
+    (i.e. within radius + half of the cell diagonal from the cell center), only the non-empty cells are stored,
+    as sorted cell keys with the point indices in CSR format.
+    The candidates of a location are a superset of the points within radius, to be filtered by the exact distance.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.origin = arrays["origin"]
+        self.cell_size = float(arrays["cell_size"][0])
+        self.radius = float(arrays["radius"][0])
+        self.n_cells = arrays["n_cells"]
+        self.cell_keys = arrays["cell_keys"]
+        self.cell_offsets = arrays["cell_offsets"]
+        self.cell_point_indices = arrays["cell_point_indices"]
+
+    @classmethod
+    def from_points(cls, points: np.ndarray, cell_size: float, radius: float):
+        """
+        Args:
+            points (np.ndarray): (n, 2) point coordinates
+            cell_size (float): cell side in meters
+            radius (float): the max distance of the candidates the lookups must return
+
+        Returns:
+            LaneGridIndex
+        """
+        reach = radius + cell_size * np.sqrt(2) / 2
+        origin = points.min(axis=0) - reach - cell_size
+        n_cells = (
+            np.ceil((points.max(axis=0) + reach + cell_size - origin) / cell_size)
+        ).astype(np.int64)
+        # cells overlapping the bounding box of the reach of some point
+        cells_low = np.floor((points - reach - origin) / cell_size).astype(np.int64)
+        cells_high = np.floor((points + reach - origin) / cell_size).astype(np.int64)
+        span = int((cells_high - cells_low).max()) + 1
+        cell_keys = []
+        for x_shift in range(span):
+            for y_shift in range(span):
+                is_in_reach = (cells_low[:, 0] + x_shift <= cells_high[:, 0]) & (
+                    cells_low[:, 1] + y_shift <= cells_high[:, 1]
+                )
+                cell_keys.append(
+                    np.unique(
+                        (cells_low[is_in_reach, 0] + x_shift) * n_cells[1]
+                        + cells_low[is_in_reach, 1]
+                        + y_shift
+                    )
+                )
+        cell_keys = np.unique(np.concatenate(cell_keys))
+        cells = np.stack([cell_keys // n_cells[1], cell_keys % n_cells[1]], axis=1)
+        cell_centers = origin + (cells + 0.5) * cell_size
+        cell_point_lists = cKDTree(points).query_ball_point(
+            cell_centers, r=reach, return_sorted=True
+        )
+        is_non_empty = np.array([len(x) > 0 for x in cell_point_lists], dtype=bool)
+        cell_offsets, cell_point_indices = get_csr(
+            [x for x, non_empty in zip(cell_point_lists, is_non_empty) if non_empty]
+        )
+        return cls(
+            {
+                "origin": origin.astype(np.float64),
+                "cell_size": np.array([cell_size], dtype=np.float64),
+                "radius": np.array([radius], dtype=np.float64),
+                "n_cells": n_cells,
+                "cell_keys": cell_keys[is_non_empty],
+                "cell_offsets": cell_offsets,
+                "cell_point_indices": cell_point_indices,
+            }
+        )
+
+    def get_candidates(self, coords: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Args:
+            coords (np.ndarray): (m, 2) query locations
+
+        Returns:
+            tuple of the candidate point indices and the positions in coords of their query locations
+        """
+        cells = np.floor((coords - self.origin) / self.cell_size).astype(np.int64)
+        is_in_grid = np.all((cells >= 0) & (cells < self.n_cells), axis=1)
+        keys = cells[is_in_grid, 0] * self.n_cells[1] + cells[is_in_grid, 1]
+        cell_positions = np.searchsorted(self.cell_keys, keys)
+        is_found = cell_positions < len(self.cell_keys)
+        is_found[is_found] = self.cell_keys[cell_positions[is_found]] == keys[is_found]
+        point_indices, source_positions = expand_csr(
+            self.cell_offsets, self.cell_point_indices, cell_positions[is_found]
+        )
+        return (
+            point_indices.astype(np.int64),
+            np.flatnonzero(is_in_grid)[np.flatnonzero(is_found)][source_positions],
+        )
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return dict(self.arrays)
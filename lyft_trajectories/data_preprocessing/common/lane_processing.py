@@ -2,6 +2,7 @@ from lyft_trajectories.utils.l5kit_modified.map_api import MapAPI
 import numpy as np
 from tqdm.auto import tqdm
 from typing import Dict
+from multiprocessing import Pool
 
 # CONSTANTS ###############
 FILTER_AGENTS_THRESHOLD = 0.5
@@ -31,218 +32,225 @@ def densify_sparse_segments(
     y_coordinates_seq_np: np.ndarray,
     max_diff: float = 0.01,
 ):
-    # the operation is done just once, so performing it naively
     if len(x_coordinates_seq_np) != len(y_coordinates_seq_np):
         raise AssertionError("Different lens of x/y coordinates")
-    x_final_seq_np = np.array([])
-    y_final_seq_np = np.array([])
-    for i in range(0, len(x_coordinates_seq_np) - 1):
-        abs_diff = np.hypot(
-            x_coordinates_seq_np[i + 1] - x_coordinates_seq_np[i],
-            y_coordinates_seq_np[i + 1] - y_coordinates_seq_np[i],
-        )
-        if abs_diff > max_diff:
-            n_interpolated_points = int(np.ceil(abs_diff / max_diff)) + 1
-            x_points_to_append = np.interp(
-                np.linspace(0, 1, n_interpolated_points),
-                np.arange(2),
-                x_coordinates_seq_np[i : i + 2],
-            )
-
-            y_points_to_append = np.interp(
-                np.linspace(0, 1, n_interpolated_points),
-                np.arange(2),
-                y_coordinates_seq_np[i : i + 2],
-            )
-
-        else:
-            x_points_to_append = x_coordinates_seq_np[i : i + 2]
-            y_points_to_append = y_coordinates_seq_np[i : i + 2]
-        if i > 0:
-            x_points_to_append = x_points_to_append[1:]
-            y_points_to_append = y_points_to_append[1:]
-        x_final_seq_np = np.append(x_final_seq_np, x_points_to_append)
-        y_final_seq_np = np.append(y_final_seq_np, y_points_to_append)
+    if len(x_coordinates_seq_np) < 2:
+        return np.array([]), np.array([])
+    x_starts, x_ends = x_coordinates_seq_np[:-1], x_coordinates_seq_np[1:]
+    y_starts, y_ends = y_coordinates_seq_np[:-1], y_coordinates_seq_np[1:]
+    abs_diffs = np.hypot(x_ends - x_starts, y_ends - y_starts)
+    # each segment is linearly interpolated, the segment start is skipped except for the first segment
+    segment_n_points = np.where(
+        abs_diffs > max_diff, np.ceil(abs_diffs / max_diff).astype(np.int64) + 1, 2
+    )
+    segment_n_appended = segment_n_points - 1
+    segment_n_appended[0] += 1
+    segment_indices = np.repeat(np.arange(len(abs_diffs)), segment_n_appended)
+    appended_offsets = np.cumsum(segment_n_appended) - segment_n_appended
+    point_indices = np.arange(len(segment_indices)) - appended_offsets[segment_indices]
+    point_indices[segment_n_appended[0] :] += 1
+    n_points = segment_n_points[segment_indices]
+    # the same as the steps of np.linspace(0, 1, n_points)
+    weights = point_indices * (1.0 / (n_points - 1))
+    is_segment_end = point_indices == n_points - 1
+    x_final_seq_np = np.where(
+        is_segment_end,
+        x_ends[segment_indices],
+        x_starts[segment_indices] + weights * (x_ends - x_starts)[segment_indices],
+    )
+    y_final_seq_np = np.where(
+        is_segment_end,
+        y_ends[segment_indices],
+        y_starts[segment_indices] + weights * (y_ends - y_starts)[segment_indices],
+    )
     return x_final_seq_np, y_final_seq_np
 
 
-def sparsify(xy_seq_np: np.ndarray, final_min_coord_dist_metr: float = 2.0):
-    prev_point = xy_seq_np[0]
-    final_list = [prev_point]
-    for i in range(1, len(xy_seq_np)):
-        delta_x = prev_point[0] - xy_seq_np[i, 0]
-        delta_y = prev_point[1] - xy_seq_np[i, 1]
-        dist = np.hypot(delta_x, delta_y)
-        if dist >= final_min_coord_dist_metr:
-            final_list.append(xy_seq_np[i])
-            prev_point = xy_seq_np[i]
-    if np.any(prev_point != xy_seq_np[-1]):
-        final_list.append(xy_seq_np[-1])
-    return np.array(final_list)
+def sparsify(
+    xy_seq_np: np.ndarray,
+    final_min_coord_dist_metr: float = 2.0,
+    search_window: int = 256,
+):
+    # greedy: the next kept point is the first one at least final_min_coord_dist_metr away from the previous kept point,
+    # it's searched for in windows of growing size (dense lines have hundreds of points between the kept ones)
+    kept_indices = [0]
+    prev_idx = 0
+    search_start = 1
+    while search_start < len(xy_seq_np):
+        window = search_window
+        next_idx = None
+        while search_start < len(xy_seq_np):
+            search_end = min(search_start + window, len(xy_seq_np))
+            dists = np.hypot(
+                xy_seq_np[prev_idx, 0] - xy_seq_np[search_start:search_end, 0],
+                xy_seq_np[prev_idx, 1] - xy_seq_np[search_start:search_end, 1],
+            )
+            far_indices = np.flatnonzero(dists >= final_min_coord_dist_metr)
+            if len(far_indices):
+                next_idx = search_start + far_indices[0]
+                break
+            search_start = search_end
+            window *= 2
+        if next_idx is None:
+            break
+        kept_indices.append(next_idx)
+        prev_idx = next_idx
+        search_start = next_idx + 1
+    if np.any(xy_seq_np[prev_idx] != xy_seq_np[-1]):
+        kept_indices.append(len(xy_seq_np) - 1)
+    return xy_seq_np[kept_indices]
 
 
 def get_lane_cumul_distances(xy_seq_np: np.ndarray):
-    idx_2_cumul_distances = [[] for _ in range(len(xy_seq_np))]
-
-    def get_dist(idx_0, idx_1):
-        deltas = xy_seq_np[idx_0] - xy_seq_np[idx_1]
-        return np.hypot(deltas[0], deltas[1])
-
-    for i in range(len(xy_seq_np)):
-        # computing backward along the lane
-        dist_backward = 0
-        backward_dists = []
-        for k in range(i - 1, -1, -1):
-            segment_len = get_dist(k, k + 1)
-            dist_backward += segment_len
-            backward_dists.append(dist_backward)
-        idx_2_cumul_distances[i].extend(reversed(backward_dists))
-        idx_2_cumul_distances[i].append(0)
-
-        # computing forward along the lane
-        dist_forward = 0
-        for k in range(i + 1, len(xy_seq_np), 1):
-            segment_len = get_dist(k, k - 1)
-            dist_forward += segment_len
-            idx_2_cumul_distances[i].append(dist_forward)
-    return idx_2_cumul_distances
-
-
-def get_helping_angle(vector_1: np.ndarray):
-    vector_0 = np.array([1, 0])
-    angle_cos = np.dot(vector_0, vector_1) / np.linalg.norm(vector_1)
-    alpha = np.arccos(angle_cos)
-    if vector_1[1] < 0:
-        alpha = 2 * np.pi - alpha
-    return alpha
+    """
+    Cumulative distances along the lane from its first point,
+    the distance between points i and k is abs(cumul_distances[k] - cumul_distances[i]).
+    """
+    segment_lens = np.hypot(
+        xy_seq_np[1:, 0] - xy_seq_np[:-1, 0], xy_seq_np[1:, 1] - xy_seq_np[:-1, 1]
+    )
+    return np.concatenate([[0.0], np.cumsum(segment_lens)])
+
+
+def get_helping_angles(vectors_1: np.ndarray):
+    angles_cos = vectors_1[:, 0] / np.sqrt(vectors_1[:, 0] ** 2 + vectors_1[:, 1] ** 2)
+    alphas = np.arccos(angles_cos)
+    return np.where(vectors_1[:, 1] < 0, 2 * np.pi - alphas, alphas)
 
 
 def get_lane_segments_sin_cosine(xy_seq_np: np.ndarray):
-    idx_2_sin_cos_forward = []
-    for i in range(len(xy_seq_np) - 1):
-        vector_1 = xy_seq_np[i + 1] - xy_seq_np[i]
-        helping_angle = get_helping_angle(vector_1)
-        idx_2_sin_cos_forward.append((np.sin(helping_angle), np.cos(helping_angle)))
-    idx_2_sin_cos_forward.append((np.nan, np.nan))
-
-    idx_2_sin_cos_backward = []
-    for i in range(len(xy_seq_np) - 1, 0, -1):
-        vector_1 = xy_seq_np[i - 1] - xy_seq_np[i]
-        helping_angle = get_helping_angle(vector_1)
-        idx_2_sin_cos_backward.append((np.sin(helping_angle), np.cos(helping_angle)))
-    idx_2_sin_cos_backward.append((np.nan, np.nan))
-    return idx_2_sin_cos_forward, list(reversed(idx_2_sin_cos_backward))
-
-
-def precompute_map_elements(proto_API: MapAPI):
-    lanes_ids = []
-    crosswalks_ids = []
-    center_line_coords = []
-    xy_left_coords = []
-    xy_right_coords = []
-    xy_left_coords_ = []
-    xy_right_coords_ = []
-
-    lane_point_idx_2_cumul_distances = []
-    lane_point_idx_2_sin_cos_forward = []
-    lane_point_idx_2_sin_cos_backward = []
-
-    lanes_bounds = np.empty(
-        (0, 2, 2), dtype=np.float
-    )  # [(X_MIN, Y_MIN), (X_MAX, Y_MAX)]
-    crosswalks_bounds = np.empty(
-        (0, 2, 2), dtype=np.float
-    )  # [(X_MIN, Y_MIN), (X_MAX, Y_MAX)]
-
-    for element in tqdm(proto_API):
-        element_id = MapAPI.id_as_str(element.id)
+    """
+    Returns:
+        (n, 2) arrays of (sin, cos) of the forward segment angles (nan for the last point)
+        and of the backward segment angles (nan for the first point)
+    """
+    idx_2_sin_cos_forward = np.full((len(xy_seq_np), 2), np.nan)
+    idx_2_sin_cos_backward = np.full((len(xy_seq_np), 2), np.nan)
+    forward_angles = get_helping_angles(xy_seq_np[1:] - xy_seq_np[:-1])
+    idx_2_sin_cos_forward[:-1, 0] = np.sin(forward_angles)
+    idx_2_sin_cos_forward[:-1, 1] = np.cos(forward_angles)
+    backward_angles = get_helping_angles(xy_seq_np[:-1] - xy_seq_np[1:])
+    idx_2_sin_cos_backward[1:, 0] = np.sin(backward_angles)
+    idx_2_sin_cos_backward[1:, 1] = np.cos(backward_angles)
+    return idx_2_sin_cos_forward, idx_2_sin_cos_backward
+
+
+def get_lane_elements(lane: Dict):
+    """
+    Lane geometry processing, independent of other lanes and of the protobuf map.
+
+    Args:
+        lane (Dict): decoded lane boundaries, output of MapAPI.get_lane_coords
+
+    Returns:
+        dict with the lane bounds, center line, sparse and dense boundaries, cumulative distances and segment angles
+    """
+    x_min = min(np.min(lane["xyz_left"][:, 0]), np.min(lane["xyz_right"][:, 0]))
+    y_min = min(np.min(lane["xyz_left"][:, 1]), np.min(lane["xyz_right"][:, 1]))
+    x_max = max(np.max(lane["xyz_left"][:, 0]), np.max(lane["xyz_right"][:, 0]))
+    y_max = max(np.max(lane["xyz_left"][:, 1]), np.max(lane["xyz_right"][:, 1]))
+
+    x_left_, y_left_ = densify_sparse_segments(
+        lane["xyz_left"][:, 0], lane["xyz_left"][:, 1]
+    )
+    x_right_, y_right_ = densify_sparse_segments(
+        lane["xyz_right"][:, 0], lane["xyz_right"][:, 1]
+    )
 
-        if proto_API.is_lane(element):
-            lane = proto_API.get_lane_coords(element_id)
-            x_min = min(np.min(lane["xyz_left"][:, 0]), np.min(lane["xyz_right"][:, 0]))
-            y_min = min(np.min(lane["xyz_left"][:, 1]), np.min(lane["xyz_right"][:, 1]))
-            x_max = max(np.max(lane["xyz_left"][:, 0]), np.max(lane["xyz_right"][:, 0]))
-            y_max = max(np.max(lane["xyz_left"][:, 1]), np.max(lane["xyz_right"][:, 1]))
-
-            x_left_, y_left_ = densify_sparse_segments(
-                lane["xyz_left"][:, 0], lane["xyz_left"][:, 1]
-            )
-            x_right_, y_right_ = densify_sparse_segments(
-                lane["xyz_right"][:, 0], lane["xyz_right"][:, 1]
-            )
+    if len(x_left_) == len(x_right_):
+        x_right = x_right_
+        x_left = x_left_
 
-            if len(x_left_) == len(x_right_):
-                x_right = x_right_
-                x_left = x_left_
+        y_right = y_right_
+        y_left = y_left_
 
-                y_right = y_right_
-                y_left = y_left_
+    elif len(x_left_) < len(x_right_):
+        x_right = x_right_
+        x_left = np.interp(
+            np.linspace(0, len(x_left_) - 1, len(x_right)),
+            np.arange(len(x_left_)),
+            x_left_,
+        )
 
-            elif len(x_left_) < len(x_right_):
-                x_right = x_right_
-                x_left = np.interp(
-                    np.linspace(0, len(x_left_) - 1, len(x_right)),
-                    np.arange(len(x_left_)),
-                    x_left_,
-                )
+        y_right = y_right_
+        y_left = np.interp(
+            np.linspace(0, len(y_left_) - 1, len(y_right)),
+            np.arange(len(y_left_)),
+            y_left_,
+        )
 
-                y_right = y_right_
-                y_left = np.interp(
-                    np.linspace(0, len(y_left_) - 1, len(y_right)),
-                    np.arange(len(y_left_)),
-                    y_left_,
-                )
+    elif len(x_left_) > len(x_right_):
+        x_left = x_left_
+        x_right = np.interp(
+            np.linspace(0, len(x_right_) - 1, len(x_left)),
+            np.arange(len(x_right_)),
+            x_right_,
+        )
 
-            elif len(x_left_) > len(x_right_):
-                x_left = x_left_
-                x_right = np.interp(
-                    np.linspace(0, len(x_right_) - 1, len(x_left)),
-                    np.arange(len(x_right_)),
-                    x_right_,
-                )
+        y_left = y_left_
+        y_right = np.interp(
+            np.linspace(0, len(y_right_) - 1, len(y_left)),
+            np.arange(len(y_right_)),
+            y_right_,
+        )
+    else:
+        raise Exception("Bug in lane length comparison")
+    if len(x_left) != len(x_right):
+        raise AssertionError
 
-                y_left = y_left_
-                y_right = np.interp(
-                    np.linspace(0, len(y_right_) - 1, len(y_left)),
-                    np.arange(len(y_right_)),
-                    y_right_,
-                )
-            else:
-                raise Exception("Bug in lane length comparison")
-            if len(x_left) != len(x_right):
-                raise AssertionError
+    center_line = np.transpose(
+        np.vstack(((x_left + x_right) / 2, (y_left + y_right) / 2))
+    )
+    center_line = sparsify(center_line)
+
+    (
+        idx_2_sin_cos_forward,
+        idx_2_sin_cos_backward,
+    ) = get_lane_segments_sin_cosine(center_line)
+    if not (
+        len(idx_2_sin_cos_forward) == len(idx_2_sin_cos_backward)
+        and len(idx_2_sin_cos_forward) == len(center_line)
+    ):
+        raise AssertionError
 
-            center_line = np.transpose(
-                np.vstack(((x_left + x_right) / 2, (y_left + y_right) / 2))
-            )
-            center_line = sparsify(center_line)
+    return {
+        "bounds": [[x_min, y_min], [x_max, y_max]],
+        "center_line": center_line,
+        "xy_left": lane["xyz_left"][:, :2],
+        "xy_right": lane["xyz_right"][:, :2],
+        "xy_left_": sparsify(np.transpose(np.vstack((x_left, y_left)))),
+        "xy_right_": sparsify(np.transpose(np.vstack((x_right, y_right)))),
+        "lane_point_idx_2_cumul_distances": get_lane_cumul_distances(center_line),
+        "lane_point_idx_2_sin_cos_forward": idx_2_sin_cos_forward,
+        "lane_point_idx_2_sin_cos_backward": idx_2_sin_cos_backward,
+    }
 
-            lanes_bounds = np.append(
-                lanes_bounds, np.asarray([[[x_min, y_min], [x_max, y_max]]]), axis=0
-            )
+
+def precompute_map_elements(proto_API: MapAPI, n_jobs: int = 1):
+    """
+    Decodes the lanes and crosswalks from the protobuf map.
+    With n_jobs > 1 the lane geometry is processed by a process pool,
+    the results are merged in the map elements order, so the output doesn't depend on n_jobs.
+
+    Args:
+        proto_API (MapAPI): semantic map API
+        n_jobs (int): number of processes for the lane geometry processing
+
+    Returns:
+        dict of the lanes and crosswalks data
+    """
+    lanes_ids = []
+    lanes_coords = []
+    crosswalks_ids = []
+    crosswalks_bounds = []  # [(X_MIN, Y_MIN), (X_MAX, Y_MAX)]
+
+    # decoding is done sequentially (the protobuf map isn't shared with the workers), it's the cheap part
+    for element in tqdm(proto_API, desc="Decoding map elements"):
+        element_id = MapAPI.id_as_str(element.id)
+
+        if proto_API.is_lane(element):
             lanes_ids.append(element_id)
-            center_line_coords.append(center_line)
-            xy_left_coords.append(lane["xyz_left"][:, :2])
-            xy_right_coords.append(lane["xyz_right"][:, :2])
-            xy_left_dense = np.transpose(np.vstack((x_left, y_left)))
-            xy_right_dense = np.transpose(np.vstack((x_right, y_right)))
-            xy_left_coords_.append(sparsify(xy_left_dense))
-            xy_right_coords_.append(sparsify(xy_right_dense))
-
-            lane_point_idx_2_cumul_distances.append(
-                get_lane_cumul_distances(center_line)
-            )
-            (
-                idx_2_sin_cos_forward,
-                idx_2_sin_cos_backward,
-            ) = get_lane_segments_sin_cosine(center_line)
-            lane_point_idx_2_sin_cos_forward.append(idx_2_sin_cos_forward)
-            lane_point_idx_2_sin_cos_backward.append(idx_2_sin_cos_backward)
-            if not (
-                len(idx_2_sin_cos_forward) == len(idx_2_sin_cos_backward)
-                and len(idx_2_sin_cos_forward) == len(center_line)
-            ):
-                raise AssertionError
+            lanes_coords.append(proto_API.get_lane_coords(element_id))
 
         if proto_API.is_crosswalk(element):
             crosswalk = proto_API.get_crosswalk_coords(element_id)
@@ -250,28 +258,49 @@ def precompute_map_elements(proto_API: MapAPI):
             y_min = np.min(crosswalk["xyz"][:, 1])
             x_max = np.max(crosswalk["xyz"][:, 0])
             y_max = np.max(crosswalk["xyz"][:, 1])
+            crosswalks_bounds.append([[x_min, y_min], [x_max, y_max]])
+            crosswalks_ids.append(element_id)
 
-            crosswalks_bounds = np.append(
-                crosswalks_bounds,
-                np.asarray([[[x_min, y_min], [x_max, y_max]]]),
-                axis=0,
+    if n_jobs > 1:
+        with Pool(n_jobs) as pool:
+            # imap keeps the input order
+            lanes_elements = list(
+                tqdm(
+                    pool.imap(get_lane_elements, lanes_coords, chunksize=64),
+                    total=len(lanes_coords),
+                    desc="Processing lanes",
+                )
             )
-            crosswalks_ids.append(element_id)
+    else:
+        lanes_elements = [
+            get_lane_elements(lane)
+            for lane in tqdm(lanes_coords, desc="Processing lanes")
+        ]
 
+    lanes = {
+        "bounds": np.array(
+            [lane_elements["bounds"] for lane_elements in lanes_elements],
+            dtype=np.float64,
+        ).reshape(-1, 2, 2),
+        "ids": lanes_ids,
+    }
+    for key in [
+        "center_line",
+        "xy_left",
+        "xy_right",
+        "xy_left_",
+        "xy_right_",
+        "lane_point_idx_2_cumul_distances",
+        "lane_point_idx_2_sin_cos_forward",
+        "lane_point_idx_2_sin_cos_backward",
+    ]:
+        lanes[key] = [lane_elements[key] for lane_elements in lanes_elements]
     return {
-        "lanes": {
-            "bounds": lanes_bounds,
-            "ids": lanes_ids,
-            "center_line": center_line_coords,
-            "xy_left": xy_left_coords,
-            "xy_right": xy_right_coords,
-            "xy_left_": xy_left_coords_,
-            "xy_right_": xy_right_coords_,
-            "lane_point_idx_2_cumul_distances": lane_point_idx_2_cumul_distances,
-            "lane_point_idx_2_sin_cos_forward": lane_point_idx_2_sin_cos_forward,
-            "lane_point_idx_2_sin_cos_backward": lane_point_idx_2_sin_cos_backward,
+        "lanes": lanes,
+        "crosswalks": {
+            "bounds": np.array(crosswalks_bounds, dtype=np.float64).reshape(-1, 2, 2),
+            "ids": crosswalks_ids,
         },
-        "crosswalks": {"bounds": crosswalks_bounds, "ids": crosswalks_ids},
     }
 
 
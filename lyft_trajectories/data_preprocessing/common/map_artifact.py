@@ -0,0 +1,121 @@
+import json
+import os
+import pickle
+import struct
+from typing import Any, Dict, Tuple
+
+import numpy as np
+
+from lyft_trajectories.data_preprocessing.common.map_cache import atomic_write
+
+# file layout: magic | header length (uint64) | json header | aligned array blocks | pickled objects block
+MAP_ARTIFACT_MAGIC = b"LYFTMAP\x00"
+MAP_ARTIFACT_ALIGNMENT = 64
+_HEADER_LEN_FORMAT = "<Q"
+
+
+def _aligned(offset: int, alignment: int = MAP_ARTIFACT_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def save_map_artifact(
+    path: str, arrays: Dict[str, np.ndarray], objects: Dict[str, Any], key: str
+):
+    """
+    Stores numpy arrays and (small) python objects in a single file.
+    Arrays are written as raw aligned blocks, so that they can be memory-mapped on load,
+    the remaining python objects are pickled into the last block.
+
+    Args:
+        path (str): output file path
+        arrays (Dict[str, np.ndarray]): arrays to store (numeric or fixed-width strings)
+        objects (Dict[str, Any]): picklable python objects
+        key (str): content hash key of the stored content, checked on load
+    """
+    arrays = {name: np.ascontiguousarray(array) for name, array in arrays.items()}
+    objects_bytes = pickle.dumps(objects, protocol=pickle.HIGHEST_PROTOCOL)
+
+    # offsets are relative to the data start, which depends on the header length
+    arrays_spec, relative_offset = dict(), 0
+    for name, array in arrays.items():
+        arrays_spec[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": relative_offset,
+        }
+        relative_offset = _aligned(relative_offset + array.nbytes)
+    header = {
+        "key": key,
+        "arrays": arrays_spec,
+        "objects": {"offset": relative_offset, "size": len(objects_bytes)},
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = _aligned(
+        len(MAP_ARTIFACT_MAGIC)
+        + struct.calcsize(_HEADER_LEN_FORMAT)
+        + len(header_bytes)
+    )
+
+    def write_artifact(f):
+        f.write(MAP_ARTIFACT_MAGIC)
+        f.write(struct.pack(_HEADER_LEN_FORMAT, len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + arrays_spec[name]["offset"])
+            f.write(array.tobytes())
+        f.seek(data_start + header["objects"]["offset"])
+        f.write(objects_bytes)
+
+    # the processes having the previous file mapped keep reading it
+    atomic_write(path, write_artifact)
+
+
+def read_map_artifact_header(path: str) -> Tuple[Dict, int]:
+    with open(path, "rb") as f:
+        if f.read(len(MAP_ARTIFACT_MAGIC)) != MAP_ARTIFACT_MAGIC:
+            raise ValueError(f"{path} is not a compiled map artifact")
+        (header_len,) = struct.unpack(
+            _HEADER_LEN_FORMAT, f.read(struct.calcsize(_HEADER_LEN_FORMAT))
+        )
+        header = json.loads(f.read(header_len).decode("utf-8"))
+    data_start = _aligned(
+        len(MAP_ARTIFACT_MAGIC) + struct.calcsize(_HEADER_LEN_FORMAT) + header_len
+    )
+    return header, data_start
+
+
+def is_map_artifact_current(path: str, key: str) -> bool:
+    if not os.path.exists(path):
+        return False
+    try:
+        header, _ = read_map_artifact_header(path)
+    except ValueError:
+        return False
+    return header.get("key") == key
+
+
+def load_map_artifact(path: str) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    """
+    Loads the artifact stored by save_map_artifact.
+    Arrays are read-only views into the memory-mapped file, so the pages are shared between processes.
+
+    Args:
+        path (str): artifact file path
+
+    Returns:
+        tuple of the arrays dict and the python objects dict
+    """
+    header, data_start = read_map_artifact_header(path)
+    buffer = np.memmap(path, dtype=np.uint8, mode="r")
+    arrays = dict()
+    for name, spec in header["arrays"].items():
+        dtype = np.dtype(spec["dtype"])
+        count = int(np.prod(spec["shape"], dtype=np.int64))
+        arrays[name] = np.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + spec["offset"]
+        ).reshape(spec["shape"])
+    objects_start = data_start + header["objects"]["offset"]
+    objects = pickle.loads(
+        buffer[objects_start : objects_start + header["objects"]["size"]].tobytes()
+    )
+    return arrays, objects
@@ -0,0 +1,134 @@
+import fcntl
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+from typing import Any, Callable
+
+MAP_CACHE_DIR = "input/map_cache"
+HASH_CHUNK_SIZE = 2 ** 20
+
+# (abs path, size, mtime) -> hash, in order not to re-read the same file in the same process
+_file_hash_memo = dict()
+
+
+def _compute_file_hash(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_file_hash(path: str) -> str:
+    """
+    Content hash of the file, the full file is read only once per (abs path, size, mtime):
+    the hash is memoized in the process and persisted in the cache dir for the other processes.
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _file_hash_memo:
+        _file_hash_memo[memo_key] = load_or_compute(
+            "file_hash", get_cache_key(*memo_key), lambda: _compute_file_hash(path)
+        )
+    return _file_hash_memo[memo_key]
+
+
+def get_object_hash(obj: Any) -> str:
+    # meant for the manual fix tables (nested lists, tuples, strings and numbers)
+    return hashlib.sha256(
+        json.dumps(obj, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def get_cache_key(*parts: Any) -> str:
+    return hashlib.sha256("|".join(str(x) for x in parts).encode("utf-8")).hexdigest()[
+        :16
+    ]
+
+
+def get_umask() -> int:
+    # the umask can be read by setting it only
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def atomic_write(path: str, write_function: Callable, binary: bool = True):
+    """
+    Writes into a temporary file in the same directory and renames it to the path,
+    so that concurrent readers see either the complete previous file or the complete new one.
+
+    Args:
+        path (str): output file path
+        write_function (Callable): function receiving the opened file object
+        binary (bool): whether to open the file in binary mode
+    """
+    output_dir = os.path.dirname(os.path.abspath(path))
+    os.makedirs(output_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=output_dir, prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb" if binary else "w") as f:
+            write_function(f)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable by the owner only, the default mode of the new files is kept
+        os.chmod(tmp_path, 0o666 & ~get_umask())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def atomic_pickle_dump(obj: Any, path: str):
+    atomic_write(path, lambda f: pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+class CacheLock:
+    """
+    Inter-process lock (flock on a sidecar file), so that concurrent jobs
+    compute a missing cache entry once and the others wait to reuse it.
+    """
+
+    def __init__(self, path: str):
+        self.lock_path = f"{path}.lock"
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.lock_path)), exist_ok=True)
+        self.lock_file = open(self.lock_path, "a")
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+
+
+def get_cache_path(name: str, key: str, extension: str = "pkl") -> str:
+    return os.path.join(MAP_CACHE_DIR, f"{name}_{key}.{extension}")
+
+
+def load_or_compute(name: str, key: str, compute_function: Callable[[], Any]):
+    """
+    Returns the cached result of compute_function for the key, computing and storing it if missing.
+
+    Args:
+        name (str): cache entry name
+        key (str): content hash key, see get_cache_key
+        compute_function (Callable[[], Any]): computes the picklable entry
+
+    Returns:
+        the cached entry
+    """
+    path = get_cache_path(name, key)
+    if not os.path.exists(path):
+        with CacheLock(path):
+            # another job might have computed it while waiting for the lock
+            if not os.path.exists(path):
+                atomic_pickle_dump(compute_function(), path)
+    with open(path, "rb") as f:
+        return pickle.load(f)
@@ -0,0 +1,148 @@
+from typing import Dict
+
+import numpy as np
+
+from lyft_trajectories.data_preprocessing.common.lane_graph import get_csr
+
+LEAF_NODE_SPLIT_DIM = -1
+
+
+def get_dists_to_bounds(points: np.ndarray, bounds: np.ndarray) -> np.ndarray:
+    # distances of the points to the box with the (min, max) corners bounds, zero inside the box
+    dists_outside = np.maximum(np.maximum(bounds[0] - points, points - bounds[1]), 0)
+    return np.hypot(dists_outside[:, 0], dists_outside[:, 1])
+
+
+class MapPartition:
+    """
+    Balanced k-d partition of the plane over the lane points: a cell is split at the median of its points
+    along the wider coordinate extent, until at most max_leaf_points points per leaf.
+    The leaf cells cover the whole plane (the outer cells are unbounded), so every location has a leaf.
+    Each leaf lists the lanes having points within margin of its cell, in increasing lane index order.
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.split_dims = arrays["split_dims"]
+        self.split_values = arrays["split_values"]
+        self.children = arrays["children"]
+        self.node_leaf_indices = arrays["node_leaf_indices"]
+        self.leaf_bounds = arrays["leaf_bounds"]
+        self.leaf_lane_offsets = arrays["leaf_lane_offsets"]
+        self.leaf_lane_indices = arrays["leaf_lane_indices"]
+        self.n_leaves = len(self.leaf_bounds)
+        # the descent of a single location is faster on python lists
+        self._nodes = list(
+            zip(
+                self.split_dims.tolist(),
+                self.split_values.tolist(),
+                self.children[:, 0].tolist(),
+                self.children[:, 1].tolist(),
+                self.node_leaf_indices.tolist(),
+            )
+        )
+
+    @classmethod
+    def from_lane_points(
+        cls,
+        points: np.ndarray,
+        point_lane_indices: np.ndarray,
+        max_leaf_points: int,
+        margin: float,
+    ):
+        """
+        Args:
+            points (np.ndarray): (n, 2) lane points
+            point_lane_indices (np.ndarray): lane index of each point
+            max_leaf_points (int): max number of points inside a leaf cell
+            margin (float): distance from the leaf cell within which the lanes are listed for the leaf
+
+        Returns:
+            MapPartition
+        """
+        split_dims, split_values, children, node_leaf_indices = [], [], [], []
+        leaf_bounds, leaf_lanes = [], []
+
+        def add_node():
+            split_dims.append(LEAF_NODE_SPLIT_DIM)
+            split_values.append(np.nan)
+            children.append([-1, -1])
+            node_leaf_indices.append(-1)
+            return len(split_dims) - 1
+
+        # (node idx, point indices, cell bounds)
+        stack = [
+            (
+                add_node(),
+                np.arange(len(points)),
+                np.array([[-np.inf] * 2, [np.inf] * 2]),
+            )
+        ]
+        while len(stack):
+            node_idx, point_indices, bounds = stack.pop()
+            node_points = points[point_indices]
+            if len(point_indices) > max_leaf_points:
+                split_dim = int(np.argmax(np.ptp(node_points, axis=0)))
+                split_coords = np.sort(node_points[:, split_dim])
+                split_value = split_coords[len(point_indices) // 2]
+                is_left = node_points[:, split_dim] < split_value
+                # all the points might be on the split coordinate
+                if 0 < is_left.sum() < len(point_indices):
+                    split_dims[node_idx] = split_dim
+                    split_values[node_idx] = split_value
+                    for child_i, child_points in enumerate(
+                        [point_indices[is_left], point_indices[~is_left]]
+                    ):
+                        child_bounds = bounds.copy()
+                        child_bounds[1 - child_i, split_dim] = split_value
+                        children[node_idx][child_i] = add_node()
+                        stack.append(
+                            (children[node_idx][child_i], child_points, child_bounds)
+                        )
+                    continue
+            node_leaf_indices[node_idx] = len(leaf_bounds)
+            leaf_bounds.append(bounds)
+            is_near = get_dists_to_bounds(points, bounds) <= margin
+            leaf_lanes.append(np.unique(point_lane_indices[is_near]).tolist())
+
+        leaf_lane_offsets, leaf_lane_indices = get_csr(leaf_lanes)
+        return cls(
+            {
+                "split_dims": np.array(split_dims, dtype=np.int8),
+                "split_values": np.array(split_values, dtype=np.float64),
+                "children": np.array(children, dtype=np.int32).reshape(-1, 2),
+                "node_leaf_indices": np.array(node_leaf_indices, dtype=np.int32),
+                "leaf_bounds": np.array(leaf_bounds, dtype=np.float64).reshape(
+                    -1, 2, 2
+                ),
+                "leaf_lane_offsets": leaf_lane_offsets,
+                "leaf_lane_indices": leaf_lane_indices,
+            }
+        )
+
+    def get_leaf_idx(self, coord: np.ndarray) -> int:
+        node = self._nodes[0]
+        while node[0] != LEAF_NODE_SPLIT_DIM:
+            node = self._nodes[node[2] if coord[node[0]] < node[1] else node[3]]
+        return node[4]
+
+    def get_leaf_indices(self, coords: np.ndarray) -> np.ndarray:
+        node_indices = np.zeros(len(coords), dtype=np.int64)
+        split_dims = self.split_dims[node_indices]
+        while np.any(split_dims != LEAF_NODE_SPLIT_DIM):
+            is_inner = np.flatnonzero(split_dims != LEAF_NODE_SPLIT_DIM)
+            inner_nodes = node_indices[is_inner]
+            is_right = (
+                coords[is_inner, split_dims[is_inner]] >= self.split_values[inner_nodes]
+            )
+            node_indices[is_inner] = self.children[inner_nodes, is_right.astype(int)]
+            split_dims = self.split_dims[node_indices]
+        return self.node_leaf_indices[node_indices]
+
+    def get_leaf_lane_indices(self, leaf_idx: int) -> np.ndarray:
+        return self.leaf_lane_indices[
+            self.leaf_lane_offsets[leaf_idx] : self.leaf_lane_offsets[leaf_idx + 1]
+        ]
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return dict(self.arrays)
@@ -1,33 +1,60 @@
 import os
-from lyft_trajectories.utils.l5kit_modified.map_api import MapAPI
-from lyft_trajectories.data_preprocessing.common.lane_processing import (
-    precompute_lane_adjacencies,
-    precompute_map_elements,
-    semantic_map_key,
-    world_to_ecef,
+from lyft_trajectories.data_preprocessing.common.map_artifact import (
+    is_map_artifact_current,
+    load_map_artifact,
+    read_map_artifact_header,
+    save_map_artifact,
 )
+from lyft_trajectories.data_preprocessing.common.map_cache import (
+    get_cache_key,
+    get_file_hash,
+    get_object_hash,
+    load_or_compute,
+)
+from lyft_trajectories.data_preprocessing.common.intersection_metadata import (
+    get_tl_signal_idx_2_master_intersection_idx,
+    is_intersection_metadata_current,
+    save_intersection_metadata,
+)
+from lyft_trajectories.data_preprocessing.common.lane_graph import (
+    LaneGraph,
+    expand_csr,
+    get_set_bit_indices,
+    is_bit_set,
+)
+from lyft_trajectories.data_preprocessing.common.lane_grid_index import LaneGridIndex
+from lyft_trajectories.data_preprocessing.common.map_partition import (
+    MapPartition,
+    get_dists_to_bounds,
+)
+from lyft_trajectories.data_preprocessing.common.timestamps import (
+    NS_PER_SEC,
+    datetime_2_timestamp_ns,
+)
+from lyft_trajectories.data_preprocessing.common.traffic_face_table import (
+    TrafficFaceTable,
+)
+import logging
 import pickle
-from l5kit.data import LocalDataManager, ChunkedDataset
 import numpy as np
-import matplotlib.pyplot as plt
-from copy import deepcopy
-from pytz import timezone
 from datetime import datetime
 from l5kit.data.filter import filter_tl_faces_by_status
 import pandas as pd
 from tqdm.auto import tqdm
 from glob import glob
-from scipy.spatial import KDTree
-from sklearn.cluster import KMeans
-from collections import defaultdict, deque
+from scipy.spatial import cKDTree
+from collections import OrderedDict, defaultdict
 import bisect
-from typing import Callable, Dict, List, Set, Tuple
+from typing import Callable, Dict, List, Sequence, Set, Tuple, Union
 from torch.utils.data import DataLoader
 
 os.environ["L5KIT_DATA_FOLDER"] = "input/"
 CAR_CLASS = 3
 BIKE_CLASS = 10
 ALL_WHEELS_CLASS = -1
+# per-point class flags of the kd scopes, the kd trees are shared by the agent classes
+KD_FLAG_BIKE = 1
+KD_FLAG_NOT_BIKE = 2
 TL_GREEN_COLOR = 1
 TL_RED_COLOR = 0
 TL_YELLOW_COLOR = 0
@@ -36,67 +63,68 @@ LANE_IDLE_CODE = 0
 LANE_ON_MOVE_CODE = 1
 SEGMENTS_OUTPUT_PATH = "outputs/map_segments"
 NUM_MAP_SEGMENTS = 13
-
-dm = LocalDataManager(None)
-
-# ------------------------------------
-
-# Checking junction info from the semantic map
-semantic_map_path = dm.require(semantic_map_key)
-proto_API = MapAPI(semantic_map_path, world_to_ecef)
-
-if os.path.exists("input/lanes_crosswalks.pkl"):
-    with open("input/lanes_crosswalks.pkl", "rb") as f:
-        lanes_crosswalks = pickle.load(f)
-else:
-    lanes_crosswalks = precompute_map_elements(proto_API)
-    with open("input/lanes_crosswalks.pkl", "wb") as f:
-        pickle.dump(lanes_crosswalks, f)
-
-
-def get_lanes_dict_and_id_mapping(filter_function: Callable):
-    lanes = dict()
-    lanes_indices = [
-        idx
-        for idx, lane_id in enumerate(lanes_crosswalks["lanes"]["ids"])
-        if filter_function(lane_id)
-    ]
-
-    for key, values in lanes_crosswalks["lanes"].items():
-        if len(lanes_crosswalks["lanes"]["ids"]) == len(values):
-            lanes[key] = (
-                values[lanes_indices]
-                if isinstance(values, (np.ndarray, np.generic))
-                else [values[i] for i in lanes_indices]
-            )
-
-    lane_id_2_idx = {lane_id: i for i, lane_id in enumerate(lanes["ids"])}
-    return lanes, lane_id_2_idx
-
-
-lanes_not_bike, lane_id_2_idx_not_bike = get_lanes_dict_and_id_mapping(
-    filter_function=lambda x: not proto_API.is_bike_only_lane(x)
+# all structures derived from the semantic map are compiled once into a single memory-mappable file
+COMPILED_MAP_PATH = "input/compiled_map.bin"
+# whether the lane speed limits are taken from the map, the trained models were trained with
+# the max speed limit for all lanes (the former map lookup never matched a lane), part of the compiled map key
+LANE_SPEED_LIMITS_FROM_MAP = False
+# code version, part of the cache keys: to be increased whenever the compiled structures or the code deriving them change
+COMPILED_MAP_VERSION = 10
+# processes for the lane geometry processing when compiling the map (the result doesn't depend on it)
+MAP_COMPILE_N_JOBS = os.cpu_count()
+# balanced k-d partition of the lane points, the kd trees of its leaves scope the lane matching
+MAP_PARTITION_MAX_LEAF_POINTS = 8192
+# the leaf kd trees contain the lanes within the margin of the leaf cell,
+# the matching falls back to the full kd trees for agents with the k-th nearest candidate beyond the margin
+# (minus max_dist_m), so that it is the same as with the full kd trees
+MAP_PARTITION_MARGIN_M = 30.0
+# per master intersection kd trees of the intersection lanes within the margin of the intersection bounding box,
+# the ego-anchored matching falls back to the kd trees of all intersections for agents with the k-th nearest candidate
+# beyond the margin (minus max_dist_m)
+MASTER_INTERSECTION_INDEX_MARGIN_M = 30.0
+# lanes with center line points closer than the distance are neighbours in the precomputed lane proximity matrix,
+# see get_lane_neighbours_based_on_dist
+LANE_PROXIMITY_DIST_M = 10.0
+# lane points per batch of the ball queries building the lane proximity matrix (bounds the memory of the hits)
+LANE_PROXIMITY_CHUNK_POINTS = 4096
+# max number of forward steps (+1) from a predecessor lane, see is_predecessor
+IS_PREDECESSOR_MAX_DEPTH = 15
+# optional uniform grid of the lane point candidates for the batch lane matching (built on the first use)
+LANE_GRID_CELL_SIZE_M = 2.0
+# default max_dist_m + blocked_dist_threshold_m of the lane matching, larger matching radii use the kd trees
+LANE_GRID_RADIUS_M = 5.5
+# whether the agents lanes tracked over frames are replaced by the full lane search results, see TrackLaneMatcher
+# (strict: the find_closest_lanes features of the trained models, the tracked lanes are looked up for the validation
+# sample only; non-strict is opt-in, the tracked lanes then replace the lane search of most agents)
+TRACK_LANE_MATCHING_STRICT = True
+# share of the tracked lanes recomputed with the full lane search to count the mismatches (0: no validation)
+TRACK_LANE_MATCHING_VALIDATION_RATE = 0.01
+# matching radius of the tracked lanes (the default max_dist_m of find_closest_lanes), the agents farther from
+# the tracked lanes fall through to the full lane search: with the 100 m search of agent_lanes_matcher, the agents
+# farther than 4 m from any lane are always tracking misses (a larger radius would keep them on the lanes they left)
+TRACK_LANE_MATCHING_MAX_DIST_M = 4.0
+# memo of the ego lane matching keyed by the quantized location and yaw, see LaneMatchCache (0: disabled)
+LANE_MATCH_CACHE_SIZE = 0
+LANE_MATCH_CACHE_POSITION_STEP_M = 0.1
+LANE_MATCH_CACHE_YAW_STEP_RAD = 0.01
+# share of the cache hits recomputed to count the disagreements with the exact lane matching
+LANE_MATCH_CACHE_VALIDATION_RATE = 0.0
+# same as LocalDataManager.require(semantic_map_key), without importing l5kit
+SEMANTIC_MAP_PATH = os.path.join(
+    os.environ["L5KIT_DATA_FOLDER"], "semantic_map/semantic_map.pb"
 )
-lanes_bike, lane_id_2_idx_bike = get_lanes_dict_and_id_mapping(
-    filter_function=lambda x: proto_API.is_bike_only_lane(x)
-)
-lane_id_2_idx = {
-    lane_id: i for i, lane_id in enumerate(lanes_crosswalks["lanes"]["ids"])
-}
+TL_FACES_DATASET_PATH = "scenes/train_full_filtered_min_frame_history_4_min_frame_future_1_with_mask_idx.zarr"
+MAP_SEGMENTS_FILE_NAMES = [
+    "map_segment_2_lanes.pkl",
+    "interval_2_segments_x.pkl",
+    "interval_2_segments_y.pkl",
+    "segment_x_coords_only.pkl",
+    "segment_y_coords_only.pkl",
+]
 
-(
-    lane_adj_list_forward_bike,
-    lane_adj_list_backward_bike,
-    lane_adj_list_right_bike,
-    lane_adj_list_left_bike,
-) = precompute_lane_adjacencies(lane_id_2_idx_bike, proto_API)
-(
-    lane_adj_list_forward_not_bike,
-    lane_adj_list_backward_not_bike,
-    lane_adj_list_right_not_bike,
-    lane_adj_list_left_not_bike,
-) = precompute_lane_adjacencies(lane_id_2_idx_not_bike, proto_API)
+logger = logging.getLogger(__name__)
 
+# MANUAL SEM MAP FIXES ###############
 # right turn under red fixes (initially assumed additional green arrow face)
 # example: parent m+dt,
 #     leave tl control connection to li+4 (if more, the first one must be the closest to the turn lane);
@@ -126,9 +154,106 @@ turn_under_red_fixes = [
     ["b75w", ["SYA4"], "4gKt", ["Q20G"]],
 ]
 
-fix_i_2_junction_bro = dict()
-red_turn_lane_2_yield_lanes = dict()
-added_lanes = set()
+added_lanes_tl_coord_tl_id = [
+    [["Myw0"], (684, -407)],
+    [["YCLp", "H1RI"], (630, -2242)],
+    [["m1RI"], (630, -2242)],
+    [["ii1t"], (634, -2268)],
+    [["TnVm", "urF8", "PrF8"], (635, -1355)],
+    [["wqF8"], (636, -1358)],
+    [["T1zT", "udk+", "Pdk+"], (672, -1342)],
+    [["wck+"], (667, -1339)],
+    [["wmAx", "RRp7"], (465, -160)],
+    [["CPtm"], (439, -190)],
+    [["8OiE", "FHu2"], (249, 82)],
+    [["6PiE"], (213, 56)],
+    [["WlSE", "pXNd", "YkSE"], (202, 63)],
+    [["RLKQ"], (-35, 350)],
+    [["jUyh", "CVyh"], (-758, 1127)],
+    [["57g+"], (-733, 1125)],
+    [["W9g+", "38g+", "Y8g+"], (-735, 1122)],
+    [["mzvz"], (-491, 896)],
+    [["F0vz", "k0vz"], (-488, 894)],
+    [["90Lv"], (-527, 874)],
+    [["e0Lv", "/zLv"], (-530, 876)],
+    [["T3uS", "y3uS"], (-973.5, 1360)],
+    [["RJu6"], (-974, 1359)],
+    [["8V6+"], (-950, 1440)],
+    [["LXvy"], (-510, 875)],
+    [["YVHi"], (-516, 901)],
+    [["9ie8"], (741, -463)],
+]
+
+lane_ids_with_wrong_tl_associations = {
+    "i2bp",
+    "AxmM",
+    "LXvy",
+    "YVHi",
+    "8V6+",
+    "Bm9O",
+    "9ie8",
+}
+
+checked_hard_cases = {("csUz", 2), ("RmBi", 7), ("RmBi", 6)}
+
+# only lane controlled by traffic light and its predecessor(s) [at least min_required_len_before_tl center line points in total]
+min_required_len_before_tl = 30
+min_yield_points = 10
+
+
+# CACHE KEYS ###############
+def get_source_file_hash(path: str):
+    # None for a missing source file, the compiled map is then used as it is (e.g. with the artifact only)
+    return get_file_hash(path) if os.path.exists(path) else None
+
+
+semantic_map_hash = get_source_file_hash(SEMANTIC_MAP_PATH)
+map_fixes_hash = get_object_hash(
+    [
+        turn_under_red_fixes,
+        added_lanes_tl_coord_tl_id,
+        sorted(lane_ids_with_wrong_tl_associations),
+        sorted(checked_hard_cases),
+    ]
+)
+# the zarr array metadata (incl. shape) of the tl faces the traffic light ids are collected from
+tl_faces_dataset_hash = get_source_file_hash(
+    os.path.join(
+        os.environ["L5KIT_DATA_FOLDER"], TL_FACES_DATASET_PATH, "tl_faces", ".zarray"
+    )
+)
+lanes_crosswalks_key = get_cache_key(semantic_map_hash, COMPILED_MAP_VERSION)
+traffic_light_ids_key = get_cache_key(tl_faces_dataset_hash, COMPILED_MAP_VERSION)
+tl_signals_key = get_cache_key(
+    semantic_map_hash, map_fixes_hash, tl_faces_dataset_hash, COMPILED_MAP_VERSION
+)
+if semantic_map_hash is not None and tl_faces_dataset_hash is not None:
+    compiled_map_key = get_cache_key(
+        semantic_map_hash,
+        map_fixes_hash,
+        tl_faces_dataset_hash,
+        LANE_SPEED_LIMITS_FROM_MAP,
+        COMPILED_MAP_VERSION,
+    )
+elif os.path.exists(COMPILED_MAP_PATH):
+    compiled_map_key = read_map_artifact_header(COMPILED_MAP_PATH)[0]["key"]
+else:
+    raise FileNotFoundError(
+        f"Neither the compiled map {COMPILED_MAP_PATH} nor its sources "
+        f"({SEMANTIC_MAP_PATH}, {TL_FACES_DATASET_PATH}) were found"
+    )
+
+
+def get_lane_indices_and_id_mapping(filter_function: Callable):
+    lane_indices = [
+        idx
+        for idx, lane_id in enumerate(lanes_crosswalks["lanes"]["ids"])
+        if filter_function(lane_id)
+    ]
+    lane_id_2_idx = {
+        lanes_crosswalks["lanes"]["ids"][idx]: i for i, idx in enumerate(lane_indices)
+    }
+    return np.array(lane_indices, dtype=np.int64), lane_id_2_idx
 
 
 def get_helping_angle(vector_1: np.ndarray):
@@ -164,376 +289,341 @@ def get_connecting_coordinates(
     return np.vstack(all_coords)
 
 
-lane_id_2_idx_specialized = [lane_id_2_idx_bike, lane_id_2_idx_not_bike]
-lane_adj_list_forward_specialized = [
-    lane_adj_list_forward_bike,
-    lane_adj_list_forward_not_bike,
-]
-lane_adj_list_backward_specialized = [
-    lane_adj_list_backward_bike,
-    lane_adj_list_backward_not_bike,
-]
-lane_adj_list_left_specialized = [lane_adj_list_left_bike, lane_adj_list_left_not_bike]
-lane_adj_list_right_specialized = [
-    lane_adj_list_right_bike,
-    lane_adj_list_right_not_bike,
-]
-lanes_specialized = [lanes_bike, lanes_not_bike]
-lanes_under_red_turn_fix = [
-    lane_under_red_turn_fix for lane_under_red_turn_fix, _, _, _ in turn_under_red_fixes
-]
+def concatenate_lines(lines: List[np.ndarray]):
+    offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+    np.cumsum([len(line) for line in lines], out=offsets[1:])
+    return np.concatenate(lines, axis=0), offsets
+
+
+def get_lane_segment_headings(points: np.ndarray, offsets: np.ndarray):
+    """
+    Per point of the concatenated lines: (dx, dy, length) of the segment to the next point of the same line,
+    nan for the last point of each line (the segment from the previous point is in the row of the previous point).
+    """
+    headings = np.full((len(points), 3), np.nan)
+    headings[:-1, :2] = points[1:] - points[:-1]
+    headings[:-1, 2] = np.hypot(headings[:-1, 0], headings[:-1, 1])
+    headings[offsets[1:] - 1] = np.nan
+    return headings
+
+
+def get_lane_point_yaws(lane_indices: np.ndarray, point_indices: np.ndarray):
+    """
+    Lane directions at the center line points: the mean of the angles (see get_helping_angle) of the segments
+    from the previous point and to the next point, across the border of the 1st and 4th quadrants.
+    """
+    lane_starts = lanes_center_line_offsets[lane_indices]
+    lane_lens = lanes_center_line_offsets[lane_indices + 1] - lane_starts
+    point_positions = lane_starts + point_indices
+    has_prev = point_indices > 0
+    has_next = point_indices + 1 < lane_lens
+
+    def get_segment_angles(start_positions: np.ndarray, end_positions: np.ndarray):
+        vectors = (
+            lanes_center_line_points[end_positions]
+            - lanes_center_line_points[start_positions]
+        )
+        # the norms with the rounding of np.linalg.norm of the single vectors
+        norms = np.sqrt(
+            np.matmul(vectors[:, np.newaxis, :], vectors[:, :, np.newaxis])[:, 0, 0]
+        )
+        angles = np.arccos(vectors[:, 0] / norms)
+        return np.where(vectors[:, 1] < 0, 2 * np.pi - angles, angles)
 
-for fix_i, turn_under_red_fix in enumerate(turn_under_red_fixes):
-    parent, lanes_active, lane_to_remove, turn_yield_lanes = turn_under_red_fix
-    lane_spec = int(parent in lane_id_2_idx_not_bike)
-    lane_id_2_idx_specialized[lane_spec][f"lane{2 * fix_i}"] = len(
-        lane_adj_list_forward_specialized[lane_spec]
+    prev_angles = get_segment_angles(
+        np.maximum(point_positions - 1, 0), point_positions
     )
-    lane_adj_list_forward_specialized[lane_spec].append([lane_to_remove])
-    lane_adj_list_backward_specialized[lane_spec].append([parent])
-    lane_adj_list_left_specialized[lane_spec].append([])
-    lane_adj_list_right_specialized[lane_spec].append([])
-
-    lane_id_2_idx_specialized[lane_spec][f"lane{2 * fix_i + 1}"] = len(
-        lane_adj_list_forward_specialized[lane_spec]
+    next_angles = get_segment_angles(
+        point_positions,
+        np.minimum(point_positions + 1, len(lanes_center_line_points) - 1),
     )
-    lane_adj_list_forward_specialized[lane_spec].append(lanes_active)
-    lane_adj_list_backward_specialized[lane_spec].append([parent])
-    lane_adj_list_left_specialized[lane_spec].append([])
-    lane_adj_list_right_specialized[lane_spec].append([])
-
-    lane_adj_list_forward_specialized[lane_spec][
-        lane_id_2_idx_specialized[lane_spec][parent]
-    ] = [f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"]
+    has_both = has_prev & has_next
+    low_angles = np.where(
+        has_both,
+        np.minimum(prev_angles, next_angles),
+        np.where(has_prev, prev_angles, next_angles),
+    )
+    high_angles = np.where(has_both, np.maximum(prev_angles, next_angles), low_angles)
+    high_angles = np.where(
+        has_both & (low_angles < np.pi / 2) & (high_angles > 3 * np.pi / 2),
+        high_angles - 2 * np.pi,
+        high_angles,
+    )
+    return np.where(has_prev | has_next, (low_angles + high_angles) / 2, np.nan)
 
-    for lane_id_left in lanes_active:
-        lane_adj_list_backward_specialized[lane_spec][
-            lane_id_2_idx_specialized[lane_spec][lane_id_left]
-        ] = [f"lane{2 * fix_i + 1}"] + [
-            x
-            for x in lane_adj_list_backward_specialized[lane_spec][
-                lane_id_2_idx_specialized[lane_spec][lane_id_left]
-            ]
-            if x != parent
-        ]
-    lane_adj_list_backward_specialized[lane_spec][
-        lane_id_2_idx_specialized[lane_spec][lane_to_remove]
-    ] = [f"lane{2 * fix_i}"] + [
-        x
-        for x in lane_adj_list_backward_specialized[lane_spec][
-            lane_id_2_idx_specialized[lane_spec][lane_to_remove]
-        ]
-        if x != parent
-    ]
 
-    if (
-        len(
-            lanes_specialized[lane_spec]["center_line"][
-                lane_id_2_idx_specialized[lane_spec][lane_to_remove]
-            ]
-        )
-        < 4
-    ):
-        raise AssertionError
-    if (
-        len(
-            lanes_specialized[lane_spec]["center_line"][
-                lane_id_2_idx_specialized[lane_spec][lanes_active[0]]
-            ]
-        )
-        < 5
+def get_kd_scope(lane_indices: np.ndarray, lane_kd_flags: np.ndarray = None):
+    # center line points of the lanes gathered from the concatenated store, in the order of lane_indices,
+    # with the class flags (KD_FLAG_*) of their lanes if given
+    starts = lanes_center_line_offsets[lane_indices]
+    counts = lanes_center_line_offsets[lane_indices + 1] - starts
+    point_indices = np.arange(counts.sum()) - np.repeat(
+        np.cumsum(counts) - counts, counts
+    )
+    kd_scope = {
+        "points": lanes_center_line_points[np.repeat(starts, counts) + point_indices],
+        "lane_idx": np.repeat(lane_indices, counts).astype(np.int32),
+        "point_idx": point_indices.astype(np.int32),
+    }
+    if lane_kd_flags is not None:
+        kd_scope["class_flags"] = np.repeat(lane_kd_flags, counts).astype(np.uint8)
+    return kd_scope
+
+
+class KDIndexMap:
+    """
+    Maps a kd tree point index to the (lane_id, lane point index) tuple,
+    the tuples are created on access only (instead of storing a list of all of them).
+    """
+
+    def __init__(
+        self,
+        lane_ids: List[str],
+        kd_lane_idx: np.ndarray,
+        kd_point_idx: np.ndarray,
+        point_mask: np.ndarray = None,
     ):
-        raise AssertionError
-
-    lanes_specialized[lane_spec]["ids"].extend(
-        [f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"]
-    )
-    lanes_crosswalks["lanes"]["ids"].extend(
-        [f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"]
-    )
-    added_lanes.update({f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"})
-
-    # last 3 points of parent to be forked
-    parent_center_line = lanes_crosswalks["lanes"]["center_line"][lane_id_2_idx[parent]]
-    init_parent_last_coord = parent_center_line[-1].copy()
-    lanes_specialized[lane_spec]["center_line"][
-        lane_id_2_idx_specialized[lane_spec][parent]
-    ] = parent_center_line[: max(1, len(parent_center_line) - 3)]
-    lanes_crosswalks["lanes"]["center_line"][
-        lane_id_2_idx[parent]
-    ] = parent_center_line[: max(1, len(parent_center_line) - 3)]
-    new_parent_last_coord = lanes_specialized[lane_spec]["center_line"][
-        lane_id_2_idx_specialized[lane_spec][parent]
-    ][-1].copy()
-    total_parent_segment_len = np.hypot(
-        new_parent_last_coord[0] - init_parent_last_coord[0],
-        new_parent_last_coord[1] - init_parent_last_coord[1],
-    )
-    # the turn lane to remove
-    directional_point_for_fork = lanes_specialized[lane_spec]["center_line"][
-        lane_id_2_idx_specialized[lane_spec][lane_to_remove]
-    ][3]
-    turn_fork_center_line = get_connecting_coordinates(
-        new_parent_last_coord,
-        directional_point_for_fork,
-        total_dist=total_parent_segment_len,
-    )
-
-    lanes_specialized[lane_spec]["center_line"].append(turn_fork_center_line)
-    lanes_crosswalks["lanes"]["center_line"].append(turn_fork_center_line)
-    # dummy boarder in order not to break vis
-    lanes_specialized[lane_spec]["xy_left_"].append(turn_fork_center_line)
-    lanes_specialized[lane_spec]["xy_right_"].append(turn_fork_center_line)
-    # shouldn't be used from lanes_crosswalks['lanes']
-
-    # the first lane to leave tl control must be the closest one to the turn-lane
-    directional_point_for_fork = lanes_specialized[lane_spec]["center_line"][
-        lane_id_2_idx_specialized[lane_spec][lanes_active[0]]
-    ][4]
-    new_parent_last_coord = lanes_specialized[lane_spec]["center_line"][
-        lane_id_2_idx_specialized[lane_spec][parent]
-    ][-1].copy()
-    straight_center_line = get_connecting_coordinates(
-        new_parent_last_coord,
-        directional_point_for_fork,
-        total_dist=total_parent_segment_len,
-    )
-
-    lanes_specialized[lane_spec]["center_line"].append(straight_center_line)
-    lanes_crosswalks["lanes"]["center_line"].append(straight_center_line)
-    # dummy boarder in order not to break vis
-    lanes_specialized[lane_spec]["xy_left_"].append(straight_center_line)
-    lanes_specialized[lane_spec]["xy_right_"].append(straight_center_line)
-
-    fix_i_2_junction_bro[fix_i] = parent
-    # TODO!: each red_turn_lane has virtual "stop-sign" when the light is red
-    red_turn_lane_2_yield_lanes[f"lane{2 * fix_i}"] = turn_yield_lanes
-
-
-def get_kd_tree_and_idx_map(lanes: Dict):
-    kd_tree = KDTree(np.concatenate(lanes["center_line"], axis=0))
-    kd_idx_2_lane_id_idx = []
-    for lane_id, center_line in zip(lanes["ids"], lanes["center_line"]):
-        next_entries = [(lane_id, i) for i in range(len(center_line))]
-        kd_idx_2_lane_id_idx.extend(next_entries)
+        self.lane_ids = lane_ids
+        self.kd_lane_idx = kd_lane_idx
+        self.kd_point_idx = kd_point_idx
+        # the kd points queried through the map (see MaskedKDTree), all of them if None
+        self.point_mask = point_mask
+        self._lane_mask = None
+
+    def __len__(self):
+        return len(self.kd_lane_idx)
+
+    def __getitem__(self, kd_idx: int):
+        return self.lane_ids[self.kd_lane_idx[kd_idx]], int(self.kd_point_idx[kd_idx])
+
+    def decode(self, kd_indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns:
+            lane indices (in lane_ids) and lane point indices of the kd tree points, in the shape of kd_indices
+        """
+        return self.kd_lane_idx[kd_indices], self.kd_point_idx[kd_indices]
+
+    def get_lane_mask(self) -> np.ndarray:
+        # lanes present in the kd tree, as a bool mask over lane_ids
+        if self._lane_mask is None:
+            self._lane_mask = np.zeros(len(self.lane_ids), dtype=bool)
+            if self.point_mask is None:
+                self._lane_mask[self.kd_lane_idx] = True
+            else:
+                self._lane_mask[self.kd_lane_idx[self.point_mask]] = True
+        return self._lane_mask
+
+
+class MaskedKDTree:
+    """
+    kd tree restricted to the points of point_mask, e.g. to the lanes of an agent class in a kd scope of all classes.
+    Queries return the k nearest masked points (with their indices in the full kd tree),
+    the same as the query of a kd tree built from the masked points only.
+    """
+
+    def __init__(self, kd_tree: cKDTree, point_mask: np.ndarray):
+        self.kd_tree = kd_tree
+        self.point_mask = point_mask
+        self.n = int(point_mask.sum())
+
+    def query(self, x: np.ndarray, k: int):
+        x = np.asarray(x)
+        n_all = self.kd_tree.n
+        # the masked points are expected in proportion to their share, the query is repeated with doubled k if not
+        # (k_query doesn't exceed the number of points, so cKDTree returns no padding)
+        k_query = min(k * int(np.ceil(n_all / max(self.n, 1))), n_all)
+        if x.ndim == 1:
+            return self._query_one(x, k, k_query)
+        # missing points are padded as by cKDTree
+        distances = np.full((len(x), k), np.inf)
+        indices = np.full((len(x), k), n_all, dtype=np.int64)
+        pending = np.arange(len(x))
+        while len(pending):
+            all_distances, all_indices = self.kd_tree.query(x[pending], k=k_query)
+            all_distances = all_distances.reshape(len(pending), -1)
+            all_indices = all_indices.reshape(len(pending), -1)
+            is_masked = self.point_mask[all_indices]
+            is_done = (is_masked.sum(axis=1) >= min(k, self.n)) | (k_query >= n_all)
+            # the first k masked points of the done queries, in the distance order
+            positions = np.argsort(~is_masked[is_done], axis=1, kind="stable")[:, :k]
+            is_found = np.take_along_axis(is_masked[is_done], positions, axis=1)
+            done_rows = pending[is_done]
+            distances[done_rows, : positions.shape[1]] = np.where(
+                is_found,
+                np.take_along_axis(all_distances[is_done], positions, axis=1),
+                np.inf,
+            )
+            indices[done_rows, : positions.shape[1]] = np.where(
+                is_found,
+                np.take_along_axis(all_indices[is_done], positions, axis=1),
+                n_all,
+            )
+            pending = pending[~is_done]
+            k_query = min(2 * k_query, n_all)
+        if k == 1:
+            return distances[:, 0], indices[:, 0]
+        return distances, indices
+
+    def _query_one(self, coord: np.ndarray, k: int, k_query: int):
+        n_all = self.kd_tree.n
+        while True:
+            all_distances, all_indices = self.kd_tree.query(coord, k=k_query)
+            all_distances = np.atleast_1d(all_distances)
+            all_indices = np.atleast_1d(all_indices)
+            found_positions = np.flatnonzero(self.point_mask[all_indices])[:k]
+            if len(found_positions) >= min(k, self.n) or k_query >= n_all:
+                break
+            k_query = min(2 * k_query, n_all)
+        distances = np.full(k, np.inf)
+        indices = np.full(k, n_all, dtype=np.int64)
+        distances[: len(found_positions)] = all_distances[found_positions]
+        indices[: len(found_positions)] = all_indices[found_positions]
+        if k == 1:
+            return distances[0], indices[0]
+        return distances, indices
+
+
+def get_kd_tree_and_idx_map(kd_scope: Dict):
+    if kd_scope is None:
+        return None, None
+    # the scope points might be memory-mapped from the compiled map, no copy is needed
+    kd_tree = cKDTree(kd_scope["points"], copy_data=False)
+    kd_idx_2_lane_id_idx = KDIndexMap(
+        lane_ids_all, kd_scope["lane_idx"], kd_scope["point_idx"]
+    )
     return kd_tree, kd_idx_2_lane_id_idx
 
 
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "map_segment_2_lanes.pkl"), "rb") as f:
-    map_segment_2_lanes = pickle.load(f)
-
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "interval_2_segments_x.pkl"), "rb") as f:
-    interval_2_map_segments_x = pickle.load(f)
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "interval_2_segments_y.pkl"), "rb") as f:
-    interval_2_map_segments_y = pickle.load(f)
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "segment_x_coords_only.pkl"), "rb") as f:
-    map_segment_x_coords_only = pickle.load(f)
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "segment_y_coords_only.pkl"), "rb") as f:
-    map_segment_y_coords_only = pickle.load(f)
+def get_class_kd_trees_and_idx_maps(kd_scope: Dict):
+    """
+    A single kd tree of the scope shared by the agent classes, the class points are selected by the class flags.
+
+    Returns:
+        per agent class, the kd tree and its index map ((None, None) if the scope has no points of the class)
+    """
+    kd_tree_, kd_idx_map_ = get_kd_tree_and_idx_map(kd_scope)
+    class_kd_trees_and_idx_maps = {ALL_WHEELS_CLASS: (kd_tree_, kd_idx_map_)}
+    for agent_class, kd_flag in [
+        (BIKE_CLASS, KD_FLAG_BIKE),
+        (CAR_CLASS, KD_FLAG_NOT_BIKE),
+    ]:
+        if kd_scope is None:
+            class_kd_trees_and_idx_maps[agent_class] = None, None
+            continue
+        point_mask = (kd_scope["class_flags"] & kd_flag) > 0
+        if np.all(point_mask):
+            class_kd_trees_and_idx_maps[agent_class] = kd_tree_, kd_idx_map_
+        elif np.any(point_mask):
+            class_kd_trees_and_idx_maps[agent_class] = (
+                MaskedKDTree(kd_tree_, point_mask),
+                KDIndexMap(
+                    lane_ids_all,
+                    kd_scope["lane_idx"],
+                    kd_scope["point_idx"],
+                    point_mask,
+                ),
+            )
+        else:
+            class_kd_trees_and_idx_maps[agent_class] = None, None
+    return class_kd_trees_and_idx_maps
+
+
+def get_map_partition_kd_scopes(partition: MapPartition, is_bike: np.ndarray):
+    # per leaf of the partition, the kd scope of its lanes (the non-empty leaves only)
+    leaf_kd_scopes = dict()
+    for leaf_idx in range(partition.n_leaves):
+        leaf_lane_indices = partition.get_leaf_lane_indices(leaf_idx).astype(np.int64)
+        if len(leaf_lane_indices):
+            leaf_kd_scopes[f"leaf_{leaf_idx}"] = get_kd_scope(
+                leaf_lane_indices,
+                np.where(is_bike[leaf_lane_indices], KD_FLAG_BIKE, KD_FLAG_NOT_BIKE),
+            )
+    return leaf_kd_scopes
 
-kd_tree_bike, kd_idx_2_lane_id_idx_bike = get_kd_tree_and_idx_map(lanes_bike)
-kd_tree_not_bike, kd_idx_2_lane_id_idx_not_bike = get_kd_tree_and_idx_map(
-    lanes_not_bike
-)
-kd_tree, kd_idx_2_lane_id_idx = get_kd_tree_and_idx_map(lanes_crosswalks["lanes"])
-
-# SEPARATELY PER EACH MAP SEGMENT ################
-n_map_segments = len(map_segment_2_lanes)
-map_segment_2_kd_tree_bike, map_segment_2_kd_idx_2_lane_id_idx_bike = [
-    None for _ in range(n_map_segments)
-], [None for _ in range(n_map_segments)]
-map_segment_2_kd_tree_not_bike, map_segment_2_kd_idx_2_lane_id_idx_not_bike = [
-    None for _ in range(n_map_segments)
-], [None for _ in range(n_map_segments)]
-map_segment_2_kd_tree, map_segment_2_kd_idx_2_lane_id_idx = [
-    None for _ in range(n_map_segments)
-], [None for _ in range(n_map_segments)]
-lane_ids_bike_only = lane_id_2_idx_specialized[0].keys()
-for map_segment_idx, segment_lanes in enumerate(map_segment_2_lanes):
-    segment_lanes_not_bike_dict, _ = get_lanes_dict_and_id_mapping(
-        filter_function=lambda x: x in segment_lanes and x not in lane_ids_bike_only
-    )
-    segment_lanes_bike_dict, _ = get_lanes_dict_and_id_mapping(
-        filter_function=lambda x: x in segment_lanes and x in lane_ids_bike_only
-    )
-    segment_lanes_dict, _ = get_lanes_dict_and_id_mapping(
-        filter_function=lambda x: x in segment_lanes
-    )
-    if len(segment_lanes_bike_dict["ids"]):
-        kd_tree_, idx_map_ = get_kd_tree_and_idx_map(segment_lanes_bike_dict)
-        map_segment_2_kd_tree_bike[map_segment_idx] = kd_tree_
-        map_segment_2_kd_idx_2_lane_id_idx_bike[map_segment_idx] = idx_map_
-    if len(segment_lanes_not_bike_dict["ids"]):
-        kd_tree_, idx_map_ = get_kd_tree_and_idx_map(segment_lanes_not_bike_dict)
-        map_segment_2_kd_tree_not_bike[map_segment_idx] = kd_tree_
-        map_segment_2_kd_idx_2_lane_id_idx_not_bike[map_segment_idx] = idx_map_
-    if len(segment_lanes_dict["ids"]):
-        kd_tree_, idx_map_ = get_kd_tree_and_idx_map(segment_lanes_dict)
-        map_segment_2_kd_tree[map_segment_idx] = kd_tree_
-        map_segment_2_kd_idx_2_lane_id_idx[map_segment_idx] = idx_map_
-
-tl_control_2_junctions = defaultdict(list)
-junction_2_tl_controls = defaultdict(list)
-lane_2_junctions = defaultdict(list)
-junction_2_lanes = defaultdict(list)
-for element in proto_API:
-    if MapAPI.is_junction(element):
-        junction_element_id = MapAPI.id_as_str(element.id)
-        traffic_control_elements = proto_API.get_traffic_control_elements_at_junction(
-            junction_element_id
-        )
-        junction_2_tl_controls[junction_element_id].extend(traffic_control_elements)
-        for tl_control in traffic_control_elements:
-            tl_control_2_junctions[tl_control].append(junction_element_id)
 
-        lanes_related_to_junction = proto_API.get_all_lanes_at_junction(
-            junction_element_id
-        )
-        for lane in lanes_related_to_junction:
-            junction_2_lanes[junction_element_id].append(lane)
-            lane_2_junctions[lane].append(junction_element_id)
-# to address potential duplications
-for lane_id, junctions in lane_2_junctions.items():
-    lane_2_junctions[lane_id] = list(set(junctions))
-for junction_id, lanes in junction_2_lanes.items():
-    junction_2_lanes[junction_id] = list(set(lanes))
-
-for fix_i in range(len(turn_under_red_fixes)):
-    junction_neighb = fix_i_2_junction_bro[fix_i]
-    lane_2_junctions[f"lane{2 * fix_i}"] = lane_2_junctions[junction_neighb].copy()
-    lane_2_junctions[f"lane{2 * fix_i + 1}"] = lane_2_junctions[junction_neighb].copy()
-    for junction_id in lane_2_junctions[junction_neighb]:
-        junction_2_lanes[junction_id].extend(
-            [f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"]
-        )
+def get_map_partition_kd_trees_and_idx_maps(kd_scopes: Dict, n_leaves: int):
+    # per leaf, see get_class_kd_trees_and_idx_maps
+    return [
+        get_class_kd_trees_and_idx_maps(kd_scopes.get(f"leaf_{leaf_idx}"))
+        for leaf_idx in range(n_leaves)
+    ]
 
-if os.path.exists("../traffic_light_ids_all.pkl"):
-    with open("../traffic_light_ids_all.pkl", "rb") as f:
-        traffic_light_ids_all = pickle.load(f)
-else:
-    dataset_path = "scenes/train_full_filtered_min_frame_history_4_min_frame_future_1_with_mask_idx.zarr"
-    train_full_zarr = ChunkedDataset(dm.require(dataset_path)).open()
-    traffic_light_ids_all = set(train_full_zarr.tl_faces["traffic_light_id"])
-    with open("../traffic_light_ids_all.pkl", "wb") as f:
-        pickle.dump(traffic_light_ids_all, f)
-
-if os.path.exists("../traffic_faces_ids_all.pkl"):
-    with open("../traffic_faces_ids_all.pkl", "rb") as f:
-        traffic_faces_ids_all = pickle.load(f)
-else:
-    dataset_path = "scenes/train_full_filtered_min_frame_history_4_min_frame_future_1_with_mask_idx.zarr"
-    train_full_zarr = ChunkedDataset(dm.require(dataset_path)).open()
-    traffic_faces_ids_all = set(train_full_zarr.tl_faces["face_id"])
-    with open("../traffic_faces_ids_all.pkl", "wb") as f:
-        pickle.dump(traffic_faces_ids_all, f)
-
-traffic_light_id_2_coord = dict()
-tl_ids_without_sem_map_info = []
-for el_id in traffic_light_ids_all:
-    if el_id in proto_API.ids_to_el:
-        coordinates = proto_API.get_traffic_light_coords(el_id)["xyz"]
-        traffic_light_id_2_coord[el_id] = coordinates[:, :2].mean(axis=0)
-    else:
-        tl_ids_without_sem_map_info.append(el_id)
 
-added_lanes_tl_coord_tl_id = [
-    [["Myw0"], (684, -407)],
-    [["YCLp", "H1RI"], (630, -2242)],
-    [["m1RI"], (630, -2242)],
-    [["ii1t"], (634, -2268)],
-    [["TnVm", "urF8", "PrF8"], (635, -1355)],
-    [["wqF8"], (636, -1358)],
-    [["T1zT", "udk+", "Pdk+"], (672, -1342)],
-    [["wck+"], (667, -1339)],
-    [["wmAx", "RRp7"], (465, -160)],
-    [["CPtm"], (439, -190)],
-    [["8OiE", "FHu2"], (249, 82)],
-    [["6PiE"], (213, 56)],
-    [["WlSE", "pXNd", "YkSE"], (202, 63)],
-    [["RLKQ"], (-35, 350)],
-    [["jUyh", "CVyh"], (-758, 1127)],
-    [["57g+"], (-733, 1125)],
-    [["W9g+", "38g+", "Y8g+"], (-735, 1122)],
-    [["mzvz"], (-491, 896)],
-    [["F0vz", "k0vz"], (-488, 894)],
-    [["90Lv"], (-527, 874)],
-    [["e0Lv", "/zLv"], (-530, 876)],
-    [["T3uS", "y3uS"], (-973.5, 1360)],
-    [["RJu6"], (-974, 1359)],
-    [["8V6+"], (-950, 1440)],
-    [["LXvy"], (-510, 875)],
-    [["YVHi"], (-516, 901)],
-    [["9ie8"], (741, -463)],
-]
-for i in range(len(added_lanes_tl_coord_tl_id)):
-    added_tl_id = f"Luda_{i}"
-    added_lanes_tl_coord_tl_id[i].append(added_tl_id)
-    traffic_light_id_2_coord[added_tl_id] = np.array(added_lanes_tl_coord_tl_id[i][1])
-    traffic_light_ids_all.add(added_tl_id)
-    for lane_id in added_lanes_tl_coord_tl_id[i][0]:
-        tl_control_2_junctions[added_tl_id].extend(lane_2_junctions[lane_id])
-        for junction in lane_2_junctions[lane_id]:
-            junction_2_tl_controls[junction].append(added_tl_id)
-
-tl_control_2_close_lanes = defaultdict(list)
-for tl_control, junctions in tl_control_2_junctions.items():
-    if tl_control in traffic_light_ids_all or tl_control in traffic_faces_ids_all:
-        for junction in junctions:
-            tl_control_2_close_lanes[tl_control].extend(junction_2_lanes[junction])
-            # predecessor lanes
-            for junction_lane in junction_2_lanes[junction]:
-                if junction_lane in lane_id_2_idx_bike:
-                    tl_control_2_close_lanes[tl_control].extend(
-                        lane_adj_list_backward_bike[lane_id_2_idx_bike[junction_lane]]
-                    )
-                elif junction_lane in lane_id_2_idx_not_bike:
-                    tl_control_2_close_lanes[tl_control].extend(
-                        lane_adj_list_backward_not_bike[
-                            lane_id_2_idx_not_bike[junction_lane]
-                        ]
-                    )
-        tl_control_2_close_lanes[tl_control] = list(
-            set(tl_control_2_close_lanes[tl_control])
+def query_kd_tree(kd_tree: cKDTree, coord: np.ndarray, k_nearest: int):
+    candidate_distances, candidate_indices = kd_tree.query(coord, k=k_nearest)
+    # equidistant points (e.g. lane end and the next lane start) are ordered by kd index
+    order = np.lexsort((candidate_indices, candidate_distances))
+    return candidate_distances[order], candidate_indices[order]
+
+
+def get_lane_grid_index():
+    global lane_grid_index
+    if lane_grid_index is None:
+        lane_grid_index = LaneGridIndex(
+            load_or_compute(
+                "lane_grid_index",
+                get_cache_key(
+                    compiled_map_key, LANE_GRID_CELL_SIZE_M, LANE_GRID_RADIUS_M
+                ),
+                lambda: LaneGridIndex.from_points(
+                    lanes_center_line_points, LANE_GRID_CELL_SIZE_M, LANE_GRID_RADIUS_M
+                ).to_arrays(),
+            )
         )
-
-lane_2_close_tl_controls = defaultdict(list)
-for tl_control, close_lanes in tl_control_2_close_lanes.items():
-    for lane in close_lanes:
-        lane_2_close_tl_controls[lane].append(tl_control)
-
-lane_2_tl_related_lanes_wip = defaultdict(set)
-for lane_id, close_tl_controls in lane_2_close_tl_controls.items():
-    for traffic_control_id in close_tl_controls:
-        lane_2_tl_related_lanes_wip[lane_id].update(
-            tl_control_2_close_lanes[traffic_control_id]
+    return lane_grid_index
+
+
+def get_grid_candidates(coords: np.ndarray, lane_mask: np.ndarray, k_nearest: int):
+    """
+    Same candidates as the kd tree query restricted to LANE_GRID_RADIUS_M:
+    the k nearest points of the lanes in lane_mask, ordered by distance and then by the point index
+    (all kd scopes list the lanes and their points in the order of the concatenated center lines).
+    The only difference is for equidistant k-th and (k + 1)-th candidates, the kd tree keeps any of them,
+    here the lower point index is kept. Missing candidates are padded with infinite distances.
+    """
+    point_indices, source_positions = get_lane_grid_index().get_candidates(coords)
+    point_lane_indices, point_lane_point_indices = kd_idx_2_lane_id_idx.decode(
+        point_indices
+    )
+    point_diffs = lanes_center_line_points[point_indices] - coords[source_positions]
+    # as computed by cKDTree
+    point_distances = np.sqrt(point_diffs[:, 0] ** 2 + point_diffs[:, 1] ** 2)
+    is_candidate = lane_mask[point_lane_indices] & (
+        point_distances <= LANE_GRID_RADIUS_M
+    )
+    order = np.lexsort(
+        (
+            point_indices[is_candidate],
+            point_distances[is_candidate],
+            source_positions[is_candidate],
         )
-
-lane_ids_with_wrong_tl_associations = {
-    "i2bp",
-    "AxmM",
-    "LXvy",
-    "YVHi",
-    "8V6+",
-    "Bm9O",
-    "9ie8",
-}
-
-tl_added_lane_id_2_tl_id = dict()
-for lanes, _, tl_id in added_lanes_tl_coord_tl_id:
-    for lane_id in lanes:
-        if lane_id in tl_added_lane_id_2_tl_id:
-            raise AssertionError
-        tl_added_lane_id_2_tl_id[lane_id] = tl_id
-        lane_2_close_tl_controls[lane_id].append(tl_id)
+    )
+    source_positions = source_positions[is_candidate][order]
+    ranks = np.arange(len(source_positions)) - np.searchsorted(
+        source_positions, source_positions
+    )
+    is_kept = ranks < k_nearest
+    candidate_distances = np.full((len(coords), k_nearest), np.inf)
+    candidate_lane_indices = np.zeros((len(coords), k_nearest), dtype=np.int64)
+    candidate_point_indices = np.zeros((len(coords), k_nearest), dtype=np.int64)
+    for candidate_values, point_values in [
+        (candidate_distances, point_distances),
+        (candidate_lane_indices, point_lane_indices),
+        (candidate_point_indices, point_lane_point_indices),
+    ]:
+        candidate_values[source_positions[is_kept], ranks[is_kept]] = point_values[
+            is_candidate
+        ][order][is_kept]
+    return candidate_distances, candidate_lane_indices, candidate_point_indices
 
 
 def get_lane_center_line(lane_id: str):
-    if lane_id in lane_id_2_idx_bike:
-        return lanes_bike["center_line"][lane_id_2_idx_bike[lane_id]]
-    if lane_id in lane_id_2_idx_not_bike:
-        return lanes_not_bike["center_line"][lane_id_2_idx_not_bike[lane_id]]
-    else:
+    if lane_id not in lane_id_2_idx_all:
         raise ValueError("Lane neither bike only, nor others")
+    lane_idx = lane_id_2_idx_all[lane_id]
+    return lanes_center_line_points[
+        lanes_center_line_offsets[lane_idx] : lanes_center_line_offsets[lane_idx + 1]
+    ]
 
 
 def get_lane_point_coordinates(lane_id: str, point_idx: int):
@@ -541,55 +631,35 @@ def get_lane_point_coordinates(lane_id: str, point_idx: int):
     return center_line[point_idx]
 
 
-lane_id_2_lane_len = dict()
-for lane_id in list(lane_id_2_idx_bike.keys()) + list(lane_id_2_idx_not_bike.keys()):
-    lane_id_2_lane_len[lane_id] = len(get_lane_center_line(lane_id))
-
-
 def get_lane_len(lane_id):
-    return lane_id_2_lane_len[lane_id]
+    return int(lane_graph.lane_lens[lane_id_2_idx_all[lane_id]])
 
 
-lane_2_direct_tl_lights = defaultdict(set)
-lane_2_direct_tl_faces = defaultdict(set)
-# only lane controlled by traffic light and its predecessor(s) [at least min_required_len_before_tl center line points in total]
-min_required_len_before_tl = 30
+def get_lane_graph_neighbours(lane_id: str, edge_type: str):
+    if lane_id not in lane_id_2_idx_all:
+        return []
+    return [
+        lane_ids_all[lane_idx]
+        for lane_idx in lane_graph.get_neighbours(
+            lane_id_2_idx_all[lane_id], edge_type
+        ).tolist()
+    ]
 
 
 def get_lane_predecessors(lane_id: str):
-    if lane_id in lane_id_2_idx_bike:
-        return lane_adj_list_backward_bike[lane_id_2_idx_bike[lane_id]]
-    elif lane_id in lane_id_2_idx_not_bike:
-        return lane_adj_list_backward_not_bike[lane_id_2_idx_not_bike[lane_id]]
-    else:
-        return []
+    return get_lane_graph_neighbours(lane_id, "backward")
 
 
 def get_lane_successors(lane_id: str):
-    if lane_id in lane_id_2_idx_bike:
-        return lane_adj_list_forward_bike[lane_id_2_idx_bike[lane_id]]
-    elif lane_id in lane_id_2_idx_not_bike:
-        return lane_adj_list_forward_not_bike[lane_id_2_idx_not_bike[lane_id]]
-    else:
-        return []
+    return get_lane_graph_neighbours(lane_id, "forward")
 
 
 def get_lane_left_neighbours(lane_id: str):
-    if lane_id in lane_id_2_idx_bike:
-        return lane_adj_list_left_bike[lane_id_2_idx_bike[lane_id]]
-    elif lane_id in lane_id_2_idx_not_bike:
-        return lane_adj_list_left_not_bike[lane_id_2_idx_not_bike[lane_id]]
-    else:
-        return []
+    return get_lane_graph_neighbours(lane_id, "left")
 
 
 def get_lane_right_neighbours(lane_id: str):
-    if lane_id in lane_id_2_idx_bike:
-        return lane_adj_list_right_bike[lane_id_2_idx_bike[lane_id]]
-    elif lane_id in lane_id_2_idx_not_bike:
-        return lane_adj_list_right_not_bike[lane_id_2_idx_not_bike[lane_id]]
-    else:
-        return []
+    return get_lane_graph_neighbours(lane_id, "right")
 
 
 def get_lane_neighbours_all(lane_id: str):
@@ -601,231 +671,69 @@ def get_lane_neighbours_all(lane_id: str):
     )
 
 
-def get_lane_neighbours_based_on_dist(lane_id: str, dist_max_m: float = 10):
-    neighbour_lanes = set()
-    for lane_point in get_lane_center_line(lane_id):
-        kd_indices = kd_tree.query_ball_point(lane_point, r=dist_max_m)
-        for kd_idx in kd_indices:
-            lane_id_neighb, _ = get_lane_point_from_kdtree(kd_idx, ALL_WHEELS_CLASS)
-            neighbour_lanes.add(lane_id_neighb)
-    return list(neighbour_lanes)
-
-
-for element in proto_API:
-    if proto_API.is_lane(element):
-        lane_id = MapAPI.id_as_str(element.id)
-        if lane_id not in lane_ids_with_wrong_tl_associations:
-            lane_traffic_controls = [
-                MapAPI.id_as_str(x)
-                for x in proto_API.get_lane_traffic_controls(lane_id)
-            ]
-        else:
-            lane_traffic_controls = []
-        lane_traffic_lights = [
-            x for x in lane_traffic_controls if x in traffic_light_ids_all
-        ]
-        lane_traffic_faces = [
-            x for x in lane_traffic_controls if x in traffic_faces_ids_all
-        ]
-        tl_faces_elements = [
-            proto_API[x].element.traffic_control_element for x in lane_traffic_faces
-        ]
-
-        if lane_id in tl_added_lane_id_2_tl_id:
-            lane_traffic_lights.append(tl_added_lane_id_2_tl_id[lane_id])
-            lane_traffic_faces.append(tl_added_lane_id_2_tl_id[lane_id])
-        if len(lane_traffic_lights):
-            dist_from_tl = get_lane_len(lane_id)
-            queue = deque()
-            queue.append((lane_id, dist_from_tl))
-            while len(queue):
-                next_lane, dist_from_tl = queue.popleft()
-                lane_2_direct_tl_lights[next_lane].update(lane_traffic_lights)
-                if dist_from_tl == get_lane_len(
-                    next_lane
-                ):  # don't propagate faces backwards
-                    lane_2_direct_tl_faces[next_lane].update(lane_traffic_faces)
-                if (
-                    dist_from_tl < min_required_len_before_tl
-                    and next_lane not in lanes_under_red_turn_fix
-                ):
-                    lane_predecessors = get_lane_predecessors(next_lane)
-                    for lane_predecessor_id in lane_predecessors:
-                        queue.append(
-                            (
-                                lane_predecessor_id,
-                                dist_from_tl + get_lane_len(lane_predecessor_id),
-                            )
-                        )
-
-# manual sem map fixes
-for fix_i, parent_lane in enumerate(lanes_under_red_turn_fix):
-    lane_2_direct_tl_lights[f"lane{2 * fix_i + 1}"] = lane_2_direct_tl_lights[
-        parent_lane
-    ].copy()
-    lane_2_direct_tl_faces[f"lane{2 * fix_i + 1}"] = lane_2_direct_tl_faces[
-        parent_lane
-    ].copy()
-    del lane_2_direct_tl_lights[parent_lane]
-    del lane_2_direct_tl_faces[parent_lane]
-
-tl_light_2_directly_controlled_lanes = defaultdict(set)
-for lane_id, tl_lights in lane_2_direct_tl_lights.items():
-    for tl_light in tl_lights:
-        tl_light_2_directly_controlled_lanes[tl_light].add(lane_id)
-
-master_intersection_idx_2_traffic_lights = []
-traffic_light_id_2_master_intersection_idx = defaultdict(list)
-
-for tls_united_by_lane in lane_2_close_tl_controls.values():
-    master_intersection_idx = None
-    for tl_id in tls_united_by_lane:
-        if tl_id in traffic_light_id_2_master_intersection_idx:
-            if master_intersection_idx is not None:
-                if (
-                    traffic_light_id_2_master_intersection_idx[tl_id]
-                    != master_intersection_idx
-                ):
-                    raise AssertionError(
-                        f"tl_id: {tl_id}",
-                        f"traffic_light_id_2_master_intersection_idx[tl_id]: {traffic_light_id_2_master_intersection_idx[tl_id]}",
-                        f"master_intersection_idx: {master_intersection_idx}",
-                    )
-            else:
-                master_intersection_idx = traffic_light_id_2_master_intersection_idx[
-                    tl_id
-                ]
-            if (
-                tl_id
-                not in master_intersection_idx_2_traffic_lights[master_intersection_idx]
-            ):
-                raise AssertionError
-        else:
-            if master_intersection_idx is None:
-                master_intersection_idx = len(master_intersection_idx_2_traffic_lights)
-                master_intersection_idx_2_traffic_lights.append(set())
-            traffic_light_id_2_master_intersection_idx[tl_id] = master_intersection_idx
-            master_intersection_idx_2_traffic_lights[master_intersection_idx].add(tl_id)
-
-master_intersection_idx_2_traffic_lights = [
-    set(intersection_tls)
-    for intersection_tls in sorted(
-        [tuple(sorted(list(x))) for x in master_intersection_idx_2_traffic_lights]
-    )
-]
-# splitting the master intersection 1 (there's some long connecting lane likely)
-orig_tl_ids = list(master_intersection_idx_2_traffic_lights[3])
-coordinates_data = np.array([traffic_light_id_2_coord[tl_id] for tl_id in orig_tl_ids])
-kmeans_clusters = KMeans(n_clusters=2, random_state=42).fit(coordinates_data).labels_
-master_intersection_idx_new = len(master_intersection_idx_2_traffic_lights)
-master_intersection_idx_2_traffic_lights.append(set())
-for tl_id, cluster in zip(orig_tl_ids, kmeans_clusters):
-    if cluster == 1:
-        traffic_light_id_2_master_intersection_idx[tl_id] = master_intersection_idx_new
-        master_intersection_idx_2_traffic_lights[master_intersection_idx_new].add(tl_id)
-        master_intersection_idx_2_traffic_lights[3].remove(tl_id)
-
-
-def get_lane_boarders(lane_id: str):
-    if lane_id in lane_id_2_idx_bike:
-        return (
-            lanes_bike["xy_left_"][lane_id_2_idx_bike[lane_id]],
-            lanes_bike["xy_right_"][lane_id_2_idx_bike[lane_id]],
+def get_lane_proximity_csr(
+    kd_tree_: cKDTree, kd_scope: Dict[str, np.ndarray], n_lanes: int, dist_max_m: float
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sparse lane-to-lane proximity matrix: lanes having some center line points within dist_max_m of each other.
+
+    Args:
+        kd_tree_ (cKDTree): kd tree over the points of kd_scope
+        kd_scope (Dict[str, np.ndarray]): lane points of all lanes, see get_kd_scope
+        n_lanes (int): number of lanes (rows of the matrix)
+        dist_max_m (float): max distance between the points of the neighbour lanes
+
+    Returns:
+        CSR offsets and indices of the neighbour lanes (including the lane itself), in increasing lane index order
+    """
+    lane_pair_keys = []
+    for chunk_start in range(0, len(kd_scope["points"]), LANE_PROXIMITY_CHUNK_POINTS):
+        chunk = slice(chunk_start, chunk_start + LANE_PROXIMITY_CHUNK_POINTS)
+        kd_indices_lists = kd_tree_.query_ball_point(
+            kd_scope["points"][chunk], r=dist_max_m
         )
-    elif lane_id in lane_id_2_idx_not_bike:
-        return (
-            lanes_not_bike["xy_left_"][lane_id_2_idx_not_bike[lane_id]],
-            lanes_not_bike["xy_right_"][lane_id_2_idx_not_bike[lane_id]],
+        hits_counts = np.array([len(x) for x in kd_indices_lists], dtype=np.int64)
+        kd_indices = np.fromiter(
+            (kd_idx for x in kd_indices_lists for kd_idx in x),
+            dtype=np.int64,
+            count=hits_counts.sum(),
         )
-    else:
-        raise ValueError("Lane nether bike only, nor others")
-
-
-def is_the_end_controlled_lane(lane_id: str, controlled_lanes: Set):
-    the_end_lane = True
-    for next_lane_id in get_lane_successors(lane_id):  # small, O(n) is ok
-        if next_lane_id in controlled_lanes:
-            the_end_lane = False
-            break
-    return the_end_lane
+        source_lane_indices = np.repeat(
+            kd_scope["lane_idx"][chunk].astype(np.int64), hits_counts
+        )
+        lane_pair_keys.append(
+            np.unique(source_lane_indices * n_lanes + kd_scope["lane_idx"][kd_indices])
+        )
+    lane_pair_keys = np.unique(np.concatenate(lane_pair_keys))
+    offsets = np.zeros(n_lanes + 1, dtype=np.int64)
+    np.cumsum(
+        np.bincount(lane_pair_keys // n_lanes, minlength=n_lanes), out=offsets[1:]
+    )
+    return offsets, (lane_pair_keys % n_lanes).astype(np.int32)
 
 
-def is_predecessor(
-    lane_id: str, candidate_predecessor_lane_id: str, max_depth: int = 15
+def get_lane_neighbours_based_on_dist(
+    lane_id: str, dist_max_m: float = LANE_PROXIMITY_DIST_M
 ):
-    # bfs
-    queue = deque()
-    queue.append((candidate_predecessor_lane_id, 0))
-    while len(queue):
-        next_lane, depth = queue.popleft()
-        if depth + 1 < max_depth:
-            lanes_next = get_lane_successors(next_lane)
-            for lane_next_id in lanes_next:
-                if lane_next_id == lane_id:
-                    return True
-                queue.append((lane_next_id, depth + 1))
-    return False
-
-
-# the goal is to group traffic light faces controlling the same lanes (assuming they duplicate the same info)
-tl_faces_set_2_lanes = defaultdict(set)
-tl_faces_set_2_master_intersections = defaultdict(set)
-
-# dummy count for the check only
-tl_ids_raw_count = 0
-for master_intersection_idx, master_intersection_traffic_lights in enumerate(
-    master_intersection_idx_2_traffic_lights
+    if dist_max_m == LANE_PROXIMITY_DIST_M:
+        lane_idx = lane_id_2_idx_all[lane_id]
+        neighbour_lane_indices = lane_proximity_indices[
+            lane_proximity_offsets[lane_idx] : lane_proximity_offsets[lane_idx + 1]
+        ]
+        return [lane_ids_all[x] for x in neighbour_lane_indices.tolist()]
+    # other distances are not precomputed
+    kd_indices = np.concatenate(
+        kd_tree.query_ball_point(get_lane_center_line(lane_id), r=dist_max_m)
+    ).astype(np.int64)
+    neighbour_lane_indices, _ = kd_idx_2_lane_id_idx.decode(kd_indices)
+    return [lane_ids_all[x] for x in np.unique(neighbour_lane_indices).tolist()]
+
+
+def compute_tl_signals(
+    tl_faces_set_2_lanes: Dict[Tuple, Set],
+    tl_faces_set_2_master_intersections: Dict[Tuple, int],
+    min_required_len_after_stop_line: int = 7,
 ):
-    tl_ids_raw_count += len(master_intersection_traffic_lights)
-    for tl_id in master_intersection_traffic_lights:
-        # all lanes directly controlled by the tl
-        controlled_lanes = tl_light_2_directly_controlled_lanes[tl_id]
-
-        # differentiate lanes based on tl faces, which are available for the final exit lanes only
-        for lane_id in controlled_lanes:
-            if is_the_end_controlled_lane(lane_id, controlled_lanes):
-                tl_faces_tuple = tuple(sorted(lane_2_direct_tl_faces[lane_id]))
-                tl_faces_set_2_lanes[tl_faces_tuple].add(lane_id)
-                # propagate the tl-faces set to the predecessors
-                for controlled_lane_id in controlled_lanes:
-                    if is_predecessor(lane_id, controlled_lane_id):
-                        tl_faces_set_2_lanes[tl_faces_tuple].add(controlled_lane_id)
-                tl_faces_set_2_master_intersections[tl_faces_tuple].add(
-                    master_intersection_idx
-                )
-
-for tl_faces, intersection_idx_set in tl_faces_set_2_master_intersections.items():
-    if len(intersection_idx_set) != 1:
-        raise AssertionError(f"{tl_faces}, {intersection_idx_set}")
-    tl_faces_set_2_master_intersections[tl_faces] = list(intersection_idx_set)[0]
-# tl_signal_idx corresponds to the set of tl faces with the same set of lanes under control and therefore (presumably) the same signal
-
-
-master_intersection_idx_2_tl_signal_indices_path = (
-    "input/master_intersection_idx_2_tl_signal_indices.pkl"
-)
-tl_face_id_2_tl_signal_indices_path = "input/tl_face_id_2_tl_signal_indices.pkl"
-tl_signal_idx_2_controlled_lanes_path = "input/tl_signal_idx_2_controlled_lanes.pkl"
-tl_signal_idx_2_exit_lanes_path = "input/tl_signal_idx_2_exit_lanes.pkl"
-tl_signal_idx_2_stop_coordinates_path = "input/tl_signal_idx_2_stop_coordinates.pkl"
-controlled_lane_id_2_tl_signal_idx_path = "input/controlled_lane_id_2_tl_signal_idx.pkl"
-exit_lane_id_2_tl_signal_idx_path = "input/exit_lane_id_2_tl_signal_idx.pkl"
-if os.path.exists(master_intersection_idx_2_tl_signal_indices_path):
-    with open(master_intersection_idx_2_tl_signal_indices_path, "rb") as f:
-        master_intersection_idx_2_tl_signal_indices = pickle.load(f)
-    with open(tl_face_id_2_tl_signal_indices_path, "rb") as f:
-        tl_face_id_2_tl_signal_indices = pickle.load(f)
-    with open(tl_signal_idx_2_controlled_lanes_path, "rb") as f:
-        tl_signal_idx_2_controlled_lanes = pickle.load(f)
-    with open(tl_signal_idx_2_exit_lanes_path, "rb") as f:
-        tl_signal_idx_2_exit_lanes = pickle.load(f)
-    with open(tl_signal_idx_2_stop_coordinates_path, "rb") as f:
-        tl_signal_idx_2_stop_coordinates = pickle.load(f)
-    with open(controlled_lane_id_2_tl_signal_idx_path, "rb") as f:
-        controlled_lane_id_2_tl_signal_idx = pickle.load(f)
-    with open(exit_lane_id_2_tl_signal_idx_path, "rb") as f:
-        exit_lane_id_2_tl_signal_idx = pickle.load(f)
-else:
     master_intersection_idx_2_tl_signal_indices = defaultdict(list)
     tl_face_id_2_tl_signal_indices = defaultdict(set)
     tl_signal_idx_2_controlled_lanes = []
@@ -834,8 +742,6 @@ else:
     controlled_lane_id_2_tl_signal_idx = dict()
     exit_lane_id_2_tl_signal_idx = dict()
 
-    min_required_len_after_stop_line = 7
-
     for tl_face_ids, controlled_lanes in sorted(
         tl_faces_set_2_lanes.items(), key=lambda x: x[0]
     ):
@@ -851,126 +757,73 @@ else:
         for lane_id in controlled_lanes:
 
             if is_the_end_controlled_lane(lane_id, controlled_lanes):
-                stop_coordinates.append(get_lane_center_line(lane_id)[-1])
-
-                dist_from_stop_line = 0
-                queue = deque()
-                queue.append((lane_id, dist_from_stop_line))
-                while len(queue):
-                    next_lane, dist_from_stop_line = queue.popleft()
-                    if dist_from_stop_line != 0:  # not the end lane
-                        tl_signal_idx_2_exit_lanes[tl_signal_idx].add(next_lane)
-                        exit_lane_id_2_tl_signal_idx[next_lane] = tl_signal_idx
-                    if dist_from_stop_line < min_required_len_after_stop_line:
-                        lanes_next = get_lane_successors(next_lane)
-                        for lane_next_id in lanes_next:
-                            queue.append(
-                                (
-                                    lane_next_id,
-                                    dist_from_stop_line + get_lane_len(lane_next_id),
-                                )
-                            )
+                stop_coordinates.append(get_lane_center_line(lane_id)[-1].copy())
+
+                next_lane_indices, dists_from_stop_line = lane_graph.traverse(
+                    [lane_id_2_idx_all[lane_id]],
+                    [0],
+                    ("forward",),
+                    max_dist=min_required_len_after_stop_line,
+                )
+                for next_lane_idx in next_lane_indices[
+                    dists_from_stop_line != 0  # not the end lane
+                ].tolist():
+                    next_lane = lane_ids_all[next_lane_idx]
+                    tl_signal_idx_2_exit_lanes[tl_signal_idx].add(next_lane)
+                    exit_lane_id_2_tl_signal_idx[next_lane] = tl_signal_idx
 
         tl_signal_idx_2_stop_coordinates.append(stop_coordinates)
         for tl_face_id in tl_face_ids:
             tl_face_id_2_tl_signal_indices[tl_face_id].add(tl_signal_idx)
-    with open(master_intersection_idx_2_tl_signal_indices_path, "wb") as f:
-        pickle.dump(master_intersection_idx_2_tl_signal_indices, f)
-    with open(tl_face_id_2_tl_signal_indices_path, "wb") as f:
-        pickle.dump(tl_face_id_2_tl_signal_indices, f)
-    with open(tl_signal_idx_2_controlled_lanes_path, "wb") as f:
-        pickle.dump(tl_signal_idx_2_controlled_lanes, f)
-    with open(tl_signal_idx_2_exit_lanes_path, "wb") as f:
-        pickle.dump(tl_signal_idx_2_exit_lanes, f)
-    with open(tl_signal_idx_2_stop_coordinates_path, "wb") as f:
-        pickle.dump(tl_signal_idx_2_stop_coordinates, f)
-    with open(controlled_lane_id_2_tl_signal_idx_path, "wb") as f:
-        pickle.dump(controlled_lane_id_2_tl_signal_idx, f)
-    with open(exit_lane_id_2_tl_signal_idx_path, "wb") as f:
-        pickle.dump(exit_lane_id_2_tl_signal_idx, f)
-
-lane_2_master_intersection_related_lanes = dict()  # ->set
-lane_id_2_master_intersection_idx = dict()
-for (
-    master_intersection_idx,
-    master_intersection_tl_signal_indices,
-) in master_intersection_idx_2_tl_signal_indices.items():
-    all_master_intersection_lanes = set()
-    for tl_signal_idx in master_intersection_tl_signal_indices:
-        all_master_intersection_lanes.update(
-            tl_signal_idx_2_controlled_lanes[tl_signal_idx]
-        )
-        all_master_intersection_lanes.update(tl_signal_idx_2_exit_lanes[tl_signal_idx])
-        for lane_id in tl_signal_idx_2_controlled_lanes[tl_signal_idx].union(
-            tl_signal_idx_2_exit_lanes[tl_signal_idx]
-        ):
-            lane_id_2_master_intersection_idx[lane_id] = master_intersection_idx
+    return (
+        master_intersection_idx_2_tl_signal_indices,
+        tl_face_id_2_tl_signal_indices,
+        tl_signal_idx_2_controlled_lanes,
+        tl_signal_idx_2_exit_lanes,
+        tl_signal_idx_2_stop_coordinates,
+        controlled_lane_id_2_tl_signal_idx,
+        exit_lane_id_2_tl_signal_idx,
+    )
 
-        # to also associate the neighbourhood to an intersection, bfs from the controlled lanes (mainly to include the artificially separated turns-under-red)
-        lanes_closed_set = tl_signal_idx_2_controlled_lanes[tl_signal_idx].union(
-            tl_signal_idx_2_exit_lanes[tl_signal_idx]
-        )
-        for lane_id in tl_signal_idx_2_controlled_lanes[tl_signal_idx]:
-            dist_from_exit = 0
-            queue = deque()
-            queue.append((lane_id, dist_from_exit))
-            while len(queue):
-                next_lane_id, dist_from_exit = queue.popleft()
-                lane_id_2_master_intersection_idx[
-                    next_lane_id
-                ] = master_intersection_idx
-                if dist_from_exit < 70:  # points
-                    lanes_next = (
-                        get_lane_successors(next_lane_id)
-                        + get_lane_left_neighbours(next_lane_id)
-                        + get_lane_right_neighbours(next_lane_id)
-                    )
-                    for further_lane_id in lanes_next:
-                        if further_lane_id not in lanes_closed_set:
-                            queue.append(
-                                (
-                                    further_lane_id,
-                                    dist_from_exit + get_lane_len(further_lane_id),
-                                )
-                            )
-                            lanes_closed_set.add(further_lane_id)
-    for lane_id in all_master_intersection_lanes:
-        lane_2_master_intersection_related_lanes[lane_id] = {
-            neighbour_lane_id
-            for neighbour_lane_id in all_master_intersection_lanes
-            if neighbour_lane_id != lane_id
-        }
 
-# added lanes belong to intersections
-lanes_not_bike_intersection, _ = get_lanes_dict_and_id_mapping(
-    filter_function=lambda x: x in added_lanes
-    or (not proto_API.is_bike_only_lane(x) and x in lane_id_2_master_intersection_idx)
-)
-lanes_bike_intersection, _ = get_lanes_dict_and_id_mapping(
-    filter_function=lambda x: x in added_lanes
-    or (proto_API.is_bike_only_lane(x) and x in lane_id_2_master_intersection_idx)
-)
-lanes_intersection, _ = get_lanes_dict_and_id_mapping(
-    filter_function=lambda x: x in added_lanes or x in lane_id_2_master_intersection_idx
-)
+def get_lane_boarders(lane_id: str):
+    if lane_id not in lane_id_2_idx_all:
+        raise ValueError("Lane nether bike only, nor others")
+    lane_idx = lane_id_2_idx_all[lane_id]
+    return (
+        lanes_xy_left_points[
+            lanes_xy_left_offsets[lane_idx] : lanes_xy_left_offsets[lane_idx + 1]
+        ],
+        lanes_xy_right_points[
+            lanes_xy_right_offsets[lane_idx] : lanes_xy_right_offsets[lane_idx + 1]
+        ],
+    )
 
-(
-    kd_tree_bike_intersection,
-    kd_idx_2_lane_id_idx_bike_intersection,
-) = get_kd_tree_and_idx_map(lanes_bike_intersection)
-(
-    kd_tree_not_bike_intersection,
-    kd_idx_2_lane_id_idx_not_bike_intersection,
-) = get_kd_tree_and_idx_map(lanes_not_bike_intersection)
-kd_tree_intersection, kd_idx_2_lane_id_idx_intersection = get_kd_tree_and_idx_map(
-    lanes_intersection
-)
+
+def is_the_end_controlled_lane(lane_id: str, controlled_lanes: Set):
+    the_end_lane = True
+    for next_lane_id in get_lane_successors(lane_id):  # small, O(n) is ok
+        if next_lane_id in controlled_lanes:
+            the_end_lane = False
+            break
+    return the_end_lane
+
+
+def is_predecessor(
+    lane_id: str,
+    candidate_predecessor_lane_id: str,
+    max_depth: int = IS_PREDECESSOR_MAX_DEPTH,
+):
+    return lane_graph.is_reachable(
+        lane_id_2_idx_all[candidate_predecessor_lane_id],
+        lane_id_2_idx_all[lane_id],
+        "forward",
+        max_depth,
+    )
 
 
 def get_traffic_light_coordinates(el_id):
-    if el_id in proto_API.ids_to_el:
-        coordinates = proto_API.get_traffic_light_coords(el_id)["xyz"]
-        return coordinates[:, :2].mean(axis=0)
+    return traffic_light_id_2_coord.get(el_id)
 
 
 def rotate_point(
@@ -982,14 +835,73 @@ def rotate_point(
     return x * cos - y * sin, x * sin + y * cos
 
 
+def get_map_segments_data():
+    """
+    Loads the map segments precomputed by lyft_trajectories.utils.segment_map on the first use,
+    they only label the agents lanes (map_segment_group).
+
+    Returns:
+        list of map_segment_2_lanes, interval_2_segments_x, interval_2_segments_y,
+        segment_x_coords_only, segment_y_coords_only
+    """
+    global map_segments_data
+    if map_segments_data is None:
+        missing_file_names = [
+            file_name
+            for file_name in MAP_SEGMENTS_FILE_NAMES
+            if not os.path.exists(os.path.join(SEGMENTS_OUTPUT_PATH, file_name))
+        ]
+        if len(missing_file_names):
+            raise FileNotFoundError(
+                f"Map segments {missing_file_names} not found in {SEGMENTS_OUTPUT_PATH}, "
+                "run lyft_trajectories.utils.segment_map first"
+            )
+        loaded_map_segments_data = []
+        for file_name in MAP_SEGMENTS_FILE_NAMES:
+            with open(os.path.join(SEGMENTS_OUTPUT_PATH, file_name), "rb") as f:
+                loaded_map_segments_data.append(pickle.load(f))
+        map_segments_data = loaded_map_segments_data
+    return map_segments_data
+
+
 def match_point_2_map_segment(
     x_coord: float,
     y_coord: float,
-    segment_x_coords_only: List = map_segment_x_coords_only,
-    segment_y_coords_only: List = map_segment_y_coords_only,
-    interval_2_segments_x: List = interval_2_map_segments_x,
-    interval_2_segments_y: List = interval_2_map_segments_y,
+    segment_x_coords_only: List = None,
+    segment_y_coords_only: List = None,
+    interval_2_segments_x: List = None,
+    interval_2_segments_y: List = None,
+    segment_2_lanes: List = None,
 ):
+    if any(
+        x is None
+        for x in (
+            segment_x_coords_only,
+            segment_y_coords_only,
+            interval_2_segments_x,
+            interval_2_segments_y,
+            segment_2_lanes,
+        )
+    ):
+        (
+            map_segment_2_lanes,
+            interval_2_map_segments_x,
+            interval_2_map_segments_y,
+            map_segment_x_coords_only,
+            map_segment_y_coords_only,
+        ) = get_map_segments_data()
+        if segment_x_coords_only is None:
+            segment_x_coords_only = map_segment_x_coords_only
+        if segment_y_coords_only is None:
+            segment_y_coords_only = map_segment_y_coords_only
+        if interval_2_segments_x is None:
+            interval_2_segments_x = interval_2_map_segments_x
+        if interval_2_segments_y is None:
+            interval_2_segments_y = interval_2_map_segments_y
+        if segment_2_lanes is None:
+            segment_2_lanes = map_segment_2_lanes
+    if not len(segment_x_coords_only):
+        return []
     x_coord, y_coord = rotate_point(x_coord, y_coord)
     x_interval = bisect.bisect_right(segment_x_coords_only, x_coord) - 1
     y_interval = bisect.bisect_right(segment_y_coords_only, y_coord) - 1
@@ -997,22 +909,49 @@ def match_point_2_map_segment(
         interval_2_segments_x[x_interval].intersection(
             interval_2_segments_y[y_interval]
         ),
-        key=lambda segment_i: len(map_segment_2_lanes[segment_i]),
+        key=lambda segment_i: len(segment_2_lanes[segment_i]),
     )
 
 
-def get_candidate_lane_points(
-    candidate_indices: np.ndarray,
+def get_kd_tree_and_idx_map_for_agent(
+    coord: np.ndarray,
     agent_class: int,
-    intersections_only: bool,
-    map_segment_idx: int = None,
+    intersections_only: bool = False,
+    segmented_map: bool = True,
+    master_intersection_idx: int = None,
 ):
-    return [
-        get_lane_point_from_kdtree(
-            candidate_idx, agent_class, intersections_only, map_segment_idx
-        )
-        for candidate_idx in candidate_indices
-    ]
+    if agent_class not in (BIKE_CLASS, CAR_CLASS, ALL_WHEELS_CLASS):
+        raise NotImplementedError("Only bikes and general cars supported")
+
+    if intersections_only:
+        if master_intersection_idx is not None:
+            (
+                master_intersection_kd_tree,
+                master_intersection_kd_idx_map,
+            ) = master_intersection_kd_trees_and_idx_maps[master_intersection_idx][
+                agent_class
+            ]
+            if master_intersection_kd_tree is not None:
+                return master_intersection_kd_tree, master_intersection_kd_idx_map
+        return intersection_kd_trees_and_idx_maps[agent_class]
+    if segmented_map:
+        # the leaf trees contain all lanes within MAP_PARTITION_MARGIN_M of the leaf cell
+        leaf_kd_tree, leaf_kd_idx_map = map_partition_leaf_2_kd_trees_and_idx_maps[
+            map_partition.get_leaf_idx(coord)
+        ][agent_class]
+        if leaf_kd_tree is not None:
+            return leaf_kd_tree, leaf_kd_idx_map
+    return kd_trees_and_idx_maps[agent_class]
+
+
+def get_master_intersection_region_mask(
+    coords: np.ndarray, master_intersection_idx: int, max_dist_m: float
+) -> np.ndarray:
+    # agents which might be matched to the lanes related to the lanes of the master intersection
+    return (
+        get_dists_to_bounds(coords, master_intersection_bounds[master_intersection_idx])
+        <= max_dist_m
+    )
 
 
 def get_closest_lanes(
@@ -1021,148 +960,62 @@ def get_closest_lanes(
     k_nearest: int,
     intersections_only: bool = False,
     segmented_map: bool = True,
+    max_dist_m: float = 4.0,
 ):
     # TODO: distance_upper_bound kd_tree param and handling empty return
-    if agent_class == BIKE_CLASS:
-        if intersections_only:
-            candidate_distances, candidate_indices = kd_tree_bike_intersection.query(
-                coord, k=k_nearest
-            )
-            return candidate_distances, get_candidate_lane_points(
-                candidate_indices, agent_class, intersections_only
-            )
-        if segmented_map:
-            map_segment_indices = match_point_2_map_segment(
-                *coord,
-                map_segment_x_coords_only,
-                map_segment_y_coords_only,
-                interval_2_map_segments_x,
-                interval_2_map_segments_y,
-            )
-            # checked that the graph and proximity adj. covered all lanes inside the segment
-            if len(map_segment_indices):
-                # map_segment_indices are ordered based on map segment size
-                candidate_distances, candidate_indices = map_segment_2_kd_tree_bike[
-                    map_segment_indices[0]
-                ].query(coord, k=k_nearest)
-                return candidate_distances, get_candidate_lane_points(
-                    candidate_indices,
-                    agent_class,
-                    intersections_only,
-                    map_segment_indices[0],
-                )
-        candidate_distances, candidate_indices = kd_tree_bike.query(coord, k=k_nearest)
-        return candidate_distances, get_candidate_lane_points(
-            candidate_indices, agent_class, intersections_only
-        )
-    elif agent_class == CAR_CLASS:
-        if intersections_only:
-            (
-                candidate_distances,
-                candidate_indices,
-            ) = kd_tree_not_bike_intersection.query(coord, k=k_nearest)
-            return candidate_distances, get_candidate_lane_points(
-                candidate_indices, agent_class, intersections_only
-            )
-        if segmented_map:
-            map_segment_indices = match_point_2_map_segment(
-                *coord,
-                map_segment_x_coords_only,
-                map_segment_y_coords_only,
-                interval_2_map_segments_x,
-                interval_2_map_segments_y,
-            )
-            # checked that the graph and proximity adj. covered all lanes inside the segment
-            if len(map_segment_indices):
-                # map_segment_indices are ordered based on map segment size
-                candidate_distances, candidate_indices = map_segment_2_kd_tree_not_bike[
-                    map_segment_indices[0]
-                ].query(coord, k=k_nearest)
-                return candidate_distances, get_candidate_lane_points(
-                    candidate_indices,
-                    agent_class,
-                    intersections_only,
-                    map_segment_indices[0],
-                )
-        candidate_distances, candidate_indices = kd_tree_not_bike.query(
-            coord, k=k_nearest
+    # the leaf kd trees contain all lanes within MAP_PARTITION_MARGIN_M of the leaf cell only
+    segmented_map = segmented_map and max_dist_m < MAP_PARTITION_MARGIN_M
+    kd_tree_, kd_idx_map_ = get_kd_tree_and_idx_map_for_agent(
+        coord, agent_class, intersections_only, segmented_map
+    )
+    candidate_distances, candidate_indices = query_kd_tree(kd_tree_, coord, k_nearest)
+    if (
+        segmented_map
+        and not intersections_only
+        and candidate_distances[-1] > MAP_PARTITION_MARGIN_M - max_dist_m
+    ):
+        return get_closest_lanes(
+            coord,
+            agent_class,
+            k_nearest,
+            intersections_only,
+            segmented_map=False,
+            max_dist_m=max_dist_m,
         )
-        return candidate_distances, get_candidate_lane_points(
-            candidate_indices, agent_class, intersections_only
+    # scopes with less than k_nearest points of the agent class are padded with infinite distances
+    # (and out of range indices), no candidates
+    is_found = np.isfinite(candidate_distances)
+    candidate_distances = candidate_distances[is_found]
+    candidate_lane_indices, candidate_point_indices = kd_idx_map_.decode(
+        candidate_indices[is_found]
+    )
+    return candidate_distances, [
+        (kd_idx_map_.lane_ids[lane_idx], point_idx)
+        for lane_idx, point_idx in zip(
+            candidate_lane_indices.tolist(), candidate_point_indices.tolist()
         )
-    elif agent_class == ALL_WHEELS_CLASS:
-        if intersections_only:
-            candidate_distances, candidate_indices = kd_tree_intersection.query(
-                coord, k=k_nearest
-            )
-            return candidate_distances, get_candidate_lane_points(
-                candidate_indices, agent_class, intersections_only
-            )
-        if segmented_map:
-            map_segment_indices = match_point_2_map_segment(
-                *coord,
-                map_segment_x_coords_only,
-                map_segment_y_coords_only,
-                interval_2_map_segments_x,
-                interval_2_map_segments_y,
-            )
-            # checked that the graph and proximity adj. covered all lanes inside the segment
-            if len(map_segment_indices):
-                # map_segment_indices are ordered based on map segment size
-                candidate_distances, candidate_indices = map_segment_2_kd_tree[
-                    map_segment_indices[0]
-                ].query(coord, k=k_nearest)
-                return candidate_distances, get_candidate_lane_points(
-                    candidate_indices,
-                    agent_class,
-                    intersections_only,
-                    map_segment_indices[0],
-                )
+    ]
 
-        candidate_distances, candidate_indices = kd_tree.query(coord, k=k_nearest)
-        return candidate_distances, get_candidate_lane_points(
-            candidate_indices, agent_class, intersections_only
-        )
-    else:
-        raise NotImplementedError("Only bikes and general cars supported")
 
+def get_heading_vectors(yaws: Sequence[float]):
+    """
+    Returns:
+        (x, y, norm) rows of the agents heading vectors, the computation is done per yaw in its own dtype
+        (yaws of agents are float32)
+    """
+    heading_vectors = []
+    for yaw in yaws:
+        x2, y2 = np.cos(yaw), np.sin(yaw)
+        heading_vectors.append((x2, y2, np.hypot(x2, y2)))
+    return np.array(heading_vectors, dtype=np.float64).reshape(-1, 3).T
 
-def get_lane_point_from_kdtree(
-    candidate_idx: int,
-    agent_class: int,
-    intersections_only: bool = False,
-    map_segment_idx: int = None,
-):
-    if agent_class == BIKE_CLASS:
-        if intersections_only:
-            return kd_idx_2_lane_id_idx_bike_intersection[candidate_idx]
-        if map_segment_idx is not None:
-            return map_segment_2_kd_idx_2_lane_id_idx_bike[map_segment_idx][
-                candidate_idx
-            ]
-        return kd_idx_2_lane_id_idx_bike[candidate_idx]
-    elif agent_class == CAR_CLASS:
-        if intersections_only:
-            return kd_idx_2_lane_id_idx_not_bike_intersection[candidate_idx]
-        if map_segment_idx is not None:
-            return map_segment_2_kd_idx_2_lane_id_idx_not_bike[map_segment_idx][
-                candidate_idx
-            ]
-        return kd_idx_2_lane_id_idx_not_bike[candidate_idx]
-    elif agent_class == ALL_WHEELS_CLASS:
-        if intersections_only:
-            return kd_idx_2_lane_id_idx_intersection[candidate_idx]
-        if map_segment_idx is not None:
-            return map_segment_2_kd_idx_2_lane_id_idx[map_segment_idx][candidate_idx]
-        return kd_idx_2_lane_id_idx[candidate_idx]
-
-
-def cos_dist(x1: float, y1: float, yaw_rad: float):
-    x2 = np.cos(yaw_rad)
-    y2 = np.sin(yaw_rad)
-    vector_product = x1 * x2 + y1 * y2
-    cos = vector_product / (np.hypot(x1, y1) * np.hypot(x2, y2))
-    return 1 - cos
+
+def get_cos_dists(segment_headings: np.ndarray, heading_vector: Tuple):
+    # 1 - cos of the angle between the lane segments (rows of lanes_center_line_headings) and the heading vector
+    return 1 - (
+        segment_headings[..., 0] * heading_vector[0]
+        + segment_headings[..., 1] * heading_vector[1]
+    ) / (segment_headings[..., 2] * heading_vector[2])
 
 
 def is_end_of_maneuver_lane(
@@ -1171,9 +1024,9 @@ def is_end_of_maneuver_lane(
     overlapped_last_points_count: int = 5,
     min_len_maneuver_lane: int = 7,
 ):
-    return (
-        lane_len > min_len_maneuver_lane
-        and point_idx >= lane_len - 1 - overlapped_last_points_count
+    # also applies element-wise to arrays of point indices and lane lengths
+    return (lane_len > min_len_maneuver_lane) & (
+        point_idx >= lane_len - 1 - overlapped_last_points_count
     )
 
 
@@ -1181,7 +1034,7 @@ def find_closest_lane(
     coord: np.ndarray,
     yaw: float,
     agent_class: int,
-    lane_point_2_blocked_lanes_set: Dict[Tuple, Set] = None,
+    lane_point_blocked_signals: np.ndarray = None,
     max_dist_m: float = 4.0,
     k_nearest: int = 25,
     return_point_i: bool = False,
@@ -1193,14 +1046,17 @@ def find_closest_lane(
     vis: bool = False,
 ):
     if vis:
+        import matplotlib.pyplot as plt
+
         plt.figure(figsize=(15, 15))
     candidate_distances, candidate_lane_points = get_closest_lanes(
-        coord, agent_class, k_nearest, intersections_only
+        coord, agent_class, k_nearest, intersections_only, max_dist_m=max_dist_m
     )
 
+    heading_vector = get_heading_vectors([yaw])[:, 0]
     closed_set = set()
     min_cos_dist = float("inf")
-    min_dist = candidate_distances[0]
+    min_dist = candidate_distances[0] if len(candidate_distances) else np.inf
     closest_lane_current_i = None
     result = None
 
@@ -1219,28 +1075,29 @@ def find_closest_lane(
             break
         if lane_id not in closed_set:
             closed_set.add(lane_id)
-            lane_center_line = get_lane_center_line(lane_id)
+            lane_idx = lane_id_2_idx_all[lane_id]
+            lane_start = lanes_center_line_offsets[lane_idx]
+            lane_len = lanes_center_line_offsets[lane_idx + 1] - lane_start
             lane_cos_dists = []
             if point_idx > 0:
-                x1_prev = (
-                    lane_center_line[point_idx][0] - lane_center_line[point_idx - 1][0]
-                )
-                y1_prev = (
-                    lane_center_line[point_idx][1] - lane_center_line[point_idx - 1][1]
-                )
-                lane_cos_dists.append(cos_dist(x1_prev, y1_prev, yaw))
-            if point_idx + 1 < len(lane_center_line):
-                x1_next = (
-                    lane_center_line[point_idx + 1][0] - lane_center_line[point_idx][0]
+                lane_cos_dists.append(
+                    get_cos_dists(
+                        lanes_center_line_headings[lane_start + point_idx - 1],
+                        heading_vector,
+                    )
                 )
-                y1_next = (
-                    lane_center_line[point_idx + 1][1] - lane_center_line[point_idx][1]
+            if point_idx + 1 < lane_len:
+                lane_cos_dists.append(
+                    get_cos_dists(
+                        lanes_center_line_headings[lane_start + point_idx],
+                        heading_vector,
+                    )
                 )
-                lane_cos_dists.append(cos_dist(x1_next, y1_next, yaw))
 
             lane_cos_dist = np.mean(lane_cos_dists)
 
             if vis:
+                lane_center_line = get_lane_center_line(lane_id)
                 plt.scatter(
                     lane_center_line[:, 0],
                     lane_center_line[:, 1],
@@ -1255,7 +1112,7 @@ def find_closest_lane(
         plt.arrow(coord[0], coord[1], 3 * np.cos(yaw), 3 * np.sin(yaw), color="r")
         plt.legend()
         plt.title(
-            f'{result}, {lane_point_2_blocked_lanes_set.get(result, set()) if lane_point_2_blocked_lanes_set is not None else ""}'
+            f'{result}, {get_lane_point_blocked_signals(lane_id_2_idx_all[result[0]], result[1], lane_point_blocked_signals) if lane_point_blocked_signals is not None and result is not None else ""}'
         )
 
     if result is None or min_cos_dist >= min_cos_dist_threshold:
@@ -1263,7 +1120,7 @@ def find_closest_lane(
     closest_lane = result[0]
 
     if return_blocked_tl_signals:
-        if lane_point_2_blocked_lanes_set is None:
+        if lane_point_blocked_signals is None:
             last_blocked_i = closest_lane_current_i
             while (
                 last_blocked_i < len(candidate_distances)
@@ -1292,7 +1149,9 @@ def find_closest_lane(
             else:
                 blocked_signals = set()
         else:
-            blocked_signals = lane_point_2_blocked_lanes_set.get(result, set())
+            blocked_signals = get_lane_point_blocked_signals(
+                lane_id_2_idx_all[closest_lane], result[1], lane_point_blocked_signals
+            )
         if not return_point_i:
             return closest_lane, blocked_signals
         return result, blocked_signals
@@ -1301,72 +1160,680 @@ def find_closest_lane(
     return result
 
 
-lane_point_2_blocked_lanes_set = dict()
+def select_closest_lane_candidates(
+    candidate_distances: np.ndarray,
+    candidate_lane_indices: np.ndarray,
+    candidate_point_indices: np.ndarray,
+    yaws: Sequence[float],
+    max_dist_m: float,
+    too_close_insensitivity_m: float,
+    min_cos_dist_threshold: float,
+):
+    """
+    The direction scoring with the deadband tie-break of find_closest_lane, for all agents at once.
+
+    Args:
+        candidate_distances (np.ndarray): (N, k) candidate lane point distances, increasing per agent
+        candidate_lane_indices (np.ndarray): (N, k) their lane indices in lane_ids_all
+        candidate_point_indices (np.ndarray): (N, k) their lane point indices
+        yaws (Sequence[float]): agent yaws
+
+    Returns:
+        tuple of the selected candidate positions (-1 if none) and of the flags whether the agent is matched
+    """
+    # lane direction scores of all candidates (as in find_closest_lane, averaged over the available neighbour points)
+    lane_starts = lanes_center_line_offsets[candidate_lane_indices]
+    lane_lens = lanes_center_line_offsets[candidate_lane_indices + 1] - lane_starts
+    has_prev = candidate_point_indices > 0
+    has_next = candidate_point_indices + 1 < lane_lens
+    candidate_points = lane_starts + candidate_point_indices
+    heading_vectors = get_heading_vectors(yaws)[:, :, np.newaxis]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        lane_cos_dists_sum = np.zeros(candidate_distances.shape, dtype=np.float64)
+        for segment_points, has_segment in [
+            (np.maximum(candidate_points - 1, 0), has_prev),
+            (candidate_points, has_next),
+        ]:
+            segment_cos_dists = get_cos_dists(
+                lanes_center_line_headings[segment_points], heading_vectors
+            )
+            lane_cos_dists_sum += np.where(has_segment, segment_cos_dists, 0)
+        lane_cos_dists = lane_cos_dists_sum / (
+            has_prev.astype(np.int64) + has_next.astype(np.int64)
+        )
+
+    # only the first candidate point of each lane is scored
+    is_first_lane_point = ~np.any(
+        np.tril(
+            candidate_lane_indices[:, :, np.newaxis]
+            == candidate_lane_indices[:, np.newaxis, :],
+            k=-1,
+        ),
+        axis=2,
+    )
+    is_scored = is_first_lane_point & (candidate_distances <= max_dist_m)
+    deadbands = np.where(
+        candidate_distances == candidate_distances[:, :1],
+        0,
+        np.where(candidate_distances <= too_close_insensitivity_m, 0.001, 0.05),
+    )
+    # processing in increasing order of L2
+    min_cos_dists = np.full(len(candidate_distances), np.inf)
+    closest_lane_candidate_i = np.full(len(candidate_distances), -1)
+    for candidate_i in range(candidate_distances.shape[1]):
+        is_best_dist = is_scored[:, candidate_i] & (
+            lane_cos_dists[:, candidate_i] + deadbands[:, candidate_i] < min_cos_dists
+        )
+        min_cos_dists[is_best_dist] = lane_cos_dists[is_best_dist, candidate_i]
+        closest_lane_candidate_i[is_best_dist] = candidate_i
+    is_matched = (closest_lane_candidate_i >= 0) & (
+        min_cos_dists < min_cos_dist_threshold
+    )
+    return closest_lane_candidate_i, is_matched
+
+
+def get_lane_point_blocked_signals(
+    lane_idx: int, point_idx: int, lane_point_blocked_signals: np.ndarray
+) -> Set[int]:
+    # the bitmask rows are aligned with lanes_center_line_points
+    return set(
+        get_set_bit_indices(
+            lane_point_blocked_signals[lanes_center_line_offsets[lane_idx] + point_idx]
+        ).tolist()
+    )
 
-checked_hard_cases = {("csUz", 2), ("RmBi", 7), ("RmBi", 6)}
 
-for i, lane_id in tqdm(
-    enumerate(exit_lane_id_2_tl_signal_idx.keys()), desc="Lane blocked sets.."
+def get_precomputed_blocked_signals(
+    lane_indices: np.ndarray,
+    lane_point_indices: np.ndarray,
+    lane_point_blocked_signals: np.ndarray,
 ):
-    lane_len = get_lane_len(lane_id)
-    lane_center_line = get_lane_center_line(lane_id)
-    if lane_len != len(lane_center_line):
-        raise AssertionError
-    blocked_set_so_far = set()
-    for point_idx in range(lane_len - 1, -1, -1):
-        yaws = []
-        if point_idx > 0:
-            x1_prev = (
-                lane_center_line[point_idx][0] - lane_center_line[point_idx - 1][0]
+    blocked_signals_list = [None for _ in range(len(lane_indices))]
+    for agent_i in np.flatnonzero(lane_indices >= 0).tolist():
+        blocked_signals_list[agent_i] = get_lane_point_blocked_signals(
+            lane_indices[agent_i],
+            lane_point_indices[agent_i],
+            lane_point_blocked_signals,
+        )
+    return blocked_signals_list
+
+
+def find_closest_lanes(
+    coords: np.ndarray,
+    yaws: Sequence[float],
+    agent_classes: Union[int, Sequence[int]],
+    lane_point_blocked_signals: np.ndarray = None,
+    max_dist_m: float = 4.0,
+    k_nearest: int = 25,
+    return_blocked_tl_signals: bool = False,
+    blocked_dist_threshold_m: float = 1.5,
+    too_close_insensitivity_m: float = 1.3,
+    min_cos_dist_threshold: float = np.pi / 2,
+    intersections_only: bool = False,
+    use_grid: bool = False,
+    master_intersection_idx: int = None,
+):
+    """
+    Batch version of find_closest_lane with identical results: agents sharing a kd tree are queried at once,
+    and the direction scoring with the deadband tie-break is done for all agents and candidates with array operations.
+
+    Args:
+        coords (np.ndarray): agent centroids, (N, 2)
+        yaws (Sequence[float]): agent yaws
+        agent_classes (Union[int, Sequence[int]]): agent classes, or a single class for all agents
+        use_grid (bool): whether to take the candidates from the lane grid index instead of the kd trees,
+            the kd trees are still used when the matching radius exceeds LANE_GRID_RADIUS_M
+        master_intersection_idx (int): with intersections_only, only the matches to the lanes related to the lanes
+            of the master intersection are needed (e.g. the ego lane is known), agents outside of its bounding box
+            (plus max_dist_m) are not matched and the others are queried from the master intersection kd trees
+        other args as in find_closest_lane
+
+    Returns:
+        tuple of the lane indices in lane_ids_all (-1 for agents without a matched lane), the lane point indices,
+        and if return_blocked_tl_signals, the list of the blocked tl signals sets (None for agents without a lane)
+    """
+    n_agents = len(yaws)
+    coords = np.asarray(coords).reshape(n_agents, 2)
+    agent_classes = np.broadcast_to(agent_classes, (n_agents,))
+
+    if master_intersection_idx is not None and not intersections_only:
+        raise ValueError("Master intersection indices cover the intersections only")
+
+    # agents without candidates are not matched
+    candidate_distances = np.full((n_agents, k_nearest), np.inf)
+    candidate_lane_indices = np.zeros((n_agents, k_nearest), dtype=np.int64)
+    candidate_point_indices = np.zeros((n_agents, k_nearest), dtype=np.int64)
+    # the candidates farther than the matching radius don't change the result
+    matching_radius = max_dist_m
+    if return_blocked_tl_signals and lane_point_blocked_signals is None:
+        matching_radius += blocked_dist_threshold_m
+    use_grid = use_grid and matching_radius <= LANE_GRID_RADIUS_M
+
+    def set_candidates(
+        agents: np.ndarray, master_intersection_idx_: int, segmented_map: bool = True
+    ):
+        tree_id_2_agents = dict()
+        for agent_i in agents.tolist():
+            kd_tree_, kd_idx_map_ = get_kd_tree_and_idx_map_for_agent(
+                coords[agent_i],
+                agent_classes[agent_i],
+                intersections_only,
+                segmented_map,
+                master_intersection_idx=master_intersection_idx_,
             )
-            y1_prev = (
-                lane_center_line[point_idx][1] - lane_center_line[point_idx - 1][1]
+            if id(kd_tree_) not in tree_id_2_agents:
+                tree_id_2_agents[id(kd_tree_)] = kd_tree_, kd_idx_map_, []
+            tree_id_2_agents[id(kd_tree_)][2].append(agent_i)
+        for kd_tree_, kd_idx_map_, agent_indices in tree_id_2_agents.values():
+            if use_grid:
+                (
+                    candidate_distances[agent_indices],
+                    candidate_lane_indices[agent_indices],
+                    candidate_point_indices[agent_indices],
+                ) = get_grid_candidates(
+                    coords[agent_indices], kd_idx_map_.get_lane_mask(), k_nearest
+                )
+                continue
+            distances, indices = kd_tree_.query(coords[agent_indices], k=k_nearest)
+            distances = distances.reshape(len(agent_indices), k_nearest)
+            indices = indices.reshape(len(agent_indices), k_nearest)
+            # same tie order as in query_kd_tree
+            order = np.lexsort((indices, distances), axis=-1)
+            indices = np.take_along_axis(indices, order, axis=-1)
+            candidate_distances[agent_indices] = np.take_along_axis(
+                distances, order, axis=-1
             )
-            yaws.append(get_helping_angle(np.array([x1_prev, y1_prev])))
-        if point_idx + 1 < lane_len:
-            x1_next = (
-                lane_center_line[point_idx + 1][0] - lane_center_line[point_idx][0]
+            # scopes with less than k_nearest points of the agent class are padded with infinite distances
+            # and out of range indices (sorted last), the padded candidates are never matched
+            (
+                candidate_lane_indices[agent_indices],
+                candidate_point_indices[agent_indices],
+            ) = kd_idx_map_.decode(np.where(indices < len(kd_idx_map_), indices, 0))
+
+    if master_intersection_idx is None:
+        # the leaf kd trees contain all lanes within MAP_PARTITION_MARGIN_M of the leaf cell only,
+        # larger matching radii are queried from the full kd trees directly
+        is_partition_used = max_dist_m < MAP_PARTITION_MARGIN_M
+        set_candidates(np.arange(n_agents), None, segmented_map=is_partition_used)
+        if is_partition_used and not use_grid and not intersections_only:
+            set_candidates(
+                np.flatnonzero(
+                    candidate_distances[:, -1] > MAP_PARTITION_MARGIN_M - max_dist_m
+                ),
+                None,
+                segmented_map=False,
             )
-            y1_next = (
-                lane_center_line[point_idx + 1][1] - lane_center_line[point_idx][1]
+    else:
+        region_agents = np.flatnonzero(
+            get_master_intersection_region_mask(
+                coords, master_intersection_idx, max_dist_m
             )
-            yaws.append(get_helping_angle(np.array([x1_next, y1_next])))
-        # 1st and 4th quadrants boarder
-        yaws = sorted(yaws)
-        if len(yaws) > 1 and yaws[0] < np.pi / 2 and yaws[1] > 3 * np.pi / 2:
-            yaws[1] = yaws[1] - 2 * np.pi
-        yaw = np.mean(yaws)
-
-        (closest_lane_id, closest_lane_point_i), blocked_tl_signals = find_closest_lane(
-            lane_center_line[point_idx],
-            yaw,
-            agent_class=ALL_WHEELS_CLASS,
-            k_nearest=15,
-            return_point_i=True,
-            return_blocked_tl_signals=True,
-            intersections_only=True,
         )
-        if not (
-            (lane_id, point_idx) in checked_hard_cases
-            or closest_lane_id == lane_id
-            and point_idx == closest_lane_point_i
-        ):
-            raise AssertionError(
-                f"closest_lane_id: {closest_lane_id}[{closest_lane_point_i}], (true lane_id: {lane_id}[{point_idx}])"
+        # the master intersection kd trees contain all the intersection lanes within the margin,
+        # larger matching radii are queried from the kd trees of all intersections directly
+        is_master_index_used = max_dist_m < MASTER_INTERSECTION_INDEX_MARGIN_M
+        set_candidates(
+            region_agents, master_intersection_idx if is_master_index_used else None
+        )
+        if is_master_index_used and not use_grid:
+            set_candidates(
+                region_agents[
+                    candidate_distances[region_agents, -1]
+                    > MASTER_INTERSECTION_INDEX_MARGIN_M - max_dist_m
+                ],
+                None,
             )
-        blocked_set_so_far.update(blocked_tl_signals)
-        lane_point_2_blocked_lanes_set[(lane_id, point_idx)] = deepcopy(
-            blocked_set_so_far
+
+    closest_lane_candidate_i, is_matched = select_closest_lane_candidates(
+        candidate_distances,
+        candidate_lane_indices,
+        candidate_point_indices,
+        yaws,
+        max_dist_m,
+        too_close_insensitivity_m,
+        min_cos_dist_threshold,
+    )
+    agent_range = np.arange(n_agents)
+    closest_candidate_i = np.maximum(closest_lane_candidate_i, 0)
+    lane_indices = np.where(
+        is_matched, candidate_lane_indices[agent_range, closest_candidate_i], -1
+    )
+    lane_point_indices = np.where(
+        is_matched, candidate_point_indices[agent_range, closest_candidate_i], -1
+    )
+    if not return_blocked_tl_signals:
+        return lane_indices, lane_point_indices
+
+    if lane_point_blocked_signals is not None:
+        return (
+            lane_indices,
+            lane_point_indices,
+            get_precomputed_blocked_signals(
+                lane_indices, lane_point_indices, lane_point_blocked_signals
+            ),
+        )
+
+    blocked_signals_list = [None for _ in range(n_agents)]
+    lane_lens = (
+        lanes_center_line_offsets[candidate_lane_indices + 1]
+        - lanes_center_line_offsets[candidate_lane_indices]
+    )
+    is_blocked_candidate = (
+        candidate_distances
+        < candidate_distances[agent_range, closest_candidate_i][:, np.newaxis]
+        + blocked_dist_threshold_m
+    ) & ~is_end_of_maneuver_lane(candidate_point_indices, lane_lens)
+    candidate_exit_signals = lane_idx_2_exit_tl_signal_idx[candidate_lane_indices]
+    for agent_i in np.flatnonzero(is_matched).tolist():
+        # to avoid blocking its own tl:
+        tl_signal_idx_closest_lane = lane_idx_2_exit_tl_signal_idx[
+            lane_indices[agent_i]
+        ]
+        if tl_signal_idx_closest_lane < 0:
+            blocked_signals_list[agent_i] = set()
+            continue
+        agent_exit_signals = candidate_exit_signals[agent_i][
+            is_blocked_candidate[agent_i]
+        ]
+        blocked_signals_list[agent_i] = set(
+            agent_exit_signals[
+                (agent_exit_signals >= 0)
+                & (agent_exit_signals != tl_signal_idx_closest_lane)
+            ].tolist()
         )
+    return lane_indices, lane_point_indices, blocked_signals_list
 
 
-def get_info_per_related_lanes(frame_sample: Dict):
-    timestamp = datetime.fromtimestamp(frame_sample["timestamp"] / 10 ** 9).astimezone(
-        timezone("US/Pacific")
+def get_track_lane_candidates(
+    coords: np.ndarray,
+    track_lane_indices: np.ndarray,
+    lane_masks: np.ndarray,
+    agent_mask_rows: np.ndarray,
+):
+    """
+    Nearest points of the previous lanes of the agents and of their successors and left/right neighbours,
+    in the candidates format of select_closest_lane_candidates (padded with infinite distances).
+
+    Args:
+        coords (np.ndarray): (N, 2) agent centroids
+        track_lane_indices (np.ndarray): previous lane indices of the agents
+        lane_masks (np.ndarray): (M, len(lane_ids_all)) masks of the lanes of the kd trees of the agents
+        agent_mask_rows (np.ndarray): per agent, the row of lane_masks with the lanes allowed for the agent
+    """
+    successor_neighbour_indices, source_positions = expand_csr(
+        *lane_graph.get_csr(("forward", "left", "right")), track_lane_indices
+    )
+    lane_indices = np.concatenate(
+        [track_lane_indices, successor_neighbour_indices]
+    ).astype(np.int64)
+    source_positions = np.concatenate(
+        [np.arange(len(track_lane_indices)), source_positions]
+    )
+    is_allowed = lane_masks[agent_mask_rows[source_positions], lane_indices]
+    pair_keys = np.unique(
+        source_positions[is_allowed] * len(lane_ids_all) + lane_indices[is_allowed]
+    )
+    source_positions, lane_indices = (
+        pair_keys // len(lane_ids_all),
+        pair_keys % len(lane_ids_all),
     )
+
+    # the nearest point of each lane, the lower point index first for equidistant points (as in query_kd_tree)
+    point_indices, pair_positions = expand_csr(
+        lanes_center_line_offsets,
+        np.arange(len(lanes_center_line_points)),
+        lane_indices,
+    )
+    point_diffs = (
+        lanes_center_line_points[point_indices]
+        - coords[source_positions[pair_positions]]
+    )
+    point_distances = np.sqrt(point_diffs[:, 0] ** 2 + point_diffs[:, 1] ** 2)
+    order = np.lexsort((point_indices, point_distances, pair_positions))
+    _, nearest_positions = np.unique(pair_positions[order], return_index=True)
+    nearest_points = point_indices[order][nearest_positions]
+    nearest_distances = point_distances[order][nearest_positions]
+
+    order = np.lexsort((nearest_points, nearest_distances, source_positions))
+    source_positions = source_positions[order]
+    ranks = np.arange(len(source_positions)) - np.searchsorted(
+        source_positions, source_positions
+    )
+    n_candidates = max(int(ranks.max()) + 1 if len(ranks) else 0, 1)
+    candidate_distances = np.full((len(coords), n_candidates), np.inf)
+    candidate_lane_indices = np.zeros((len(coords), n_candidates), dtype=np.int64)
+    candidate_point_indices = np.zeros((len(coords), n_candidates), dtype=np.int64)
+    candidate_distances[source_positions, ranks] = nearest_distances[order]
+    candidate_lane_indices[source_positions, ranks] = lane_indices[order]
+    candidate_point_indices[source_positions, ranks] = (
+        nearest_points[order] - lanes_center_line_offsets[lane_indices[order]]
+    )
+    return candidate_distances, candidate_lane_indices, candidate_point_indices
+
+
+class TrackLaneMatcher:
+    """
+    Lane matching of the agents of consecutive frames of a scene, agents mostly stay on their lane or move to
+    a successor/neighbour lane: a tracked agent is matched to its previous lane, the lane successors or neighbours
+    if one of them is a valid match (within track_max_dist_m and the orientation threshold, scored as in
+    find_closest_lane), and with find_closest_lanes otherwise.
+    The result can differ from find_closest_lanes (e.g. when a lane not adjacent to the previous one is closer),
+    validation_rate of the tracked matches are recomputed with find_closest_lanes to count such mismatches.
+    Strict mode returns the find_closest_lanes results of all agents, the tracked lanes are then looked up
+    for the validated agents only (none without validation, i.e. the cost of find_closest_lanes).
+    """
+
+    def __init__(
+        self,
+        strict: bool = True,
+        track_max_dist_m: float = 4.0,
+        validation_rate: float = 0.01,
+        seed: int = None,
+        **matching_kwargs,
+    ):
+        """
+        Args:
+            strict (bool): whether to return the find_closest_lanes results
+            track_max_dist_m (float): matching radius of the tracked lanes (capped by max_dist_m), a larger max_dist_m
+                of the lane search would keep the agents on their previous lanes
+            validation_rate (float): share of the tracked matches (of the tracked agents in strict mode)
+                recomputed with find_closest_lanes
+            seed (int): seed of the sampling for the validation
+            matching_kwargs: find_closest_lanes arguments, the tracking is not used for the blocked signals
+                computed from the candidates (return_blocked_tl_signals without lane_point_blocked_signals)
+        """
+        self.strict = strict
+        self.track_max_dist_m = track_max_dist_m
+        self.validation_rate = validation_rate
+        self.rng = np.random.default_rng(seed)
+        self.matching_kwargs = matching_kwargs
+        self.scene_idx = None
+        self.track_id_2_lane_idx = dict()
+        self.hits, self.misses = 0, 0
+        self.validations, self.mismatches = 0, 0
+
+    def get_stats(self) -> Dict:
+        # hits and misses of the tracked lanes lookups, the agents without a track are searched without a lookup
+        n_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "validations": self.validations,
+            "mismatches": self.mismatches,
+            "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+        }
+
+    def match(
+        self,
+        scene_idx: int,
+        track_ids: Sequence[int],
+        coords: np.ndarray,
+        yaws: Sequence[float],
+        agent_classes: Union[int, Sequence[int]],
+        master_intersection_idx: int = None,
+    ):
+        """
+        Args:
+            scene_idx (int): scene of the frame, the tracks are reset when the scene changes (None: no tracking)
+            track_ids (Sequence[int]): agent track ids
+            coords, yaws, agent_classes, master_intersection_idx: as in find_closest_lanes
+
+        Returns:
+            same as find_closest_lanes
+        """
+        if scene_idx is None or scene_idx != self.scene_idx:
+            self.scene_idx = scene_idx
+            self.track_id_2_lane_idx = dict()
+        n_agents = len(yaws)
+        coords = np.asarray(coords).reshape(n_agents, 2)
+        agent_classes = np.broadcast_to(agent_classes, (n_agents,))
+        kwargs = self.matching_kwargs
+        return_blocked_tl_signals = kwargs.get("return_blocked_tl_signals", False)
+        blocked_signals_bitmasks = kwargs.get("lane_point_blocked_signals")
+        lane_indices = np.full(n_agents, -1, dtype=np.int64)
+        lane_point_indices = np.full(n_agents, -1, dtype=np.int64)
+        blocked_signals_list = [None for _ in range(n_agents)]
+        is_found = np.zeros(n_agents, dtype=bool)
+        is_validated = np.zeros(n_agents, dtype=bool)
+
+        is_tracking_used = (
+            not return_blocked_tl_signals or blocked_signals_bitmasks is not None
+        ) and (not self.strict or self.validation_rate > 0)
+        if is_tracking_used:
+            if master_intersection_idx is None:
+                is_in_region = np.ones(n_agents, dtype=bool)
+            else:
+                is_in_region = get_master_intersection_region_mask(
+                    coords, master_intersection_idx, kwargs.get("max_dist_m", 4.0)
+                )
+            tracked_agents = np.array(
+                [
+                    agent_i
+                    for agent_i, track_id in enumerate(track_ids)
+                    if track_id in self.track_id_2_lane_idx and is_in_region[agent_i]
+                ],
+                dtype=np.int64,
+            )
+            if self.strict:
+                # the tracked lanes are looked up for the validated agents only
+                tracked_agents = tracked_agents[
+                    self.rng.random(len(tracked_agents)) < self.validation_rate
+                ]
+        else:
+            tracked_agents = np.zeros(0, dtype=np.int64)
+        if len(tracked_agents):
+            tree_id_2_mask_row, lane_masks, agent_mask_rows = dict(), [], []
+            for agent_i in tracked_agents.tolist():
+                kd_tree_, kd_idx_map_ = get_kd_tree_and_idx_map_for_agent(
+                    coords[agent_i],
+                    agent_classes[agent_i],
+                    kwargs.get("intersections_only", False),
+                    master_intersection_idx=master_intersection_idx,
+                )
+                if id(kd_tree_) not in tree_id_2_mask_row:
+                    tree_id_2_mask_row[id(kd_tree_)] = len(lane_masks)
+                    lane_masks.append(kd_idx_map_.get_lane_mask())
+                agent_mask_rows.append(tree_id_2_mask_row[id(kd_tree_)])
+            (
+                candidate_distances,
+                candidate_lane_indices,
+                candidate_point_indices,
+            ) = get_track_lane_candidates(
+                coords[tracked_agents],
+                np.array(
+                    [
+                        self.track_id_2_lane_idx[track_ids[i]]
+                        for i in tracked_agents.tolist()
+                    ],
+                    dtype=np.int64,
+                ),
+                np.stack(lane_masks),
+                np.array(agent_mask_rows, dtype=np.int64),
+            )
+            closest_lane_candidate_i, is_matched = select_closest_lane_candidates(
+                candidate_distances,
+                candidate_lane_indices,
+                candidate_point_indices,
+                [yaws[i] for i in tracked_agents.tolist()],
+                min(self.track_max_dist_m, kwargs.get("max_dist_m", 4.0)),
+                kwargs.get("too_close_insensitivity_m", 1.3),
+                kwargs.get("min_cos_dist_threshold", np.pi / 2),
+            )
+            hit_rows = np.flatnonzero(is_matched)
+            hit_agents = tracked_agents[hit_rows]
+            lane_indices[hit_agents] = candidate_lane_indices[
+                hit_rows, closest_lane_candidate_i[hit_rows]
+            ]
+            lane_point_indices[hit_agents] = candidate_point_indices[
+                hit_rows, closest_lane_candidate_i[hit_rows]
+            ]
+            is_found[hit_agents] = True
+            if self.strict:
+                is_validated[hit_agents] = True
+            elif self.validation_rate > 0:
+                is_validated[hit_agents] = (
+                    self.rng.random(len(hit_agents)) < self.validation_rate
+                )
+            self.hits += len(hit_agents)
+            self.misses += len(tracked_agents) - len(hit_agents)
+            self.validations += int(is_validated.sum())
+
+        if self.strict:
+            search_agents = np.arange(n_agents)
+        else:
+            search_agents = np.flatnonzero(~is_found | is_validated)
+        if len(search_agents):
+            search_results = find_closest_lanes(
+                coords[search_agents],
+                [yaws[i] for i in search_agents.tolist()],
+                agent_classes[search_agents],
+                master_intersection_idx=master_intersection_idx,
+                **kwargs,
+            )
+            n_mismatches = int(
+                np.sum(
+                    is_validated[search_agents]
+                    & (
+                        (search_results[0] != lane_indices[search_agents])
+                        | (search_results[1] != lane_point_indices[search_agents])
+                    )
+                )
+            )
+            if n_mismatches:
+                self.mismatches += n_mismatches
+                logger.warning(
+                    f"Scene {scene_idx}: {n_mismatches} tracked lanes differ from find_closest_lanes "
+                    f"({self.mismatches} of {self.validations} validated so far, "
+                    f"{'the find_closest_lanes results are used' if self.strict else 'the tracked lanes are used'})"
+                )
+            # the validated tracked matches are kept unless strict
+            is_result_used = (
+                np.ones(len(search_agents), dtype=bool)
+                if self.strict
+                else ~is_found[search_agents]
+            )
+            result_agents = search_agents[is_result_used]
+            lane_indices[result_agents] = search_results[0][is_result_used]
+            lane_point_indices[result_agents] = search_results[1][is_result_used]
+            if return_blocked_tl_signals and blocked_signals_bitmasks is None:
+                for agent_i, blocked_signals in zip(
+                    search_agents.tolist(), search_results[2]
+                ):
+                    blocked_signals_list[agent_i] = blocked_signals
+
+        for track_id, lane_idx in zip(track_ids, lane_indices.tolist()):
+            if lane_idx >= 0:
+                self.track_id_2_lane_idx[track_id] = lane_idx
+            else:
+                self.track_id_2_lane_idx.pop(track_id, None)
+        if not return_blocked_tl_signals:
+            return lane_indices, lane_point_indices
+        if blocked_signals_bitmasks is not None:
+            blocked_signals_list = get_precomputed_blocked_signals(
+                lane_indices, lane_point_indices, blocked_signals_bitmasks
+            )
+        return lane_indices, lane_point_indices, blocked_signals_list
+
+
+class LaneMatchCache:
+    """
+    Bounded LRU memo of find_closest_lane keyed by the location and yaw quantized to position_step_m and yaw_step_rad,
+    the agent class and the other find_closest_lane arguments. Repeated queries of stopped vehicles
+    (parked cars, queues at red lights, ego stopped) are then answered without the kd tree search.
+    A hit returns the result of the first query of the quantization cell, which can differ from the exact result
+    near lane boundaries, validation_rate of the hits are recomputed to count such mismatches.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        position_step_m: float = 0.1,
+        yaw_step_rad: float = 0.01,
+        validation_rate: float = 0.0,
+        seed: int = None,
+    ):
+        """
+        Args:
+            max_size (int): max number of the memoized results, the least recently used are evicted (0: no memo)
+            position_step_m (float): quantization step of the location coordinates
+            yaw_step_rad (float): quantization step of the yaw
+            validation_rate (float): share of the hits recomputed with find_closest_lane
+            seed (int): seed of the hits sampling for the validation
+        """
+        self.max_size = max_size
+        self.position_step_m = position_step_m
+        self.yaw_step_rad = yaw_step_rad
+        self.validation_rate = validation_rate
+        self.rng = np.random.default_rng(seed)
+        self.key_2_result = OrderedDict()
+        self.hits, self.misses, self.evictions = 0, 0, 0
+        self.validations, self.validation_mismatches = 0, 0
+
+    def get_stats(self) -> Dict:
+        n_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "validations": self.validations,
+            "validation_mismatches": self.validation_mismatches,
+            "hit_rate": self.hits / n_lookups if n_lookups else 0.0,
+        }
+
+    def get_key(self, coord: np.ndarray, yaw: float, agent_class: int, kwargs: Dict):
+        # unhashable arguments (e.g. lane_point_blocked_signals) are keyed by the object identity
+        kwargs_key = tuple(
+            (
+                name,
+                value
+                if isinstance(value, (int, float, bool, type(None)))
+                else id(value),
+            )
+            for name, value in sorted(kwargs.items())
+        )
+        return (
+            int(round(float(coord[0]) / self.position_step_m)),
+            int(round(float(coord[1]) / self.position_step_m)),
+            int(round(float(yaw) / self.yaw_step_rad)),
+            int(agent_class),
+            kwargs_key,
+        )
+
+    def find_closest_lane(self, coord, yaw, agent_class, **kwargs):
+        """
+        Args:
+            coord, yaw, agent_class, kwargs: as in find_closest_lane (vis is not memoized)
+
+        Returns:
+            same as find_closest_lane, the memoized results are shared between the hits and must not be modified
+        """
+        if self.max_size <= 0 or kwargs.get("vis", False):
+            return find_closest_lane(coord, yaw, agent_class, **kwargs)
+        key = self.get_key(coord, yaw, agent_class, kwargs)
+        if key in self.key_2_result:
+            self.hits += 1
+            self.key_2_result.move_to_end(key)
+            result = self.key_2_result[key]
+            if self.validation_rate > 0 and self.rng.random() < self.validation_rate:
+                self.validations += 1
+                self.validation_mismatches += (
+                    find_closest_lane(coord, yaw, agent_class, **kwargs) != result
+                )
+            return result
+        self.misses += 1
+        result = find_closest_lane(coord, yaw, agent_class, **kwargs)
+        self.key_2_result[key] = result
+        if len(self.key_2_result) > self.max_size:
+            self.key_2_result.popitem(last=False)
+            self.evictions += 1
+        return result
+
+
+def get_info_per_related_lanes(frame_sample: Dict):
+    timestamp = frame_sample["timestamp"]
     ego_centroid = frame_sample["ego_centroid"]
     ego_yaw = frame_sample["ego_yaw"]
-    ego_closest_lane_id = find_closest_lane(
+    ego_closest_lane_id = lane_match_cache.find_closest_lane(
         ego_centroid, ego_yaw, agent_class=ALL_WHEELS_CLASS, intersections_only=True
     )
     intersection_related_lanes = (
@@ -1391,32 +1858,44 @@ def get_info_per_related_lanes(frame_sample: Dict):
     ]
     ego_speed = frame_sample["ego_speed"]
     if ego_speed is not None:
+        # the track id -1 is not used by the agents
         agents_with_wheels.append(
-            ((ego_centroid, None, ego_yaw, ego_speed, None, None), ALL_WHEELS_CLASS)
+            ((ego_centroid, None, ego_yaw, ego_speed, -1, None), ALL_WHEELS_CLASS)
         )
         intersection_related_lanes.add(ego_closest_lane_id)
-    for agent, agent_class in agents_with_wheels:
-        agent_speed = np.hypot(*agent[-3])
-        agent_centroid = agent[0]
-        agent_yaw = agent[2]
-        find_closest_result = find_closest_lane(
-            agent_centroid,
-            agent_yaw,
-            agent_class,
-            lane_point_2_blocked_lanes_set=lane_point_2_blocked_lanes_set,
-            return_point_i=True,
-            return_blocked_tl_signals=True,
-            intersections_only=True,
+    # the tl faces are decoded also for the frames without (matchable) agents
+    if len(agents_with_wheels):
+        (
+            agent_lane_indices,
+            agent_lane_point_indices,
+            agent_blocked_tl_signals,
+        ) = intersection_lanes_matcher.match(
+            frame_sample.get("scene_index"),
+            [int(agent[-2]) for agent, _ in agents_with_wheels],
+            np.array([agent[0] for agent, _ in agents_with_wheels]),
+            [agent[2] for agent, _ in agents_with_wheels],
+            [agent_class for _, agent_class in agents_with_wheels],
+            # only the lanes related to the ego lane are used
+            master_intersection_idx=lane_id_2_master_intersection_idx[
+                ego_closest_lane_id
+            ],
         )
-        if find_closest_result is not None:
-            (lane_id, lane_point_i), blocked_tl_signals = find_closest_result
-            lane_len = get_lane_len(lane_id)
-            if not is_end_of_maneuver_lane(lane_point_i, lane_len):
-                lane_completion = lane_point_i / (lane_len - 1)
-                if lane_id in intersection_related_lanes:
-                    lane_2_speeds[lane_id].append(agent_speed)
-                    lane_2_completions[lane_id].append(lane_completion)
-                    lane_2_blocked_tl_signals[lane_id].update(blocked_tl_signals)
+        for (agent, _), lane_idx, lane_point_i, blocked_tl_signals in zip(
+            agents_with_wheels,
+            agent_lane_indices.tolist(),
+            agent_lane_point_indices.tolist(),
+            agent_blocked_tl_signals,
+        ):
+            agent_speed = np.hypot(*agent[-3])
+            if lane_idx >= 0:
+                lane_id = lane_ids_all[lane_idx]
+                lane_len = get_lane_len(lane_id)
+                if not is_end_of_maneuver_lane(lane_point_i, lane_len):
+                    lane_completion = lane_point_i / (lane_len - 1)
+                    if lane_id in intersection_related_lanes:
+                        lane_2_speeds[lane_id].append(agent_speed)
+                        lane_2_completions[lane_id].append(lane_completion)
+                        lane_2_blocked_tl_signals[lane_id].update(blocked_tl_signals)
     lane_results = []
     for lane_id, speeds in lane_2_speeds.items():
         lane_results.append(
@@ -1431,24 +1910,15 @@ def get_info_per_related_lanes(frame_sample: Dict):
         )
 
     # tl's
-    tl_results = set()
     tl_faces = filter_tl_faces_by_status(frame_sample["tl_faces"], "ACTIVE")
-    for tl_face_id, tl_light_id, _ in tl_faces:
-        tl_color = proto_API.get_traffic_face_colour(tl_face_id)
-        if tl_color != "unknown":
-            for tl_signal_idx in tl_face_id_2_tl_signal_indices[tl_face_id]:
-                for tl_controlled_lane in tl_signal_idx_2_controlled_lanes[
-                    tl_signal_idx
-                ]:
-                    if tl_controlled_lane in intersection_related_lanes:
-                        tl_color_code = (
-                            TL_GREEN_COLOR
-                            if tl_color == "green"
-                            else TL_RED_COLOR
-                            if tl_color == "red"
-                            else TL_YELLOW_COLOR
-                        )
-                        tl_results.add((tl_light_id, tl_signal_idx, tl_color_code))
+    tl_results = traffic_face_table.get_tl_events(
+        tl_faces["face_id"],
+        tl_faces["traffic_light_id"],
+        traffic_face_table.get_related_signals_mask(
+            lane_id_2_idx_all[ego_closest_lane_id],
+            include_lane_itself=ego_closest_lane_id in intersection_related_lanes,
+        ),
+    )
 
     if len(lane_results) or len(tl_results):
         master_intersection_idx = lane_id_2_master_intersection_idx[ego_closest_lane_id]
@@ -1585,7 +2055,7 @@ def get_accumulated_tl_signals(
     distdiff_max_m: float = 2.0,
     max_buffer_age_sec: float = 15,
 ):
-    timediff_sec = (timestamp - timestamp_prev).total_seconds()
+    timediff_sec = (timestamp - timestamp_prev) / NS_PER_SEC
     if master_intersection_idx != master_intersection_idx_prev:
         tl_signals_buffer = dict()
     elif timediff_sec > timediff_max_sec:
@@ -1604,20 +2074,16 @@ def get_accumulated_tl_signals(
 
     current_buffer_items = list(tl_signals_buffer.items())
     for tl_sig_idx, (timestamp_record, color_cod) in current_buffer_items:
-        if (timestamp - timestamp_record).total_seconds() > max_buffer_age_sec:
+        if (timestamp - timestamp_record) / NS_PER_SEC > max_buffer_age_sec:
             del tl_signals_buffer[tl_sig_idx]
     return tl_signals_buffer
 
 
-def tl_seq_collate_fn(
-    frames_batch: List, timestamp_min: datetime, timestamp_max: datetime
-):
+def tl_seq_collate_fn(frames_batch: List, timestamp_min: int, timestamp_max: int):
+    # ns timestamps bounds, see timestamps.date_2_timestamp_ns
     batch_result = []
     for frame in frames_batch:
-        timestamp = datetime.fromtimestamp(frame["timestamp"] / 10 ** 9).astimezone(
-            timezone("US/Pacific")
-        )
-        if timestamp_min < timestamp <= timestamp_max:
+        if timestamp_min < frame["timestamp"] <= timestamp_max:
             info_related_lanes = get_info_per_related_lanes(frame)
 
             if len(info_related_lanes):
@@ -1700,7 +2166,7 @@ def get_tl_events_df(dataloader_frames: DataLoader):
 def compute_tl_signal_classes(tl_events_df: pd.DataFrame):
     tl_signals_buffer = dict()
     timestamp_prev, ego_centroid_prev = (
-        datetime(1970, 1, 1).astimezone(timezone("US/Pacific")),
+        0,
         np.array([-9999, -9999]),
     )
     master_intersection_idx_prev = -9999
@@ -1738,7 +2204,7 @@ def compute_time_to_tl_change(
         dict()
     )  # tl_sig_idx -> (event_timestamp, new_event_color_code)
     timestamp_next, ego_centroid_next = (
-        datetime(2050, 1, 1).astimezone(timezone("US/Pacific")),
+        datetime_2_timestamp_ns(datetime(2050, 1, 1)),
         np.array([-9999, -9999]),
     )
     master_intersection_idx_next = -9999
@@ -1762,7 +2228,7 @@ def compute_time_to_tl_change(
                 )
                 active_next_tl_signals[tl_signal_idx] = color_code
             the_same_color_duration = dict()
-        elif (timestamp_next - row["timestamp"]).total_seconds() > timediff_max_sec:
+        elif (timestamp_next - row["timestamp"]) / NS_PER_SEC > timediff_max_sec:
             active_next_tl_signals = dict()
             relevant_tl_signal_change_event = dict()
             for tl_signal_idx, color_code in row["tl_signal_classes"].items():
@@ -1810,7 +2276,7 @@ def compute_time_to_tl_change(
             # if the current tl color is the same, as in the future change event, ...
             if event_color_code != row["tl_signal_classes"][tl_signal_idx]:
                 time_to_tl_change_current[tl_signal_idx] = np.clip(
-                    (event_timestamp - row["timestamp"]).total_seconds(),
+                    (event_timestamp - row["timestamp"]) / NS_PER_SEC,
                     0,
                     time_to_event_ub,
                 )
@@ -1828,7 +2294,7 @@ def compute_time_to_tl_change(
                         the_same_color_duration[tl_signal_idx] = row["timestamp"]
                     elif (
                         the_same_color_duration[tl_signal_idx] - row["timestamp"]
-                    ).total_seconds() >= time_to_event_ub:
+                    ) / NS_PER_SEC >= time_to_event_ub:
                         time_to_tl_change_current[tl_signal_idx] = time_to_event_ub
                         if verbose:
                             print("too long the same color: TTE at least 5.01")
@@ -1839,7 +2305,7 @@ def compute_time_to_tl_change(
                         active_next_tl_signals[tl_signal_idx],
                     )
                     time_to_tl_change_current[tl_signal_idx] = np.clip(
-                        (timestamp_next - row["timestamp"]).total_seconds(),
+                        (timestamp_next - row["timestamp"]) / NS_PER_SEC,
                         0,
                         time_to_event_ub,
                     )
@@ -1905,51 +2371,9 @@ def get_next_car_dist_speed(
         agent_centroid[0] - next_agent_centroid[0],
         agent_centroid[1] - next_agent_centroid[1],
     )
-    cos_between_yaws = get_cos_between_yaws(agent_yaw, next_agent_yaw)
-    closing_speed = agent_speed - cos_between_yaws * next_agent_speed
-    return dist, closing_speed
-
-
-semantic_map_path = dm.require(semantic_map_key)
-proto_API = MapAPI(semantic_map_path, world_to_ecef)
-
-######################
-# getting yield sets
-lane_id_2_yield_lanes = defaultdict(set)
-min_yield_points = 10
-
-lane_id_2_yield_lanes_init = dict()
-for lane_id in lane_id_2_idx:
-    lane_ids_to_yield = proto_API.get_lanes_to_yield(lane_id)
-    if len(lane_ids_to_yield):
-        lane_id_2_yield_lanes_init[lane_id] = lane_ids_to_yield
-lane_id_2_yield_lanes_init.update(red_turn_lane_2_yield_lanes)
-
-for lane_id, lane_ids_to_yield in lane_id_2_yield_lanes_init.items():
-    if (
-        lane_id in exit_lane_id_2_tl_signal_idx
-    ):  # focusing on the most common case of traffic lights being on; 95.7% of lanes with lanes to yield are not tl exit lanes
-        continue
-    for lane_id_to_yield in lane_ids_to_yield:
-        queue = deque()
-        queue.append((lane_id_to_yield, get_lane_len(lane_id_to_yield)))
-        while len(queue):
-            lane_id_to_yield_, yield_points_current = queue.popleft()
-            lane_id_2_yield_lanes[lane_id].add(lane_id_to_yield_)
-            for prev_lane in get_lane_predecessors(lane_id_to_yield_):
-                prev_lane_len = get_lane_len(prev_lane)
-                if yield_points_current < min_yield_points:
-                    queue.append((prev_lane, yield_points_current + prev_lane_len))
-
-##########################
-# traffic light signals
-tl_signal_idx_2_master_intersection_idx = dict()
-for (
-    intersection_i,
-    tl_signal_indices,
-) in master_intersection_idx_2_tl_signal_indices.items():
-    for tl_signal_i in tl_signal_indices:
-        tl_signal_idx_2_master_intersection_idx[tl_signal_i] = intersection_i
+    cos_between_yaws = get_cos_between_yaws(agent_yaw, next_agent_yaw)
+    closing_speed = agent_speed - cos_between_yaws * next_agent_speed
+    return dist, closing_speed
 
 
 def get_traffic_light_predictions_per_intersection(tl_predictions_base_name):
@@ -1969,29 +2393,20 @@ def get_traffic_light_predictions_per_intersection(tl_predictions_base_name):
     return intersection_2_predictions
 
 
-######################
-# precomputing speed limits per lanes
-lane_id_2_speed_limit = {
-    lane_id: proto_API.get_speed_limit(lane_id) for lane_id in lane_id_2_idx
-}
-
-
 def get_agent_lanes_info(
     frame_sample,
     intersection_2_predictions,
     min_lane_points_forward=10,
     max_speed_limit=18,
 ):
-    timestamp = frame_sample[
-        "timestamp"
-    ]  # datetime.fromtimestamp(frame_sample['timestamp'] / 10 ** 9).astimezone(timezone('US/Pacific'))
+    timestamp = frame_sample["timestamp"]
     scene_idx = frame_sample["scene_index"]
     state_idx = frame_sample["state_index"]
 
     # for optimization purposes considering only cars belonging to the same intersection as ego sdv
     ego_centroid = frame_sample["ego_centroid"]
     ego_yaw = frame_sample["ego_yaw"]
-    ego_math_result = find_closest_lane(
+    ego_math_result = lane_match_cache.find_closest_lane(
         ego_centroid, ego_yaw, agent_class=ALL_WHEELS_CLASS, return_point_i=True
     )
 
@@ -2030,27 +2445,29 @@ def get_agent_lanes_info(
 
     track_speed_yaw_lane_point_list = []
     track_speed_yaw_lane_point_list_final = []
-    for agent in frame_sample["agents"]:
+    agent_lane_indices, agent_lane_point_indices = agent_lanes_matcher.match(
+        scene_idx,
+        [int(agent[-2]) for agent in frame_sample["agents"]],
+        np.array([agent[0] for agent in frame_sample["agents"]]),
+        [agent[2] for agent in frame_sample["agents"]],
+        ALL_WHEELS_CLASS,
+    )
+    for agent, agent_lane_idx, agent_lane_point_i in zip(
+        frame_sample["agents"],
+        agent_lane_indices.tolist(),
+        agent_lane_point_indices.tolist(),
+    ):
         agent_track_id = agent[-2]
         agent_speed = np.hypot(*agent[-3])
         agent_centroid = agent[0]
         agent_yaw = agent[2]
-        find_closest_result = find_closest_lane(
-            agent_centroid,
-            agent_yaw,
-            ALL_WHEELS_CLASS,
-            return_point_i=True,
-            return_blocked_tl_signals=False,
-            intersections_only=False,
-            max_dist_m=100,
-        )
         matched_map_segments = match_point_2_map_segment(*agent_centroid)
         if len(matched_map_segments):
             map_segment_group = matched_map_segments[0]
         else:
             map_segment_group = NUM_MAP_SEGMENTS
-        if find_closest_result is not None:
-            lane_id, lane_point_i = find_closest_result
+        if agent_lane_idx >= 0:
+            lane_id, lane_point_i = lane_ids_all[agent_lane_idx], agent_lane_point_i
             lane_2_cars[lane_id].append(
                 (lane_point_i, agent_centroid, agent_speed, agent_yaw)
             )
@@ -2160,48 +2577,31 @@ def get_agent_lanes_info(
             )
         else:
             lane_points_dist_start = get_lane_len(lane_id) - lane_point_i
-            queue = deque()
-            queue.append((lane_id, lane_points_dist_start))
-            next_car_found = False
-            while len(queue) and not next_car_found:
-                last_checked_lane, lane_points_dist_up_now = queue.popleft()
-                for next_lane in get_lane_successors(last_checked_lane):
-                    if next_lane in lane_2_cars:
-                        (
-                            next_car_lane_point_i,
-                            next_agent_centroid,
-                            next_agent_speed,
-                            next_agent_yaw,
-                        ) = lane_2_cars[next_lane][0]
-                        lane_points_dist = (
-                            lane_points_dist_up_now + next_car_lane_point_i
-                        )
-                        dist, closing_speed = get_next_car_dist_speed(
-                            agent_centroid,
-                            agent_speed,
-                            agent_yaw,
-                            next_agent_centroid,
-                            next_agent_speed,
-                            next_agent_yaw,
-                        )
-                        track_speed_yaw_lane_point_list_final[-1].extend(
-                            (lane_points_dist, dist, closing_speed)
-                        )
-                        next_car_found = True
-                        break  # limiting myself to one next car (not aggregating over all paths forward)
-                    else:
-                        next_lane_len = get_lane_len(next_lane)
-                        if (
-                            lane_points_dist_up_now + next_lane_len
-                            < min_lane_points_forward
-                        ):
-                            queue.append(
-                                (
-                                    next_lane_len,
-                                    lane_points_dist_up_now + next_lane_len
-                                    < min_lane_points_forward,
-                                )
-                            )
+            # the next car is searched on the direct successors only (the models were trained with these features)
+            for next_lane_idx in lane_graph.get_neighbours(
+                lane_id_2_idx_all[lane_id], "forward"
+            ).tolist():
+                next_lane = lane_ids_all[next_lane_idx]
+                if next_lane in lane_2_cars:
+                    (
+                        next_car_lane_point_i,
+                        next_agent_centroid,
+                        next_agent_speed,
+                        next_agent_yaw,
+                    ) = lane_2_cars[next_lane][0]
+                    lane_points_dist = lane_points_dist_start + next_car_lane_point_i
+                    dist, closing_speed = get_next_car_dist_speed(
+                        agent_centroid,
+                        agent_speed,
+                        agent_yaw,
+                        next_agent_centroid,
+                        next_agent_speed,
+                        next_agent_yaw,
+                    )
+                    track_speed_yaw_lane_point_list_final[-1].extend(
+                        (lane_points_dist, dist, closing_speed)
+                    )
+                    break  # limiting myself to one next car (not aggregating over all paths forward)
 
         if len(track_speed_yaw_lane_point_list_final[-1]) == 15:
             track_speed_yaw_lane_point_list_final[-1].extend(
@@ -2264,15 +2664,12 @@ LANE_SEQ_DTYPE = [
 def agent_lanes_collate_fn(
     frames_batch,
     intersection_2_predictions,
-    timestamp_min=datetime(1970, 11, 20).astimezone(timezone("US/Pacific")),
-    timestamp_max=datetime(2021, 11, 20).astimezone(timezone("US/Pacific")),
+    timestamp_min=datetime_2_timestamp_ns(datetime(1970, 11, 20)),
+    timestamp_max=datetime_2_timestamp_ns(datetime(2021, 11, 20)),
 ):
     batch_result = []
     for frame in frames_batch:
-        timestamp = datetime.fromtimestamp(frame["timestamp"] / 10 ** 9).astimezone(
-            timezone("US/Pacific")
-        )
-        if timestamp_min < timestamp <= timestamp_max:
+        if timestamp_min < frame["timestamp"] <= timestamp_max:
             agent_lanes_info = get_agent_lanes_info(frame, intersection_2_predictions)
             batch_result.extend(agent_lanes_info)
     return np.array([tuple(x) for x in batch_result], dtype=LANE_SEQ_DTYPE)
@@ -2289,3 +2686,981 @@ def compute_vocab_indices(agent_lane_df, train_vocab):
     agent_lane_df["lane_vocab_idx"] = agent_lane_df["lane_id"].map(
         lambda lane_id: get_vocab_idx(lane_id)
     )
+
+
+if not is_map_artifact_current(COMPILED_MAP_PATH, compiled_map_key):
+    # the map protobuf, the l5kit datasets and sklearn are needed for compiling only
+    from l5kit.data import LocalDataManager, ChunkedDataset
+    from sklearn.cluster import KMeans
+    from lyft_trajectories.utils.l5kit_modified.map_api import (
+        ELEMENT_KIND_LANE,
+        ELEMENT_KIND_TRAFFIC_CONTROL,
+        MapAPI,
+    )
+    from lyft_trajectories.data_preprocessing.common.lane_processing import (
+        precompute_lane_adjacencies,
+        precompute_map_elements,
+        world_to_ecef,
+    )
+
+    dm = LocalDataManager(None)
+
+    # Checking junction info from the semantic map
+    proto_API = MapAPI(SEMANTIC_MAP_PATH, world_to_ecef)
+
+    lanes_crosswalks = load_or_compute(
+        "lanes_crosswalks",
+        lanes_crosswalks_key,
+        lambda: precompute_map_elements(proto_API, n_jobs=MAP_COMPILE_N_JOBS),
+    )
+
+    # the lane geometry stays in lanes_crosswalks["lanes"] only, the specialized mappings are for the adjacency lists
+    _, lane_id_2_idx_not_bike = get_lane_indices_and_id_mapping(
+        filter_function=lambda x: not proto_API.is_bike_only_lane(x)
+    )
+    _, lane_id_2_idx_bike = get_lane_indices_and_id_mapping(
+        filter_function=lambda x: proto_API.is_bike_only_lane(x)
+    )
+    lane_id_2_idx = {
+        lane_id: i for i, lane_id in enumerate(lanes_crosswalks["lanes"]["ids"])
+    }
+
+    (
+        lane_adj_list_forward_bike,
+        lane_adj_list_backward_bike,
+        lane_adj_list_right_bike,
+        lane_adj_list_left_bike,
+    ) = precompute_lane_adjacencies(lane_id_2_idx_bike, proto_API)
+    (
+        lane_adj_list_forward_not_bike,
+        lane_adj_list_backward_not_bike,
+        lane_adj_list_right_not_bike,
+        lane_adj_list_left_not_bike,
+    ) = precompute_lane_adjacencies(lane_id_2_idx_not_bike, proto_API)
+
+    fix_i_2_junction_bro = dict()
+    red_turn_lane_2_yield_lanes = dict()
+    added_lanes = set()
+
+    lane_id_2_idx_specialized = [lane_id_2_idx_bike, lane_id_2_idx_not_bike]
+    lane_adj_list_forward_specialized = [
+        lane_adj_list_forward_bike,
+        lane_adj_list_forward_not_bike,
+    ]
+    lane_adj_list_backward_specialized = [
+        lane_adj_list_backward_bike,
+        lane_adj_list_backward_not_bike,
+    ]
+    lane_adj_list_left_specialized = [
+        lane_adj_list_left_bike,
+        lane_adj_list_left_not_bike,
+    ]
+    lane_adj_list_right_specialized = [
+        lane_adj_list_right_bike,
+        lane_adj_list_right_not_bike,
+    ]
+    lanes_center_lines = lanes_crosswalks["lanes"]["center_line"]
+    lanes_under_red_turn_fix = [
+        lane_under_red_turn_fix
+        for lane_under_red_turn_fix, _, _, _ in turn_under_red_fixes
+    ]
+
+    for fix_i, turn_under_red_fix in enumerate(turn_under_red_fixes):
+        parent, lanes_active, lane_to_remove, turn_yield_lanes = turn_under_red_fix
+        lane_spec = int(parent in lane_id_2_idx_not_bike)
+        lane_id_2_idx_specialized[lane_spec][f"lane{2 * fix_i}"] = len(
+            lane_adj_list_forward_specialized[lane_spec]
+        )
+        lane_adj_list_forward_specialized[lane_spec].append([lane_to_remove])
+        lane_adj_list_backward_specialized[lane_spec].append([parent])
+        lane_adj_list_left_specialized[lane_spec].append([])
+        lane_adj_list_right_specialized[lane_spec].append([])
+
+        lane_id_2_idx_specialized[lane_spec][f"lane{2 * fix_i + 1}"] = len(
+            lane_adj_list_forward_specialized[lane_spec]
+        )
+        lane_adj_list_forward_specialized[lane_spec].append(lanes_active)
+        lane_adj_list_backward_specialized[lane_spec].append([parent])
+        lane_adj_list_left_specialized[lane_spec].append([])
+        lane_adj_list_right_specialized[lane_spec].append([])
+
+        lane_adj_list_forward_specialized[lane_spec][
+            lane_id_2_idx_specialized[lane_spec][parent]
+        ] = [f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"]
+
+        for lane_id_left in lanes_active:
+            lane_adj_list_backward_specialized[lane_spec][
+                lane_id_2_idx_specialized[lane_spec][lane_id_left]
+            ] = [f"lane{2 * fix_i + 1}"] + [
+                x
+                for x in lane_adj_list_backward_specialized[lane_spec][
+                    lane_id_2_idx_specialized[lane_spec][lane_id_left]
+                ]
+                if x != parent
+            ]
+        lane_adj_list_backward_specialized[lane_spec][
+            lane_id_2_idx_specialized[lane_spec][lane_to_remove]
+        ] = [f"lane{2 * fix_i}"] + [
+            x
+            for x in lane_adj_list_backward_specialized[lane_spec][
+                lane_id_2_idx_specialized[lane_spec][lane_to_remove]
+            ]
+            if x != parent
+        ]
+
+        if len(lanes_center_lines[lane_id_2_idx[lane_to_remove]]) < 4:
+            raise AssertionError
+        if len(lanes_center_lines[lane_id_2_idx[lanes_active[0]]]) < 5:
+            raise AssertionError
+
+        lanes_crosswalks["lanes"]["ids"].extend(
+            [f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"]
+        )
+        added_lanes.update({f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"})
+
+        # last 3 points of parent to be forked
+        parent_center_line = lanes_center_lines[lane_id_2_idx[parent]]
+        init_parent_last_coord = parent_center_line[-1].copy()
+        lanes_center_lines[lane_id_2_idx[parent]] = parent_center_line[
+            : max(1, len(parent_center_line) - 3)
+        ]
+        new_parent_last_coord = lanes_center_lines[lane_id_2_idx[parent]][-1].copy()
+        total_parent_segment_len = np.hypot(
+            new_parent_last_coord[0] - init_parent_last_coord[0],
+            new_parent_last_coord[1] - init_parent_last_coord[1],
+        )
+        # the turn lane to remove
+        directional_point_for_fork = lanes_center_lines[lane_id_2_idx[lane_to_remove]][
+            3
+        ]
+        turn_fork_center_line = get_connecting_coordinates(
+            new_parent_last_coord,
+            directional_point_for_fork,
+            total_dist=total_parent_segment_len,
+        )
+
+        lanes_center_lines.append(turn_fork_center_line)
+        # dummy boarder in order not to break vis
+        lanes_crosswalks["lanes"]["xy_left_"].append(turn_fork_center_line)
+        lanes_crosswalks["lanes"]["xy_right_"].append(turn_fork_center_line)
+
+        # the first lane to leave tl control must be the closest one to the turn-lane
+        directional_point_for_fork = lanes_center_lines[lane_id_2_idx[lanes_active[0]]][
+            4
+        ]
+        new_parent_last_coord = lanes_center_lines[lane_id_2_idx[parent]][-1].copy()
+        straight_center_line = get_connecting_coordinates(
+            new_parent_last_coord,
+            directional_point_for_fork,
+            total_dist=total_parent_segment_len,
+        )
+
+        lanes_center_lines.append(straight_center_line)
+        # dummy boarder in order not to break vis
+        lanes_crosswalks["lanes"]["xy_left_"].append(straight_center_line)
+        lanes_crosswalks["lanes"]["xy_right_"].append(straight_center_line)
+
+        fix_i_2_junction_bro[fix_i] = parent
+        # TODO!: each red_turn_lane has virtual "stop-sign" when the light is red
+        red_turn_lane_2_yield_lanes[f"lane{2 * fix_i}"] = turn_yield_lanes
+
+    lane_ids_all = lanes_crosswalks["lanes"]["ids"]
+    lane_id_2_idx_all = {lane_id: i for i, lane_id in enumerate(lane_ids_all)}
+    # from now on, the lane geometry is read from the concatenated arrays only
+    lanes_center_line_points, lanes_center_line_offsets = concatenate_lines(
+        lanes_center_lines
+    )
+    # the lane matching orientation scores are dot products with these rows
+    lanes_center_line_headings = get_lane_segment_headings(
+        lanes_center_line_points, lanes_center_line_offsets
+    )
+    lanes_xy_left_points, lanes_xy_left_offsets = concatenate_lines(
+        lanes_crosswalks["lanes"]["xy_left_"]
+    )
+    lanes_xy_right_points, lanes_xy_right_offsets = concatenate_lines(
+        lanes_crosswalks["lanes"]["xy_right_"]
+    )
+
+    lane_adj_lists_specialized = {
+        "forward": lane_adj_list_forward_specialized,
+        "backward": lane_adj_list_backward_specialized,
+        "left": lane_adj_list_left_specialized,
+        "right": lane_adj_list_right_specialized,
+    }
+    lane_specs = [int(lane_id in lane_id_2_idx_not_bike) for lane_id in lane_ids_all]
+    lane_graph = LaneGraph.from_adjacency_lists(
+        lane_ids_all,
+        {
+            edge_type: [
+                adj_lists[lane_spec][lane_id_2_idx_specialized[lane_spec][lane_id]]
+                for lane_id, lane_spec in zip(lane_ids_all, lane_specs)
+            ]
+            for edge_type, adj_lists in lane_adj_lists_specialized.items()
+        },
+        lane_lens=np.diff(lanes_center_line_offsets),
+        is_bike=np.array(lane_specs) == 0,
+    )
+
+    kd_scopes = dict()
+    kd_scopes["all"] = get_kd_scope(
+        np.arange(len(lane_ids_all)),
+        np.where(lane_graph.is_bike, KD_FLAG_BIKE, KD_FLAG_NOT_BIKE),
+    )
+    kd_trees_and_idx_maps = get_class_kd_trees_and_idx_maps(kd_scopes["all"])
+    kd_tree, kd_idx_2_lane_id_idx = kd_trees_and_idx_maps[ALL_WHEELS_CLASS]
+    lane_proximity_offsets, lane_proximity_indices = get_lane_proximity_csr(
+        kd_tree, kd_scopes["all"], len(lane_ids_all), LANE_PROXIMITY_DIST_M
+    )
+
+    # SEPARATELY PER EACH MAP PARTITION LEAF ################
+    # the partition depends on the lane geometry only
+    map_partition = MapPartition.from_lane_points(
+        lanes_center_line_points,
+        np.repeat(np.arange(len(lane_ids_all)), np.diff(lanes_center_line_offsets)),
+        MAP_PARTITION_MAX_LEAF_POINTS,
+        MAP_PARTITION_MARGIN_M,
+    )
+    kd_scopes.update(get_map_partition_kd_scopes(map_partition, lane_graph.is_bike))
+    map_partition_leaf_2_kd_trees_and_idx_maps = (
+        get_map_partition_kd_trees_and_idx_maps(kd_scopes, map_partition.n_leaves)
+    )
+
+    tl_control_2_junctions = defaultdict(list)
+    junction_2_tl_controls = defaultdict(list)
+    lane_2_junctions = defaultdict(list)
+    junction_2_lanes = defaultdict(list)
+    for element in proto_API:
+        if MapAPI.is_junction(element):
+            junction_element_id = MapAPI.id_as_str(element.id)
+            traffic_control_elements = (
+                proto_API.get_traffic_control_elements_at_junction(junction_element_id)
+            )
+            junction_2_tl_controls[junction_element_id].extend(traffic_control_elements)
+            for tl_control in traffic_control_elements:
+                tl_control_2_junctions[tl_control].append(junction_element_id)
+
+            lanes_related_to_junction = proto_API.get_all_lanes_at_junction(
+                junction_element_id
+            )
+            for lane in lanes_related_to_junction:
+                junction_2_lanes[junction_element_id].append(lane)
+                lane_2_junctions[lane].append(junction_element_id)
+    # to address potential duplications
+    for lane_id, junctions in lane_2_junctions.items():
+        lane_2_junctions[lane_id] = list(set(junctions))
+    for junction_id, lanes in junction_2_lanes.items():
+        junction_2_lanes[junction_id] = list(set(lanes))
+
+    for fix_i in range(len(turn_under_red_fixes)):
+        junction_neighb = fix_i_2_junction_bro[fix_i]
+        lane_2_junctions[f"lane{2 * fix_i}"] = lane_2_junctions[junction_neighb].copy()
+        lane_2_junctions[f"lane{2 * fix_i + 1}"] = lane_2_junctions[
+            junction_neighb
+        ].copy()
+        for junction_id in lane_2_junctions[junction_neighb]:
+            junction_2_lanes[junction_id].extend(
+                [f"lane{2 * fix_i}", f"lane{2 * fix_i + 1}"]
+            )
+
+    def get_tl_faces_dataset_ids(field_name: str):
+        train_full_zarr = ChunkedDataset(dm.require(TL_FACES_DATASET_PATH)).open()
+        return set(train_full_zarr.tl_faces[field_name])
+
+    traffic_light_ids_all = load_or_compute(
+        "traffic_light_ids_all",
+        traffic_light_ids_key,
+        lambda: get_tl_faces_dataset_ids("traffic_light_id"),
+    )
+    traffic_faces_ids_all = load_or_compute(
+        "traffic_faces_ids_all",
+        traffic_light_ids_key,
+        lambda: get_tl_faces_dataset_ids("face_id"),
+    )
+
+    traffic_light_id_2_coord = dict()
+    tl_ids_without_sem_map_info = []
+    for el_id in traffic_light_ids_all:
+        if el_id in proto_API.ids_to_el:
+            coordinates = proto_API.get_traffic_light_coords(el_id)["xyz"]
+            traffic_light_id_2_coord[el_id] = coordinates[:, :2].mean(axis=0)
+        else:
+            tl_ids_without_sem_map_info.append(el_id)
+
+    for i in range(len(added_lanes_tl_coord_tl_id)):
+        added_tl_id = f"Luda_{i}"
+        added_lanes_tl_coord_tl_id[i].append(added_tl_id)
+        traffic_light_id_2_coord[added_tl_id] = np.array(
+            added_lanes_tl_coord_tl_id[i][1]
+        )
+        traffic_light_ids_all.add(added_tl_id)
+        for lane_id in added_lanes_tl_coord_tl_id[i][0]:
+            tl_control_2_junctions[added_tl_id].extend(lane_2_junctions[lane_id])
+            for junction in lane_2_junctions[lane_id]:
+                junction_2_tl_controls[junction].append(added_tl_id)
+
+    tl_control_2_close_lanes = defaultdict(list)
+    for tl_control, junctions in tl_control_2_junctions.items():
+        if tl_control in traffic_light_ids_all or tl_control in traffic_faces_ids_all:
+            for junction in junctions:
+                tl_control_2_close_lanes[tl_control].extend(junction_2_lanes[junction])
+                # predecessor lanes
+                for junction_lane in junction_2_lanes[junction]:
+                    tl_control_2_close_lanes[tl_control].extend(
+                        get_lane_predecessors(junction_lane)
+                    )
+            tl_control_2_close_lanes[tl_control] = list(
+                set(tl_control_2_close_lanes[tl_control])
+            )
+
+    lane_2_close_tl_controls = defaultdict(list)
+    for tl_control, close_lanes in tl_control_2_close_lanes.items():
+        for lane in close_lanes:
+            lane_2_close_tl_controls[lane].append(tl_control)
+
+    lane_2_tl_related_lanes_wip = defaultdict(set)
+    for lane_id, close_tl_controls in lane_2_close_tl_controls.items():
+        for traffic_control_id in close_tl_controls:
+            lane_2_tl_related_lanes_wip[lane_id].update(
+                tl_control_2_close_lanes[traffic_control_id]
+            )
+
+    tl_added_lane_id_2_tl_id = dict()
+    for lanes, _, tl_id in added_lanes_tl_coord_tl_id:
+        for lane_id in lanes:
+            if lane_id in tl_added_lane_id_2_tl_id:
+                raise AssertionError
+            tl_added_lane_id_2_tl_id[lane_id] = tl_id
+            lane_2_close_tl_controls[lane_id].append(tl_id)
+
+    lane_2_direct_tl_lights = defaultdict(set)
+    lane_2_direct_tl_faces = defaultdict(set)
+    is_not_under_red_turn_fix = np.ones(len(lane_ids_all), dtype=bool)
+    is_not_under_red_turn_fix[
+        [lane_id_2_idx_all[lane_id] for lane_id in lanes_under_red_turn_fix]
+    ] = False
+
+    for lane_id in proto_API.get_element_ids(ELEMENT_KIND_LANE):
+        if lane_id not in lane_ids_with_wrong_tl_associations:
+            lane_traffic_controls = proto_API.get_lane_traffic_control_ids(lane_id)
+        else:
+            lane_traffic_controls = []
+        lane_traffic_lights = [
+            x for x in lane_traffic_controls if x in traffic_light_ids_all
+        ]
+        lane_traffic_faces = [
+            x for x in lane_traffic_controls if x in traffic_faces_ids_all
+        ]
+
+        if lane_id in tl_added_lane_id_2_tl_id:
+            lane_traffic_lights.append(tl_added_lane_id_2_tl_id[lane_id])
+            lane_traffic_faces.append(tl_added_lane_id_2_tl_id[lane_id])
+        if len(lane_traffic_lights):
+            next_lane_indices, dists_from_tl = lane_graph.traverse(
+                [lane_id_2_idx_all[lane_id]],
+                [get_lane_len(lane_id)],
+                ("backward",),
+                max_dist=min_required_len_before_tl,
+                expand_mask=is_not_under_red_turn_fix,
+            )
+            # don't propagate faces backwards
+            is_faces_lane = dists_from_tl == lane_graph.lane_lens[next_lane_indices]
+            for next_lane_idx, is_faces_lane_ in zip(
+                next_lane_indices.tolist(), is_faces_lane.tolist()
+            ):
+                next_lane = lane_ids_all[next_lane_idx]
+                lane_2_direct_tl_lights[next_lane].update(lane_traffic_lights)
+                if is_faces_lane_:
+                    lane_2_direct_tl_faces[next_lane].update(lane_traffic_faces)
+
+    # manual sem map fixes
+    for fix_i, parent_lane in enumerate(lanes_under_red_turn_fix):
+        lane_2_direct_tl_lights[f"lane{2 * fix_i + 1}"] = lane_2_direct_tl_lights[
+            parent_lane
+        ].copy()
+        lane_2_direct_tl_faces[f"lane{2 * fix_i + 1}"] = lane_2_direct_tl_faces[
+            parent_lane
+        ].copy()
+        del lane_2_direct_tl_lights[parent_lane]
+        del lane_2_direct_tl_faces[parent_lane]
+
+    tl_light_2_directly_controlled_lanes = defaultdict(set)
+    for lane_id, tl_lights in lane_2_direct_tl_lights.items():
+        for tl_light in tl_lights:
+            tl_light_2_directly_controlled_lanes[tl_light].add(lane_id)
+
+    master_intersection_idx_2_traffic_lights = []
+    traffic_light_id_2_master_intersection_idx = defaultdict(list)
+
+    for tls_united_by_lane in lane_2_close_tl_controls.values():
+        master_intersection_idx = None
+        for tl_id in tls_united_by_lane:
+            if tl_id in traffic_light_id_2_master_intersection_idx:
+                if master_intersection_idx is not None:
+                    if (
+                        traffic_light_id_2_master_intersection_idx[tl_id]
+                        != master_intersection_idx
+                    ):
+                        raise AssertionError(
+                            f"tl_id: {tl_id}",
+                            f"traffic_light_id_2_master_intersection_idx[tl_id]: {traffic_light_id_2_master_intersection_idx[tl_id]}",
+                            f"master_intersection_idx: {master_intersection_idx}",
+                        )
+                else:
+                    master_intersection_idx = (
+                        traffic_light_id_2_master_intersection_idx[tl_id]
+                    )
+                if (
+                    tl_id
+                    not in master_intersection_idx_2_traffic_lights[
+                        master_intersection_idx
+                    ]
+                ):
+                    raise AssertionError
+            else:
+                if master_intersection_idx is None:
+                    master_intersection_idx = len(
+                        master_intersection_idx_2_traffic_lights
+                    )
+                    master_intersection_idx_2_traffic_lights.append(set())
+                traffic_light_id_2_master_intersection_idx[
+                    tl_id
+                ] = master_intersection_idx
+                master_intersection_idx_2_traffic_lights[master_intersection_idx].add(
+                    tl_id
+                )
+
+    master_intersection_idx_2_traffic_lights = [
+        set(intersection_tls)
+        for intersection_tls in sorted(
+            [tuple(sorted(list(x))) for x in master_intersection_idx_2_traffic_lights]
+        )
+    ]
+    # splitting the master intersection 1 (there's some long connecting lane likely)
+    orig_tl_ids = list(master_intersection_idx_2_traffic_lights[3])
+    coordinates_data = np.array(
+        [traffic_light_id_2_coord[tl_id] for tl_id in orig_tl_ids]
+    )
+    kmeans_clusters = (
+        KMeans(n_clusters=2, random_state=42).fit(coordinates_data).labels_
+    )
+    master_intersection_idx_new = len(master_intersection_idx_2_traffic_lights)
+    master_intersection_idx_2_traffic_lights.append(set())
+    for tl_id, cluster in zip(orig_tl_ids, kmeans_clusters):
+        if cluster == 1:
+            traffic_light_id_2_master_intersection_idx[
+                tl_id
+            ] = master_intersection_idx_new
+            master_intersection_idx_2_traffic_lights[master_intersection_idx_new].add(
+                tl_id
+            )
+            master_intersection_idx_2_traffic_lights[3].remove(tl_id)
+
+    # the goal is to group traffic light faces controlling the same lanes (assuming they duplicate the same info)
+    tl_faces_set_2_lanes = defaultdict(set)
+    tl_faces_set_2_master_intersections = defaultdict(set)
+
+    # dummy count for the check only
+    tl_ids_raw_count = 0
+    for master_intersection_idx, master_intersection_traffic_lights in enumerate(
+        master_intersection_idx_2_traffic_lights
+    ):
+        tl_ids_raw_count += len(master_intersection_traffic_lights)
+        # the predecessor relations (see is_predecessor) between the lanes controlled by the intersection tls,
+        # computed at once for the intersection
+        intersection_controlled_lane_indices = sorted(
+            {
+                lane_id_2_idx_all[lane_id]
+                for tl_id in master_intersection_traffic_lights
+                for lane_id in tl_light_2_directly_controlled_lanes[tl_id]
+            }
+        )
+        controlled_lane_idx_2_bit_idx = {
+            lane_idx: bit_idx
+            for bit_idx, lane_idx in enumerate(intersection_controlled_lane_indices)
+        }
+        controlled_lanes_reachability_bitsets = lane_graph.get_reachability_bitsets(
+            intersection_controlled_lane_indices, "forward", IS_PREDECESSOR_MAX_DEPTH
+        )
+        for tl_id in master_intersection_traffic_lights:
+            # all lanes directly controlled by the tl
+            controlled_lanes = tl_light_2_directly_controlled_lanes[tl_id]
+
+            # differentiate lanes based on tl faces, which are available for the final exit lanes only
+            for lane_id in controlled_lanes:
+                if is_the_end_controlled_lane(lane_id, controlled_lanes):
+                    tl_faces_tuple = tuple(sorted(lane_2_direct_tl_faces[lane_id]))
+                    tl_faces_set_2_lanes[tl_faces_tuple].add(lane_id)
+                    # propagate the tl-faces set to the predecessors
+                    lane_bit_idx = controlled_lane_idx_2_bit_idx[
+                        lane_id_2_idx_all[lane_id]
+                    ]
+                    for controlled_lane_id in controlled_lanes:
+                        if is_bit_set(
+                            controlled_lanes_reachability_bitsets,
+                            lane_id_2_idx_all[controlled_lane_id],
+                            lane_bit_idx,
+                        ):
+                            tl_faces_set_2_lanes[tl_faces_tuple].add(controlled_lane_id)
+                    tl_faces_set_2_master_intersections[tl_faces_tuple].add(
+                        master_intersection_idx
+                    )
+
+    for tl_faces, intersection_idx_set in tl_faces_set_2_master_intersections.items():
+        if len(intersection_idx_set) != 1:
+            raise AssertionError(f"{tl_faces}, {intersection_idx_set}")
+        tl_faces_set_2_master_intersections[tl_faces] = list(intersection_idx_set)[0]
+    # tl_signal_idx corresponds to the set of tl faces with the same set of lanes under control and therefore (presumably) the same signal
+
+    # tl signal indices are used by the trained models, therefore they're cached separately from the compiled map
+    (
+        master_intersection_idx_2_tl_signal_indices,
+        tl_face_id_2_tl_signal_indices,
+        tl_signal_idx_2_controlled_lanes,
+        tl_signal_idx_2_exit_lanes,
+        tl_signal_idx_2_stop_coordinates,
+        controlled_lane_id_2_tl_signal_idx,
+        exit_lane_id_2_tl_signal_idx,
+    ) = load_or_compute(
+        "tl_signals",
+        tl_signals_key,
+        lambda: compute_tl_signals(
+            tl_faces_set_2_lanes, tl_faces_set_2_master_intersections
+        ),
+    )
+
+    lane_2_master_intersection_related_lanes = dict()  # ->set
+    lane_id_2_master_intersection_idx = dict()
+    for (
+        master_intersection_idx,
+        master_intersection_tl_signal_indices,
+    ) in master_intersection_idx_2_tl_signal_indices.items():
+        all_master_intersection_lanes = set()
+        for tl_signal_idx in master_intersection_tl_signal_indices:
+            all_master_intersection_lanes.update(
+                tl_signal_idx_2_controlled_lanes[tl_signal_idx]
+            )
+            all_master_intersection_lanes.update(
+                tl_signal_idx_2_exit_lanes[tl_signal_idx]
+            )
+            for lane_id in tl_signal_idx_2_controlled_lanes[tl_signal_idx].union(
+                tl_signal_idx_2_exit_lanes[tl_signal_idx]
+            ):
+                lane_id_2_master_intersection_idx[lane_id] = master_intersection_idx
+
+            # to also associate the neighbourhood to an intersection, bfs from the controlled lanes (mainly to include the artificially separated turns-under-red)
+            is_lane_closed = np.zeros(len(lane_ids_all), dtype=bool)
+            is_lane_closed[
+                [
+                    lane_id_2_idx_all[x]
+                    for x in tl_signal_idx_2_controlled_lanes[tl_signal_idx].union(
+                        tl_signal_idx_2_exit_lanes[tl_signal_idx]
+                    )
+                ]
+            ] = True
+            for lane_id in tl_signal_idx_2_controlled_lanes[tl_signal_idx]:
+                next_lane_indices, _ = lane_graph.traverse(
+                    [lane_id_2_idx_all[lane_id]],
+                    [0],
+                    ("forward", "left", "right"),
+                    max_dist=70,  # points
+                    closed_mask=is_lane_closed,
+                )
+                for next_lane_idx in next_lane_indices.tolist():
+                    lane_id_2_master_intersection_idx[
+                        lane_ids_all[next_lane_idx]
+                    ] = master_intersection_idx
+        for lane_id in all_master_intersection_lanes:
+            lane_2_master_intersection_related_lanes[lane_id] = {
+                neighbour_lane_id
+                for neighbour_lane_id in all_master_intersection_lanes
+                if neighbour_lane_id != lane_id
+            }
+
+    # added lanes belong to intersections
+    lane_indices_not_bike_intersection, _ = get_lane_indices_and_id_mapping(
+        filter_function=lambda x: x in added_lanes
+        or (
+            not proto_API.is_bike_only_lane(x)
+            and x in lane_id_2_master_intersection_idx
+        )
+    )
+    lane_indices_bike_intersection, _ = get_lane_indices_and_id_mapping(
+        filter_function=lambda x: x in added_lanes
+        or (proto_API.is_bike_only_lane(x) and x in lane_id_2_master_intersection_idx)
+    )
+    lane_indices_intersection, _ = get_lane_indices_and_id_mapping(
+        filter_function=lambda x: x in added_lanes
+        or x in lane_id_2_master_intersection_idx
+    )
+
+    # the added lanes are in both bike and not bike subsets
+    intersection_lane_kd_flags = np.where(
+        np.isin(lane_indices_intersection, lane_indices_bike_intersection),
+        KD_FLAG_BIKE,
+        0,
+    ) | np.where(
+        np.isin(lane_indices_intersection, lane_indices_not_bike_intersection),
+        KD_FLAG_NOT_BIKE,
+        0,
+    )
+    kd_scopes["intersection"] = get_kd_scope(
+        lane_indices_intersection, intersection_lane_kd_flags
+    )
+    intersection_kd_trees_and_idx_maps = get_class_kd_trees_and_idx_maps(
+        kd_scopes["intersection"]
+    )
+
+    # PER MASTER INTERSECTION ################
+    # bounding boxes of the lanes related to the lanes of the master intersection (see get_info_per_related_lanes)
+    master_intersection_idx_2_region_lanes = defaultdict(set)
+    for lane_id, related_lanes in lane_2_master_intersection_related_lanes.items():
+        region_lanes = master_intersection_idx_2_region_lanes[
+            lane_id_2_master_intersection_idx[lane_id]
+        ]
+        region_lanes.add(lane_id)
+        region_lanes.update(related_lanes)
+    # the boxes of the intersections without related lanes contain no point
+    master_intersection_bounds = np.full(
+        (len(master_intersection_idx_2_traffic_lights), 2, 2), np.nan
+    )
+    for (
+        master_intersection_idx,
+        region_lanes,
+    ) in master_intersection_idx_2_region_lanes.items():
+        region_points = get_kd_scope(
+            np.array(sorted(lane_id_2_idx_all[x] for x in region_lanes))
+        )["points"]
+        master_intersection_bounds[master_intersection_idx] = [
+            region_points.min(axis=0),
+            region_points.max(axis=0),
+        ]
+        # intersection lanes within the margin, in the order of the intersection kd scope
+        is_near_lane = np.zeros(len(lane_ids_all), dtype=bool)
+        is_near_lane[
+            kd_scopes["intersection"]["lane_idx"][
+                get_dists_to_bounds(
+                    kd_scopes["intersection"]["points"],
+                    master_intersection_bounds[master_intersection_idx],
+                )
+                <= MASTER_INTERSECTION_INDEX_MARGIN_M
+            ]
+        ] = True
+        is_scope_point = is_near_lane[kd_scopes["intersection"]["lane_idx"]]
+        kd_scopes[f"master_intersection_{master_intersection_idx}"] = {
+            key: values[is_scope_point]
+            for key, values in kd_scopes["intersection"].items()
+        }
+    master_intersection_kd_trees_and_idx_maps = [
+        get_class_kd_trees_and_idx_maps(
+            kd_scopes.get(f"master_intersection_{master_intersection_idx}")
+        )
+        for master_intersection_idx in range(len(master_intersection_bounds))
+    ]
+
+    # blocked tl signals of the exit lane points, accumulated from the lane end backwards,
+    # as signal bitmasks aligned with lanes_center_line_points
+    exit_lane_points = get_kd_scope(
+        np.array(
+            sorted(lane_id_2_idx_all[x] for x in exit_lane_id_2_tl_signal_idx.keys())
+        )
+    )
+    exit_lane_point_yaws = get_lane_point_yaws(
+        exit_lane_points["lane_idx"], exit_lane_points["point_idx"]
+    )
+    (
+        matched_lane_indices,
+        matched_point_indices,
+        exit_lane_points_blocked_signals,
+    ) = find_closest_lanes(
+        exit_lane_points["points"],
+        exit_lane_point_yaws,
+        ALL_WHEELS_CLASS,
+        k_nearest=15,
+        return_blocked_tl_signals=True,
+        intersections_only=True,
+    )
+    for lane_idx, point_idx, matched_lane_idx, matched_point_idx in zip(
+        exit_lane_points["lane_idx"].tolist(),
+        exit_lane_points["point_idx"].tolist(),
+        matched_lane_indices.tolist(),
+        matched_point_indices.tolist(),
+    ):
+        if not (
+            (lane_ids_all[lane_idx], point_idx) in checked_hard_cases
+            or matched_lane_idx == lane_idx
+            and matched_point_idx == point_idx
+        ):
+            raise AssertionError(
+                f"closest_lane_id: {lane_ids_all[matched_lane_idx] if matched_lane_idx >= 0 else None}[{matched_point_idx}], "
+                f"(true lane_id: {lane_ids_all[lane_idx]}[{point_idx}])"
+            )
+    # a signal blocked at a lane point is blocked at all the preceding points of the lane
+    blocked_pair_positions = np.repeat(
+        np.arange(len(exit_lane_points_blocked_signals)),
+        [len(x) for x in exit_lane_points_blocked_signals],
+    )
+    blocked_pair_signals = np.array(
+        [
+            x
+            for blocked_signals in exit_lane_points_blocked_signals
+            for x in blocked_signals
+        ],
+        dtype=np.int64,
+    )
+    blocked_pair_lane_starts = lanes_center_line_offsets[
+        exit_lane_points["lane_idx"][blocked_pair_positions]
+    ]
+    blocked_pair_counts = exit_lane_points["point_idx"][blocked_pair_positions] + 1
+    blocked_point_signals = np.repeat(blocked_pair_signals, blocked_pair_counts)
+    blocked_point_indices = np.repeat(blocked_pair_lane_starts, blocked_pair_counts) + (
+        np.arange(blocked_pair_counts.sum())
+        - np.repeat(
+            np.cumsum(blocked_pair_counts) - blocked_pair_counts, blocked_pair_counts
+        )
+    )
+    lane_point_blocked_signals = np.zeros(
+        (
+            len(lanes_center_line_points),
+            max((len(tl_signal_idx_2_controlled_lanes) + 63) // 64, 1),
+        ),
+        dtype=np.uint64,
+    )
+    np.bitwise_or.at(
+        lane_point_blocked_signals,
+        (blocked_point_indices, blocked_point_signals // 64),
+        np.left_shift(np.uint64(1), (blocked_point_signals % 64).astype(np.uint64)),
+    )
+
+    ######################
+    # getting yield sets
+    lane_id_2_yield_lanes = defaultdict(set)
+
+    lane_id_2_yield_lanes_init = dict()
+    for lane_id in lane_id_2_idx:
+        lane_ids_to_yield = proto_API.get_lanes_to_yield(lane_id)
+        if len(lane_ids_to_yield):
+            lane_id_2_yield_lanes_init[lane_id] = lane_ids_to_yield
+    lane_id_2_yield_lanes_init.update(red_turn_lane_2_yield_lanes)
+
+    for lane_id, lane_ids_to_yield in lane_id_2_yield_lanes_init.items():
+        if (
+            lane_id in exit_lane_id_2_tl_signal_idx
+        ):  # focusing on the most common case of traffic lights being on; 95.7% of lanes with lanes to yield are not tl exit lanes
+            continue
+        for lane_id_to_yield in lane_ids_to_yield:
+            lane_indices_to_yield, _ = lane_graph.traverse(
+                [lane_id_2_idx_all[lane_id_to_yield]],
+                [get_lane_len(lane_id_to_yield)],
+                ("backward",),
+                max_dist=min_yield_points,
+            )
+            lane_id_2_yield_lanes[lane_id].update(
+                lane_ids_all[x] for x in lane_indices_to_yield.tolist()
+            )
+
+    ######################
+    # precomputing speed limits per lanes,
+    # without LANE_SPEED_LIMITS_FROM_MAP all lanes get the max speed limit of get_agent_lanes_info
+    lane_id_2_speed_limit = (
+        {lane_id: proto_API.get_speed_limit(lane_id) for lane_id in lane_id_2_idx}
+        if LANE_SPEED_LIMITS_FROM_MAP
+        else dict()
+    )
+
+    # traffic light faces colours and signals as arrays, so that the frame faces are decoded without the map protobuf
+    tl_face_id_2_colour = {
+        element_id: proto_API.get_traffic_face_colour(element_id)
+        for element_id in proto_API.get_element_ids(ELEMENT_KIND_TRAFFIC_CONTROL)
+    }
+    traffic_face_table = TrafficFaceTable.from_map_structures(
+        tl_face_id_2_colour,
+        {"green": TL_GREEN_COLOR, "red": TL_RED_COLOR, "yellow": TL_YELLOW_COLOR},
+        tl_face_id_2_tl_signal_indices,
+        tl_signal_idx_2_controlled_lanes,
+        lane_2_master_intersection_related_lanes,
+        lane_id_2_idx_all,
+    )
+
+    save_map_artifact(
+        COMPILED_MAP_PATH,
+        arrays={
+            "lane_ids_all": np.array(lane_ids_all),
+            "lanes_center_line_points": lanes_center_line_points,
+            "lanes_center_line_offsets": lanes_center_line_offsets,
+            "lanes_center_line_headings": lanes_center_line_headings,
+            "lanes_xy_left_points": lanes_xy_left_points,
+            "lanes_xy_left_offsets": lanes_xy_left_offsets,
+            "lanes_xy_right_points": lanes_xy_right_points,
+            "lanes_xy_right_offsets": lanes_xy_right_offsets,
+            "lane_proximity_offsets": lane_proximity_offsets,
+            "lane_proximity_indices": lane_proximity_indices,
+            "lane_point_blocked_signals": lane_point_blocked_signals,
+            **{
+                f"lane_graph/{key}": values
+                for key, values in lane_graph.to_arrays().items()
+            },
+            **{
+                f"traffic_face_table/{key}": values
+                for key, values in traffic_face_table.to_arrays().items()
+            },
+            **{
+                f"map_partition/{key}": values
+                for key, values in map_partition.to_arrays().items()
+            },
+            "master_intersection_bounds": master_intersection_bounds,
+            **{
+                f"kd_scope/{scope_name}/{key}": values
+                for scope_name, kd_scope in kd_scopes.items()
+                for key, values in kd_scope.items()
+            },
+        },
+        objects={
+            "lane_id_2_idx": lane_id_2_idx,
+            "traffic_light_ids_all": traffic_light_ids_all,
+            "traffic_light_id_2_coord": traffic_light_id_2_coord,
+            "master_intersection_idx_2_tl_signal_indices": master_intersection_idx_2_tl_signal_indices,
+            "tl_face_id_2_tl_signal_indices": tl_face_id_2_tl_signal_indices,
+            "tl_signal_idx_2_controlled_lanes": tl_signal_idx_2_controlled_lanes,
+            "tl_signal_idx_2_exit_lanes": tl_signal_idx_2_exit_lanes,
+            "tl_signal_idx_2_stop_coordinates": tl_signal_idx_2_stop_coordinates,
+            "controlled_lane_id_2_tl_signal_idx": controlled_lane_id_2_tl_signal_idx,
+            "exit_lane_id_2_tl_signal_idx": exit_lane_id_2_tl_signal_idx,
+            "lane_2_master_intersection_related_lanes": lane_2_master_intersection_related_lanes,
+            "lane_id_2_master_intersection_idx": lane_id_2_master_intersection_idx,
+            "lane_id_2_yield_lanes": lane_id_2_yield_lanes,
+            "lane_id_2_speed_limit": lane_id_2_speed_limit,
+        },
+        key=compiled_map_key,
+    )
+    save_intersection_metadata(
+        master_intersection_idx_2_tl_signal_indices, compiled_map_key
+    )
+else:
+    compiled_map_arrays, compiled_map_objects = load_map_artifact(COMPILED_MAP_PATH)
+    lane_ids_all = compiled_map_arrays["lane_ids_all"].tolist()
+    lane_id_2_idx_all = {lane_id: i for i, lane_id in enumerate(lane_ids_all)}
+    lanes_center_line_points = compiled_map_arrays["lanes_center_line_points"]
+    lanes_center_line_offsets = compiled_map_arrays["lanes_center_line_offsets"]
+    lanes_center_line_headings = compiled_map_arrays["lanes_center_line_headings"]
+    lanes_xy_left_points = compiled_map_arrays["lanes_xy_left_points"]
+    lanes_xy_left_offsets = compiled_map_arrays["lanes_xy_left_offsets"]
+    lanes_xy_right_points = compiled_map_arrays["lanes_xy_right_points"]
+    lanes_xy_right_offsets = compiled_map_arrays["lanes_xy_right_offsets"]
+    lane_proximity_offsets = compiled_map_arrays["lane_proximity_offsets"]
+    lane_proximity_indices = compiled_map_arrays["lane_proximity_indices"]
+    lane_point_blocked_signals = compiled_map_arrays["lane_point_blocked_signals"]
+    lane_graph = LaneGraph(
+        {
+            array_name[len("lane_graph/") :]: values
+            for array_name, values in compiled_map_arrays.items()
+            if array_name.startswith("lane_graph/")
+        }
+    )
+    lane_id_2_idx = compiled_map_objects["lane_id_2_idx"]
+    traffic_light_ids_all = compiled_map_objects["traffic_light_ids_all"]
+    traffic_light_id_2_coord = compiled_map_objects["traffic_light_id_2_coord"]
+    traffic_face_table = TrafficFaceTable(
+        {
+            array_name[len("traffic_face_table/") :]: values
+            for array_name, values in compiled_map_arrays.items()
+            if array_name.startswith("traffic_face_table/")
+        }
+    )
+    map_partition = MapPartition(
+        {
+            array_name[len("map_partition/") :]: values
+            for array_name, values in compiled_map_arrays.items()
+            if array_name.startswith("map_partition/")
+        }
+    )
+    master_intersection_idx_2_tl_signal_indices = compiled_map_objects[
+        "master_intersection_idx_2_tl_signal_indices"
+    ]
+    tl_face_id_2_tl_signal_indices = compiled_map_objects[
+        "tl_face_id_2_tl_signal_indices"
+    ]
+    tl_signal_idx_2_controlled_lanes = compiled_map_objects[
+        "tl_signal_idx_2_controlled_lanes"
+    ]
+    tl_signal_idx_2_exit_lanes = compiled_map_objects["tl_signal_idx_2_exit_lanes"]
+    tl_signal_idx_2_stop_coordinates = compiled_map_objects[
+        "tl_signal_idx_2_stop_coordinates"
+    ]
+    controlled_lane_id_2_tl_signal_idx = compiled_map_objects[
+        "controlled_lane_id_2_tl_signal_idx"
+    ]
+    exit_lane_id_2_tl_signal_idx = compiled_map_objects["exit_lane_id_2_tl_signal_idx"]
+    lane_2_master_intersection_related_lanes = compiled_map_objects[
+        "lane_2_master_intersection_related_lanes"
+    ]
+    lane_id_2_master_intersection_idx = compiled_map_objects[
+        "lane_id_2_master_intersection_idx"
+    ]
+    lane_id_2_yield_lanes = compiled_map_objects["lane_id_2_yield_lanes"]
+    lane_id_2_speed_limit = compiled_map_objects["lane_id_2_speed_limit"]
+
+    kd_scopes = defaultdict(dict)
+    for array_name, values in compiled_map_arrays.items():
+        if array_name.startswith("kd_scope/"):
+            _, scope_name, key = array_name.split("/")
+            kd_scopes[scope_name][key] = values
+    kd_trees_and_idx_maps = get_class_kd_trees_and_idx_maps(kd_scopes["all"])
+    kd_tree, kd_idx_2_lane_id_idx = kd_trees_and_idx_maps[ALL_WHEELS_CLASS]
+    map_partition_leaf_2_kd_trees_and_idx_maps = (
+        get_map_partition_kd_trees_and_idx_maps(kd_scopes, map_partition.n_leaves)
+    )
+    intersection_kd_trees_and_idx_maps = get_class_kd_trees_and_idx_maps(
+        kd_scopes["intersection"]
+    )
+    master_intersection_bounds = compiled_map_arrays["master_intersection_bounds"]
+    master_intersection_kd_trees_and_idx_maps = [
+        get_class_kd_trees_and_idx_maps(
+            kd_scopes.get(f"master_intersection_{master_intersection_idx}")
+        )
+        for master_intersection_idx in range(len(master_intersection_bounds))
+    ]
+
+    if not is_intersection_metadata_current(compiled_map_key):
+        save_intersection_metadata(
+            master_intersection_idx_2_tl_signal_indices, compiled_map_key
+        )
+
+##########################
+# map segments, precomputed by lyft_trajectories.utils.segment_map (which builds them with this module imported),
+# see get_map_segments_data
+map_segments_data = None
+
+##########################
+# traffic light signals
+tl_signal_idx_2_master_intersection_idx = get_tl_signal_idx_2_master_intersection_idx(
+    master_intersection_idx_2_tl_signal_indices
+)
+lane_idx_2_exit_tl_signal_idx = np.full(len(lane_ids_all), -1, dtype=np.int64)
+for lane_id, tl_signal_idx in exit_lane_id_2_tl_signal_idx.items():
+    lane_idx_2_exit_tl_signal_idx[lane_id_2_idx_all[lane_id]] = tl_signal_idx
+# see get_lane_grid_index
+lane_grid_index = None
+# memo of the ego lane matching of the TL events and the agent lanes features (per process)
+lane_match_cache = LaneMatchCache(
+    max_size=LANE_MATCH_CACHE_SIZE,
+    position_step_m=LANE_MATCH_CACHE_POSITION_STEP_M,
+    yaw_step_rad=LANE_MATCH_CACHE_YAW_STEP_RAD,
+    validation_rate=LANE_MATCH_CACHE_VALIDATION_RATE,
+)
+# agents lanes tracked over the consecutive frames of a scene (per process)
+intersection_lanes_matcher = TrackLaneMatcher(
+    strict=TRACK_LANE_MATCHING_STRICT,
+    track_max_dist_m=TRACK_LANE_MATCHING_MAX_DIST_M,
+    validation_rate=TRACK_LANE_MATCHING_VALIDATION_RATE,
+    lane_point_blocked_signals=lane_point_blocked_signals,
+    return_blocked_tl_signals=True,
+    intersections_only=True,
+)
+agent_lanes_matcher = TrackLaneMatcher(
+    strict=TRACK_LANE_MATCHING_STRICT,
+    track_max_dist_m=TRACK_LANE_MATCHING_MAX_DIST_M,
+    validation_rate=TRACK_LANE_MATCHING_VALIDATION_RATE,
+    return_blocked_tl_signals=False,
+    intersections_only=False,
+    max_dist_m=100,
+)
@@ -0,0 +1,31 @@
+from datetime import datetime
+
+from pytz import timezone
+
+# the pipeline carries the int64 ns timestamps of the zarr frames, the timezone is used for display and the CLI bounds
+TIMESTAMPS_TIMEZONE = "US/Pacific"
+NS_PER_SEC = 10 ** 9
+
+
+def timestamp_ns_2_datetime(timestamp_ns: int) -> datetime:
+    return datetime.fromtimestamp(timestamp_ns / NS_PER_SEC).astimezone(
+        timezone(TIMESTAMPS_TIMEZONE)
+    )
+
+
+def datetime_2_timestamp_ns(date_time: datetime) -> int:
+    # microsecond resolution of datetime
+    return round(date_time.timestamp() * 10 ** 6) * 1000
+
+
+def date_2_timestamp_ns(date_str: str, default: datetime) -> int:
+    """
+    Args:
+        date_str (str): date in the %Y-%m-%d format, or empty for the default
+        default (datetime): the date if date_str is empty
+
+    Returns:
+        the ns timestamp of the date start
+    """
+    date_time = default if date_str == "" else datetime.strptime(date_str, "%Y-%m-%d")
+    return datetime_2_timestamp_ns(date_time.astimezone(timezone(TIMESTAMPS_TIMEZONE)))
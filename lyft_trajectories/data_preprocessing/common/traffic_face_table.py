@@ -0,0 +1,167 @@
+from typing import Dict, List, Set
+
+import numpy as np
+
+from lyft_trajectories.data_preprocessing.common.lane_graph import expand_csr, get_csr
+
+UNKNOWN_COLOUR_CODE = -1
+
+
+class TrafficFaceTable:
+    """
+    Per-frame traffic light faces decoding with array lookups:
+    - faces sorted by id with their colour codes and CSR of the signals they belong to;
+    - for each intersection lane, packed bitsets of the signals controlling some of the lane's intersection-related lanes
+      (the related lanes exclude the lane itself, hence a second bitset of the signals controlling the lane itself).
+    """
+
+    def __init__(self, arrays: Dict[str, np.ndarray]):
+        self.arrays = arrays
+        self.face_ids = arrays["face_ids"]
+        self.face_colour_codes = arrays["face_colour_codes"]
+        self.face_signal_offsets = arrays["face_signal_offsets"]
+        self.face_signal_indices = arrays["face_signal_indices"]
+        self.lane_idx_2_bitset_row = arrays["lane_idx_2_bitset_row"]
+        self.related_signals_bitsets = arrays["related_signals_bitsets"]
+        self.own_signals_bitsets = arrays["own_signals_bitsets"]
+        self.n_signals = int(arrays["n_signals"][0])
+
+    @classmethod
+    def from_map_structures(
+        cls,
+        tl_face_id_2_colour: Dict[str, str],
+        colour_2_code: Dict[str, int],
+        tl_face_id_2_tl_signal_indices: Dict[str, Set[int]],
+        tl_signal_idx_2_controlled_lanes: List[Set[str]],
+        lane_2_master_intersection_related_lanes: Dict[str, Set[str]],
+        lane_id_2_idx: Dict[str, int],
+    ):
+        """
+        Args:
+            tl_face_id_2_colour (Dict[str, str]): colour name of each traffic control element
+            colour_2_code (Dict[str, int]): colour codes, colours missing here are skipped when decoding
+            tl_face_id_2_tl_signal_indices (Dict[str, Set[int]]): signals of each face
+            tl_signal_idx_2_controlled_lanes (List[Set[str]]): controlled lanes of each signal
+            lane_2_master_intersection_related_lanes (Dict[str, Set[str]]): intersection-related lanes per lane
+            lane_id_2_idx (Dict[str, int]): dense lane indices
+
+        Returns:
+            TrafficFaceTable
+        """
+        face_ids = sorted(tl_face_id_2_colour.keys())
+        face_signal_offsets, face_signal_indices = get_csr(
+            [sorted(tl_face_id_2_tl_signal_indices.get(x, set())) for x in face_ids]
+        )
+        n_signals = len(tl_signal_idx_2_controlled_lanes)
+        lane_2_controlling_signals = dict()
+        for tl_signal_idx, controlled_lanes in enumerate(
+            tl_signal_idx_2_controlled_lanes
+        ):
+            for lane_id in controlled_lanes:
+                lane_2_controlling_signals.setdefault(lane_id, set()).add(tl_signal_idx)
+
+        lane_idx_2_bitset_row = np.full(len(lane_id_2_idx), -1, dtype=np.int32)
+        related_signals_masks, own_signals_masks = [], []
+        for lane_id, related_lanes in lane_2_master_intersection_related_lanes.items():
+            lane_idx_2_bitset_row[lane_id_2_idx[lane_id]] = len(related_signals_masks)
+            related_signals_mask = np.zeros(n_signals, dtype=bool)
+            for related_lane_id in related_lanes:
+                related_signals_mask[
+                    list(lane_2_controlling_signals.get(related_lane_id, []))
+                ] = True
+            own_signals_mask = np.zeros(n_signals, dtype=bool)
+            own_signals_mask[list(lane_2_controlling_signals.get(lane_id, []))] = True
+            related_signals_masks.append(related_signals_mask)
+            own_signals_masks.append(own_signals_mask)
+        return cls(
+            {
+                "face_ids": np.array(face_ids, dtype=str),
+                "face_colour_codes": np.array(
+                    [
+                        colour_2_code.get(tl_face_id_2_colour[x], UNKNOWN_COLOUR_CODE)
+                        for x in face_ids
+                    ],
+                    dtype=np.int8,
+                ),
+                "face_signal_offsets": face_signal_offsets,
+                "face_signal_indices": face_signal_indices,
+                "lane_idx_2_bitset_row": lane_idx_2_bitset_row,
+                "related_signals_bitsets": np.packbits(
+                    np.array(related_signals_masks, dtype=bool).reshape(-1, n_signals),
+                    axis=1,
+                ),
+                "own_signals_bitsets": np.packbits(
+                    np.array(own_signals_masks, dtype=bool).reshape(-1, n_signals),
+                    axis=1,
+                ),
+                "n_signals": np.array([n_signals], dtype=np.int64),
+            }
+        )
+
+    def get_related_signals_mask(
+        self, lane_idx: int, include_lane_itself: bool
+    ) -> np.ndarray:
+        """
+        Signals controlling at least one of the intersection-related lanes of the lane
+
+        Args:
+            lane_idx (int): dense lane index
+            include_lane_itself (bool): whether the lane itself is considered related
+
+        Returns:
+            np.ndarray: bool mask over signal indices
+        """
+        row = self.lane_idx_2_bitset_row[lane_idx]
+        if row < 0:
+            return np.zeros(self.n_signals, dtype=bool)
+        bitset = self.related_signals_bitsets[row]
+        if include_lane_itself:
+            bitset = bitset | self.own_signals_bitsets[row]
+        return np.unpackbits(bitset, count=self.n_signals).astype(bool)
+
+    def get_tl_events(
+        self,
+        face_ids: np.ndarray,
+        tl_light_ids: np.ndarray,
+        related_signals_mask: np.ndarray,
+    ) -> Set:
+        """
+        Decodes the observed faces into the (tl light id, signal idx, colour code) events at once.
+        Faces with unknown colour and signals outside of related_signals_mask are skipped.
+
+        Args:
+            face_ids (np.ndarray): face ids of the frame faces
+            tl_light_ids (np.ndarray): their traffic light ids
+            related_signals_mask (np.ndarray): bool mask over signal indices
+
+        Returns:
+            Set: set of events tuples
+        """
+        if not len(face_ids):
+            return set()
+        face_positions = np.searchsorted(self.face_ids, face_ids)
+        is_found = face_positions < len(self.face_ids)
+        is_found[is_found] = (
+            self.face_ids[face_positions[is_found]] == face_ids[is_found]
+        )
+        if not np.all(is_found):
+            raise KeyError(face_ids[~is_found][0])
+        colour_codes = self.face_colour_codes[face_positions]
+        is_coloured = colour_codes != UNKNOWN_COLOUR_CODE
+        signal_indices, source_positions = expand_csr(
+            self.face_signal_offsets,
+            self.face_signal_indices,
+            face_positions[is_coloured],
+        )
+        is_related = related_signals_mask[signal_indices]
+        source_positions = np.flatnonzero(is_coloured)[source_positions[is_related]]
+        return set(
+            zip(
+                tl_light_ids[source_positions].tolist(),
+                signal_indices[is_related].tolist(),
+                colour_codes[source_positions].tolist(),
+            )
+        )
+
+    def to_arrays(self) -> Dict[str, np.ndarray]:
+        return dict(self.arrays)
@@ -0,0 +1,12 @@
+import os
+from lyft_trajectories.data_preprocessing.common.map_traffic_lights_data import (
+    COMPILED_MAP_PATH,
+    compiled_map_key,
+    lane_ids_all,
+)
+
+# the import compiles the map artifact if it's missing or outdated
+print(
+    f"Compiled map {compiled_map_key} ({len(lane_ids_all)} lanes): {COMPILED_MAP_PATH}, "
+    f"{os.path.getsize(COMPILED_MAP_PATH) / 2 ** 20:.1f} MB"
+)
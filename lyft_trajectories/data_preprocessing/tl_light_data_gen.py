@@ -7,10 +7,13 @@ from lyft_trajectories.data_preprocessing.common.map_traffic_lights_data import
     compute_rnn_inputs,
 )
 from torch.utils.data import DataLoader
-from ..utils.l5kit_modified.l5kit_modified import FramesDataset
+from ..utils.l5kit_modified.l5kit_modified import FramesDataset, SceneFramesDataset
+from lyft_trajectories.data_preprocessing.common.timestamps import (
+    date_2_timestamp_ns,
+    timestamp_ns_2_datetime,
+)
 from l5kit.data import LocalDataManager
 from datetime import datetime
-from pytz import timezone
 from functools import partial
 import argparse
 
@@ -26,20 +29,16 @@ timestamp_min = args.timestamp_min
 timestamp_max = args.timestamp_max
 fold_i = args.fold_i
 
-if timestamp_min == "":
-    timestamp_min = datetime(2017, 2, 2).astimezone(timezone("US/Pacific"))
-else:
-    timestamp_min = datetime.strptime(timestamp_min, "%Y-%m-%d").astimezone(
-        timezone("US/Pacific")
-    )
-if timestamp_max == "":
-    timestamp_max = datetime(2021, 11, 20).astimezone(timezone("US/Pacific"))
-else:
-    timestamp_max = datetime.strptime(timestamp_max, "%Y-%m-%d").astimezone(
-        timezone("US/Pacific")
-    )
+# the pipeline compares the int64 ns timestamps of the frames
+timestamp_min = date_2_timestamp_ns(timestamp_min, default=datetime(2017, 2, 2))
+timestamp_max = date_2_timestamp_ns(timestamp_max, default=datetime(2021, 11, 20))
 print("=" * 20)
-print("start: ", timestamp_min, "end: ", timestamp_max)
+print(
+    "start: ",
+    timestamp_ns_2_datetime(timestamp_min),
+    "end: ",
+    timestamp_ns_2_datetime(timestamp_max),
+)
 print("=" * 20)
 os.environ["L5KIT_DATA_FOLDER"] = "input/"
 dm = LocalDataManager()
@@ -48,10 +47,14 @@ dataset_path = dm.require(
 )
 
 frame_dataset = FramesDataset(dataset_path, return_indices=True)
+# whole scenes per worker: the scene frames are read at once and the agents lanes are tracked over the scene,
+# only the scenes and frames within the timestamp bounds are read
 dataloader_frames = DataLoader(
-    frame_dataset,
+    SceneFramesDataset(
+        frame_dataset, timestamp_min=timestamp_min, timestamp_max=timestamp_max
+    ),
     shuffle=False,
-    batch_size=32,
+    batch_size=None,
     num_workers=12,
     collate_fn=partial(
         tl_seq_collate_fn, timestamp_min=timestamp_min, timestamp_max=timestamp_max
@@ -1,13 +1,13 @@
 import os
 import pandas as pd
 import numpy as np
-from lyft_trajectories.data_preprocessing.common.map_traffic_lights_data import (
-    master_intersection_idx_2_tl_signal_indices,
+from lyft_trajectories.data_preprocessing.common.intersection_metadata import (
+    load_intersection_metadata,
 )
+from lyft_trajectories.data_preprocessing.common.timestamps import NS_PER_SEC
 
 # early stopping source: https://github.com/Bjarten/early-stopping-pytorch/blob/master/pytorchtools.py
 from ..utils.pytorchtools import EarlyStopping
-from datetime import timedelta
 from collections import defaultdict
 from typing import Dict, List
 import torch
@@ -51,6 +51,8 @@ epoch_max = args.epoch_max
 gpu_i = args.gpu_i
 prediction_id = args.prediction_id
 
+master_intersection_idx_2_tl_signal_indices = load_intersection_metadata()
+
 lr = 6e-5
 embedding_dim = 64
 hidden_dim = 64
@@ -78,14 +80,14 @@ if not perform_prediction:
 
 if "continuous_time" not in tl_events_df_trn.columns:
     tl_events_df_trn["continuous_time"] = (
-        tl_events_df_trn["timestamp"].diff(1) < timedelta(seconds=0.31)
+        tl_events_df_trn["timestamp"].diff(1) < 0.31 * NS_PER_SEC
     ) & (  # observed 0.3 sec jumps (assuming it's between consec. scenes)
         tl_events_df_trn["master_intersection_idx"].shift(1)
         == tl_events_df_trn["master_intersection_idx"]
     )
 if not perform_prediction and "continuous_time" not in tl_events_df_val.columns:
     tl_events_df_val["continuous_time"] = (
-        tl_events_df_val["timestamp"].diff(1) < timedelta(seconds=0.31)
+        tl_events_df_val["timestamp"].diff(1) < 0.31 * NS_PER_SEC
     ) & (
         tl_events_df_val["master_intersection_idx"].shift(1)
         == tl_events_df_val["master_intersection_idx"]
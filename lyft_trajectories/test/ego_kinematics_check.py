@@ -0,0 +1,36 @@
+import argparse
+
+import numpy as np
+from l5kit.data import ChunkedDataset
+from l5kit.geometry import rotation33_as_yaw
+
+from lyft_trajectories.utils.l5kit_modified.l5kit_modified import get_ego_kinematics
+
+# the vectorized ego yaws of the scene frames, checked against rotation33_as_yaw of the single frames
+parser = argparse.ArgumentParser()
+parser.add_argument("--dataset-basename", default="validate")
+parser.add_argument("--n-scenes", default=100, type=int)
+
+args = parser.parse_args()
+
+dataset_path = f"input/scenes/{args.dataset_basename}_filtered_min_frame_history_4_min_frame_future_1_with_mask_idx.zarr"
+zarr_dataset = ChunkedDataset(dataset_path)
+zarr_dataset.open()
+
+n_frames, n_mismatches, max_abs_diff = 0, 0, 0.0
+for scene in zarr_dataset.scenes[: args.n_scenes]:
+    frames = zarr_dataset.frames[slice(*scene["frame_index_interval"])]
+    ego_yaws = get_ego_kinematics(frames)["ego_yaw"]
+    frame_ego_yaws = np.array(
+        [rotation33_as_yaw(frame["ego_rotation"]) for frame in frames]
+    )
+    n_frames += len(frames)
+    n_mismatches += int(np.sum(ego_yaws != frame_ego_yaws))
+    if len(frames):
+        max_abs_diff = max(max_abs_diff, np.abs(ego_yaws - frame_ego_yaws).max())
+print(
+    f"{n_frames} frames of {min(args.n_scenes, len(zarr_dataset.scenes))} scenes, "
+    f"{n_mismatches} ego yaws differ from rotation33_as_yaw (max abs diff {max_abs_diff:.3g} rad)"
+)
+if n_mismatches:
+    raise AssertionError("The vectorized ego yaws change the ego yaw features")
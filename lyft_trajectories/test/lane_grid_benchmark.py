@@ -0,0 +1,135 @@
+import argparse
+import time
+
+import numpy as np
+from tqdm.auto import tqdm
+
+from lyft_trajectories.data_preprocessing.common.map_traffic_lights_data import (
+    find_closest_lane,
+    find_closest_lanes,
+    get_closest_lanes,
+    get_grid_candidates,
+    get_kd_tree_and_idx_map_for_agent,
+    get_lane_grid_index,
+    lane_ids_all,
+    lanes_center_line_points,
+    ALL_WHEELS_CLASS,
+    LANE_GRID_RADIUS_M,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--n-agents", default=20000, type=int)
+parser.add_argument("--agents-per-frame", default=50, type=int)
+parser.add_argument("--position-noise-m", default=2.0, type=float)
+parser.add_argument("--k-nearest", default=25, type=int)
+parser.add_argument("--seed", default=42, type=int)
+
+args = parser.parse_args()
+
+# agents around the lane center lines with random headings
+rng = np.random.default_rng(args.seed)
+coords = lanes_center_line_points[
+    rng.integers(0, len(lanes_center_line_points), args.n_agents)
+] + rng.normal(0, args.position_noise_m, (args.n_agents, 2))
+yaws = rng.uniform(-np.pi, np.pi, args.n_agents).astype(np.float32)
+frame_starts = range(0, args.n_agents, args.agents_per_frame)
+
+start_time = time.time()
+get_lane_grid_index()
+print(f"Lane grid index built/loaded in {time.time() - start_time:.2f} s")
+
+# CANDIDATES ###############
+start_time = time.time()
+kd_candidates = [
+    get_closest_lanes(coord, ALL_WHEELS_CLASS, args.k_nearest) for coord in coords
+]
+kd_time = time.time() - start_time
+
+start_time = time.time()
+grid_candidates = [None for _ in range(args.n_agents)]
+for frame_start in frame_starts:
+    frame_agents = range(
+        frame_start, min(frame_start + args.agents_per_frame, args.n_agents)
+    )
+    # the same kd tree selection as in get_closest_lanes (the lanes of the agent's map segment)
+    lane_mask_id_2_agents = dict()
+    for agent_i in frame_agents:
+        lane_mask = get_kd_tree_and_idx_map_for_agent(
+            coords[agent_i], ALL_WHEELS_CLASS
+        )[1].get_lane_mask()
+        lane_mask_id_2_agents.setdefault(id(lane_mask), (lane_mask, []))[1].append(
+            agent_i
+        )
+    for lane_mask, agent_indices in lane_mask_id_2_agents.values():
+        distances, lane_indices, point_indices = get_grid_candidates(
+            coords[agent_indices], lane_mask, args.k_nearest
+        )
+        for i, agent_i in enumerate(agent_indices):
+            grid_candidates[agent_i] = distances[i], lane_indices[i], point_indices[i]
+grid_time = time.time() - start_time
+
+n_agreed = 0
+for (kd_distances, kd_lane_points), (
+    grid_distances,
+    grid_lane_indices,
+    grid_point_indices,
+) in zip(kd_candidates, grid_candidates):
+    is_in_radius = kd_distances <= LANE_GRID_RADIUS_M
+    n_agreed += [
+        lane_point
+        for lane_point, in_radius in zip(kd_lane_points, is_in_radius)
+        if in_radius
+    ] == [
+        (lane_ids_all[lane_idx], point_idx)
+        for lane_idx, point_idx, dist in zip(
+            grid_lane_indices.tolist(),
+            grid_point_indices.tolist(),
+            grid_distances,
+        )
+        if dist <= LANE_GRID_RADIUS_M
+    ]
+print(
+    f"Candidates within {LANE_GRID_RADIUS_M} m: kd trees {args.n_agents / kd_time:.0f} agents/s, "
+    f"grid {args.n_agents / grid_time:.0f} agents/s, agreement {n_agreed / args.n_agents:.4%}"
+)
+
+# LANE MATCHING ###############
+start_time = time.time()
+scalar_results = []
+for coord, yaw in tqdm(
+    zip(coords, yaws), total=args.n_agents, desc="find_closest_lane"
+):
+    result = find_closest_lane(coord, yaw, ALL_WHEELS_CLASS, return_point_i=True)
+    scalar_results.append(result)
+scalar_time = time.time() - start_time
+
+batch_results = dict()
+batch_times = dict()
+for use_grid in [False, True]:
+    start_time = time.time()
+    lane_indices, point_indices = [], []
+    for frame_start in frame_starts:
+        frame_slice = slice(frame_start, frame_start + args.agents_per_frame)
+        frame_lane_indices, frame_point_indices = find_closest_lanes(
+            coords[frame_slice], yaws[frame_slice], ALL_WHEELS_CLASS, use_grid=use_grid
+        )
+        lane_indices.append(frame_lane_indices)
+        point_indices.append(frame_point_indices)
+    batch_times[use_grid] = time.time() - start_time
+    batch_results[use_grid] = [
+        (lane_ids_all[lane_idx], point_idx) if lane_idx >= 0 else None
+        for lane_idx, point_idx in zip(
+            np.concatenate(lane_indices).tolist(),
+            np.concatenate(point_indices).tolist(),
+        )
+    ]
+
+print(f"find_closest_lane: {args.n_agents / scalar_time:.0f} agents/s")
+for use_grid, name in [(False, "kd trees"), (True, "grid")]:
+    agreement = np.mean(
+        [x == y for x, y in zip(scalar_results, batch_results[use_grid])]
+    )
+    print(
+        f"find_closest_lanes ({name}): {args.n_agents / batch_times[use_grid]:.0f} agents/s, "
+        f"agreement with find_closest_lane {agreement:.4%}"
+    )
@@ -0,0 +1,135 @@
+import argparse
+import time
+
+import numpy as np
+
+from lyft_trajectories.data_preprocessing.common.map_traffic_lights_data import (
+    find_closest_lanes,
+    get_kd_scope,
+    get_kd_tree_and_idx_map,
+    get_kd_tree_and_idx_map_for_agent,
+    lane_id_2_idx_all,
+    lanes_center_line_points,
+    get_map_segments_data,
+    map_partition,
+    match_point_2_map_segment,
+    query_kd_tree,
+    ALL_WHEELS_CLASS,
+    MAP_PARTITION_MARGIN_M,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--n-queries", default=20000, type=int)
+parser.add_argument("--position-noise-m", default=2.0, type=float)
+parser.add_argument("--k-nearest", default=25, type=int)
+parser.add_argument("--seed", default=42, type=int)
+parser.add_argument("--agents-per-frame", default=50, type=int)
+# the default radius of the lane matching and the radius of the agent lanes features (agent_lanes_matcher)
+parser.add_argument("--max-dists-m", default=[4.0, 100.0], type=float, nargs="+")
+
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+coords = lanes_center_line_points[
+    rng.integers(0, len(lanes_center_line_points), args.n_queries)
+] + rng.normal(0, args.position_noise_m, (args.n_queries, 2))
+full_kd_tree, _ = get_kd_tree_and_idx_map_for_agent(
+    coords[0], ALL_WHEELS_CLASS, segmented_map=False
+)
+
+leaf_n_points = np.bincount(
+    map_partition.get_leaf_indices(lanes_center_line_points),
+    minlength=map_partition.n_leaves,
+)
+print(
+    f"Map partition: {map_partition.n_leaves} leaves, "
+    f"lane points per leaf cell max {leaf_n_points.max()}, median {np.median(leaf_n_points):.0f}"
+)
+
+# the former selection of the kd tree scope: the smallest matched KMeans map segment
+try:
+    map_segment_2_lanes = get_map_segments_data()[0]
+except FileNotFoundError:
+    map_segment_2_lanes = []
+if len(map_segment_2_lanes):
+    segment_kd_trees = []
+    for segment_lanes in map_segment_2_lanes:
+        segment_kd_tree, _ = get_kd_tree_and_idx_map(
+            get_kd_scope(np.array(sorted(lane_id_2_idx_all[x] for x in segment_lanes)))
+        )
+        segment_kd_trees.append(segment_kd_tree)
+
+    def select_segment_kd_tree(coord):
+        map_segment_indices = match_point_2_map_segment(*coord)
+        if len(map_segment_indices):
+            return segment_kd_trees[map_segment_indices[0]]
+        return full_kd_tree
+
+else:
+    print("No map segments found, only the map partition is benchmarked")
+    select_segment_kd_tree = None
+
+
+def select_partition_kd_tree(coord):
+    return get_kd_tree_and_idx_map_for_agent(coord, ALL_WHEELS_CLASS)[0]
+
+
+for name, select_kd_tree in [
+    ("map segments", select_segment_kd_tree),
+    ("map partition", select_partition_kd_tree),
+]:
+    if select_kd_tree is None:
+        continue
+    latencies_us = np.empty(args.n_queries)
+    n_agreed, n_within_margin = 0, 0
+    for i, coord in enumerate(coords):
+        start_time = time.perf_counter()
+        kd_tree_ = select_kd_tree(coord)
+        distances, _ = query_kd_tree(kd_tree_, coord, args.k_nearest)
+        latencies_us[i] = (time.perf_counter() - start_time) * 1e6
+        full_distances, _ = query_kd_tree(full_kd_tree, coord, args.k_nearest)
+        if full_distances[-1] <= MAP_PARTITION_MARGIN_M:
+            n_within_margin += 1
+            n_agreed += np.array_equal(distances, full_distances)
+    p50, p90, p99 = np.percentile(latencies_us, [50, 90, 99])
+    print(
+        f"{name}: latency per query p50 {p50:.1f} us, p90 {p90:.1f} us, p99 {p99:.1f} us, "
+        f"max {latencies_us.max():.1f} us; the same k nearest as the full tree for "
+        f"{n_agreed / max(n_within_margin, 1):.4%} of the {n_within_margin} queries "
+        f"with the k-th nearest within {MAP_PARTITION_MARGIN_M} m"
+    )
+
+# the lane matching falls back to the full kd trees for the agents with the k-th nearest candidate beyond
+# MAP_PARTITION_MARGIN_M - max_dist_m, radii of at least the margin use the full kd trees only
+yaws = rng.uniform(-np.pi, np.pi, args.n_queries).astype(np.float32)
+partition_distances = np.array(
+    [
+        query_kd_tree(select_partition_kd_tree(coord), coord, args.k_nearest)[0][-1]
+        for coord in coords
+    ]
+)
+for max_dist_m in args.max_dists_m:
+    if max_dist_m < MAP_PARTITION_MARGIN_M:
+        fallback_share = np.mean(
+            partition_distances > MAP_PARTITION_MARGIN_M - max_dist_m
+        )
+        scope_desc = (
+            f"{fallback_share:.4%} of the agents fall back to the full kd trees"
+        )
+    else:
+        scope_desc = "the full kd trees only"
+    start_time = time.perf_counter()
+    for frame_start in range(0, args.n_queries, args.agents_per_frame):
+        frame_slice = slice(frame_start, frame_start + args.agents_per_frame)
+        find_closest_lanes(
+            coords[frame_slice],
+            yaws[frame_slice],
+            ALL_WHEELS_CLASS,
+            max_dist_m=max_dist_m,
+            k_nearest=args.k_nearest,
+        )
+    latency_us = (time.perf_counter() - start_time) * 1e6 / args.n_queries
+    print(
+        f"find_closest_lanes with max_dist_m {max_dist_m} m: "
+        f"{latency_us:.1f} us per agent, {scope_desc}"
+    )
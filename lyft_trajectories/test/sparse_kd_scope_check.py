@@ -0,0 +1,135 @@
+import argparse
+
+import numpy as np
+
+from lyft_trajectories.data_preprocessing.common.map_traffic_lights_data import (
+    MaskedKDTree,
+    find_closest_lane,
+    find_closest_lanes,
+    get_closest_lanes,
+    lane_ids_all,
+    lanes_center_line_points,
+    map_partition,
+    map_partition_leaf_2_kd_trees_and_idx_maps,
+    master_intersection_kd_trees_and_idx_maps,
+    BIKE_CLASS,
+)
+
+# lane matching of the agents of the kd scopes with less than k_nearest points of the agent class
+# (the kd tree queries are padded), checked against the full kd trees
+parser = argparse.ArgumentParser()
+parser.add_argument("--max-agents-per-scope", default=20, type=int)
+parser.add_argument("--position-noise-m", default=2.0, type=float)
+parser.add_argument("--k-nearest", default=25, type=int)
+parser.add_argument("--seed", default=42, type=int)
+
+args = parser.parse_args()
+
+rng = np.random.default_rng(args.seed)
+
+
+def is_sparse(kd_tree_):
+    return isinstance(kd_tree_, MaskedKDTree) and kd_tree_.n < args.k_nearest
+
+
+def get_scope_coords(coords: np.ndarray):
+    coords = coords[
+        rng.choice(
+            len(coords), min(len(coords), args.max_agents_per_scope), replace=False
+        )
+    ]
+    return coords + rng.normal(0, args.position_noise_m, coords.shape)
+
+
+# MASKED KD TREE ###############
+for kd_trees_and_idx_maps_ in master_intersection_kd_trees_and_idx_maps:
+    kd_tree_, kd_idx_map_ = kd_trees_and_idx_maps_[BIKE_CLASS]
+    if is_sparse(kd_tree_):
+        distances, indices = kd_tree_.query(
+            kd_tree_.kd_tree.data[kd_tree_.point_mask], k=args.k_nearest
+        )
+        is_padded = np.isinf(distances)
+        if not (
+            np.all(is_padded.sum(axis=1) == args.k_nearest - kd_tree_.n)
+            and np.all(indices[is_padded] == kd_tree_.kd_tree.n)
+            and np.all(kd_idx_map_.point_mask[indices[~is_padded]])
+        ):
+            raise AssertionError("Unexpected padding of the masked kd tree query")
+        break
+
+# PARTITION LEAVES ###############
+sparse_leaves = [
+    leaf_idx
+    for leaf_idx, kd_trees_and_idx_maps_ in enumerate(
+        map_partition_leaf_2_kd_trees_and_idx_maps
+    )
+    if is_sparse(kd_trees_and_idx_maps_[BIKE_CLASS][0])
+]
+leaf_indices = map_partition.get_leaf_indices(lanes_center_line_points)
+n_agents, n_mismatches = 0, 0
+for leaf_idx in sparse_leaves:
+    coords = get_scope_coords(lanes_center_line_points[leaf_indices == leaf_idx])
+    yaws = rng.uniform(-np.pi, np.pi, len(coords)).astype(np.float32)
+    for max_dist_m in [4.0, 100.0]:
+        lane_indices, point_indices = find_closest_lanes(
+            coords, yaws, BIKE_CLASS, max_dist_m=max_dist_m, k_nearest=args.k_nearest
+        )
+        for coord, yaw, lane_idx, point_idx in zip(
+            coords, yaws, lane_indices.tolist(), point_indices.tolist()
+        ):
+            result = find_closest_lane(
+                coord,
+                yaw,
+                BIKE_CLASS,
+                max_dist_m=max_dist_m,
+                k_nearest=args.k_nearest,
+                return_point_i=True,
+            )
+            n_mismatches += result != (
+                (lane_ids_all[lane_idx], point_idx) if lane_idx >= 0 else None
+            )
+            leaf_candidates = get_closest_lanes(
+                coord, BIKE_CLASS, args.k_nearest, max_dist_m=max_dist_m
+            )
+            full_candidates = get_closest_lanes(
+                coord, BIKE_CLASS, args.k_nearest, segmented_map=False
+            )
+            n_mismatches += leaf_candidates[1] != full_candidates[1]
+            n_agents += 1
+print(
+    f"Partition leaves with less than {args.k_nearest} bike lane points: {len(sparse_leaves)}, "
+    f"{n_agents} agents matched, {n_mismatches} mismatches with the full kd trees"
+)
+if n_mismatches:
+    raise AssertionError("The sparse leaf kd trees change the lane matching")
+
+# MASTER INTERSECTIONS ###############
+sparse_master_intersections = [
+    master_intersection_idx
+    for master_intersection_idx, kd_trees_and_idx_maps_ in enumerate(
+        master_intersection_kd_trees_and_idx_maps
+    )
+    if is_sparse(kd_trees_and_idx_maps_[BIKE_CLASS][0])
+]
+n_agents, n_matched = 0, 0
+for master_intersection_idx in sparse_master_intersections:
+    kd_tree_ = master_intersection_kd_trees_and_idx_maps[master_intersection_idx][
+        BIKE_CLASS
+    ][0]
+    coords = get_scope_coords(kd_tree_.kd_tree.data[kd_tree_.point_mask])
+    yaws = rng.uniform(-np.pi, np.pi, len(coords)).astype(np.float32)
+    lane_indices, _, blocked_signals_list = find_closest_lanes(
+        coords,
+        yaws,
+        BIKE_CLASS,
+        k_nearest=args.k_nearest,
+        return_blocked_tl_signals=True,
+        intersections_only=True,
+        master_intersection_idx=master_intersection_idx,
+    )
+    n_agents += len(coords)
+    n_matched += int((lane_indices >= 0).sum())
+print(
+    f"Master intersections with less than {args.k_nearest} bike lane points: {len(sparse_master_intersections)}, "
+    f"{n_agents} agents, {n_matched} matched"
+)
@@ -19,8 +19,6 @@ from lyft_trajectories.utils.l5kit_modified.l5kit_modified import FramesDataset
 from IPython.display import display, clear_output
 import PIL
 import time
-from datetime import datetime
-from pytz import timezone
 from tqdm.auto import tqdm
 import imutils
 from l5kit.data import ChunkedDataset, LocalDataManager
@@ -156,7 +154,7 @@ def run_vis(
 ):
     tl_signals_buffer = dict()
     timestamp_prev, ego_centroid_prev = (
-        datetime(1970, 1, 1).astimezone(timezone("US/Pacific")),
+        0,
         np.array([-9999, -9999]),
     )
     master_intersection_idx_prev = -9999
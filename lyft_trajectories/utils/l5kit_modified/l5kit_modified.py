@@ -1,6 +1,5 @@
 import bisect
 import gc
-from datetime import datetime
 from functools import partial
 from pathlib import Path
 from typing import List
@@ -27,11 +26,12 @@ from l5kit.dataset.select_agents import (
     TH_YAW_DEGREE,
     select_agents,
 )
-from l5kit.geometry import rotation33_as_yaw
-from pytz import timezone
+from scipy.spatial.transform import Rotation
 from torch.utils.data import Dataset
 from zarr import convenience
 
+from lyft_trajectories.data_preprocessing.common.timestamps import NS_PER_SEC
+
 # WARNING: changing these values impact the number of instances selected for both train and inference!
 MIN_FRAME_HISTORY = (
     10  # minimum number of frames an agents must have in the past to be picked
@@ -40,6 +40,39 @@ MIN_FRAME_FUTURE = (
     1  # minimum number of frames an agents must have in the future to be picked
 )
 MASK_AGENT_INDICES_ARRAY_KEY = "mask_agent_indices"
+# the ego velocity is estimated from the previous frame if closer than the limits
+EGO_VELOCITY_MAX_TRANSLATION_M = 10
+EGO_VELOCITY_MAX_TIMEDIFF_SEC = 0.2
+
+
+def get_ego_kinematics(frames: np.ndarray) -> dict:
+    """
+    Ego velocity (from the previous frame), yaw (as rotation33_as_yaw) and the velocity validity
+    of consecutive frames at once.
+    """
+    ego_centroids = frames["ego_translation"][:, :2]
+    ego_velocities = np.full((len(frames), 2), np.nan)
+    is_ego_velocity_valid = np.zeros(len(frames), dtype=bool)
+    if len(frames) > 1:
+        translations = ego_centroids[1:] - ego_centroids[:-1]
+        timediffs_sec = np.diff(frames["timestamp"].astype(np.int64)) / NS_PER_SEC
+        is_ego_velocity_valid[1:] = (
+            (
+                np.hypot(translations[:, 0], translations[:, 1])
+                < EGO_VELOCITY_MAX_TRANSLATION_M
+            )
+            & (timediffs_sec > 0)
+            & (timediffs_sec < EGO_VELOCITY_MAX_TIMEDIFF_SEC)
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ego_velocities[1:] = translations / timediffs_sec[:, np.newaxis]
+    # the scipy conversion of rotation33_as_yaw (l5kit 1.1.0) for all frames at once,
+    # checked against rotation33_as_yaw by test/ego_kinematics_check.py
+    return {
+        "ego_velocity": ego_velocities,
+        "ego_yaw": Rotation.from_matrix(frames["ego_rotation"]).as_euler("xyz")[:, 2],
+        "is_ego_velocity_valid": is_ego_velocity_valid,
+    }
 
 
 def generate_frame_sample_without_hist(
@@ -49,6 +82,7 @@ def generate_frame_sample_without_hist(
     agents: zarr.core.Array,
     agents_from_standard_mask_only: bool = False,
     mask_agent_indices: zarr.core.Array = None,
+    ego_kinematics: dict = None,
 ) -> dict:
     frame = frames[state_index]
     if not agents_from_standard_mask_only:
@@ -59,34 +93,25 @@ def generate_frame_sample_without_hist(
         masked_agent_indices = [
             el[0] for el in mask_agent_indices[masked_indices_slice]
         ]
-        if masked_agent_indices:
+        if masked_agent_indices and isinstance(agents, np.ndarray):
+            # in-memory scene block, see FramesDataset.get_scene_frames
+            agents = agents[masked_agent_indices].copy()
+        elif masked_agent_indices:
             agents = agents.get_coordinate_selection(masked_agent_indices).copy()
         else:
             agents = []
 
     ego_centroid = frame["ego_translation"][:2]
-    # try to estimate ego velocity
-    if state_index > 0:
-        prev_frame_candidate = frames[state_index - 1]
-        prev_ego_centroid = prev_frame_candidate["ego_translation"][:2]
-        translation_m = np.hypot(
-            prev_ego_centroid[0] - ego_centroid[0],
-            prev_ego_centroid[1] - ego_centroid[1],
+    # precomputed for the whole scene, or from the previous frame only
+    if ego_kinematics is None:
+        ego_kinematics = get_ego_kinematics(
+            frames[max(state_index - 1, 0) : state_index + 1]
         )
-        if translation_m < 10:
-            timestamp = datetime.fromtimestamp(frame["timestamp"] / 10 ** 9).astimezone(
-                timezone("US/Pacific")
-            )
-            timestamp_prev = datetime.fromtimestamp(
-                prev_frame_candidate["timestamp"] / 10 ** 9
-            ).astimezone(timezone("US/Pacific"))
-            timediff_sec = (timestamp - timestamp_prev).total_seconds()
-            if timestamp > timestamp_prev and timediff_sec < 0.2:
-                ego_speed = (ego_centroid - prev_ego_centroid) / timediff_sec
-            else:
-                ego_speed = None
-        else:
-            ego_speed = None
+        kinematics_idx = min(state_index, 1)
+    else:
+        kinematics_idx = state_index
+    if ego_kinematics["is_ego_velocity_valid"][kinematics_idx]:
+        ego_speed = ego_kinematics["ego_velocity"][kinematics_idx]
     else:
         ego_speed = None
 
@@ -100,7 +125,7 @@ def generate_frame_sample_without_hist(
     return {
         "ego_centroid": ego_centroid,
         "ego_speed": ego_speed,
-        "ego_yaw": rotation33_as_yaw(frame["ego_rotation"]),
+        "ego_yaw": float(ego_kinematics["ego_yaw"][kinematics_idx]),
         "tl_faces": tl_faces_this,
         "agents": agents,
     }
@@ -200,7 +225,10 @@ class FramesDataset(Dataset):
             )
         self.with_history = with_history
         self.return_indices = return_indices
+        self.agents_from_standard_mask_only = agents_from_standard_mask_only
         self.zarr_root = zarr_root
+        # see get_scene_time_index
+        self.scene_time_index = None
 
     def __len__(self) -> int:
         return len(self.zarr_root[FRAME_ARRAY_KEY])
@@ -222,7 +250,11 @@ class FramesDataset(Dataset):
         frames = self.zarr_root[FRAME_ARRAY_KEY][frames_slice]
         timestamp = frames[state_index]["timestamp"]
         data = self.sample_function(state_index, frames)
+        return self.get_frame_results(data, timestamp, scene_index, state_index)
 
+    def get_frame_results(
+        self, data: dict, timestamp: int, scene_index: int, state_index: int
+    ) -> dict:
         results = {
             "timestamp": timestamp,
         }
@@ -268,9 +300,157 @@ class FramesDataset(Dataset):
             state_index = index - self.cumulative_sizes[scene_index - 1]
         return self.get_frame(scene_index, state_index)
 
+    def get_scene_time_index(self) -> np.ndarray:
+        """
+        Returns:
+            (n_scenes, 2) timestamps of the first and the last frame of each scene, read once
+        """
+        if self.scene_time_index is None:
+            frame_index_intervals = self.zarr_root[SCENE_ARRAY_KEY][
+                "frame_index_interval"
+            ]
+            self.scene_time_index = (
+                self.zarr_root[FRAME_ARRAY_KEY]
+                .get_coordinate_selection(
+                    np.stack(
+                        [frame_index_intervals[:, 0], frame_index_intervals[:, 1] - 1],
+                        axis=1,
+                    ).reshape(-1),
+                    fields="timestamp",
+                )
+                .reshape(-1, 2)
+            )
+        return self.scene_time_index
+
+    def get_scene_indices_in_time_range(
+        self, timestamp_min: int, timestamp_max: int
+    ) -> np.ndarray:
+        # scenes with frames in (timestamp_min, timestamp_max]
+        scene_time_index = self.get_scene_time_index()
+        return np.flatnonzero(
+            (scene_time_index[:, 1] > timestamp_min)
+            & (scene_time_index[:, 0] <= timestamp_max)
+        )
+
+    def get_scene_frames(
+        self, scene_index: int, timestamp_min: int = None, timestamp_max: int = None
+    ) -> List[dict]:
+        """
+        All frames of the scene, same as get_frame for each of them, from the frames, agents and tl faces
+        of the scene read at once (one contiguous read per array instead of per frame reads).
+        With the timestamp bounds, only the frames with the timestamp in (timestamp_min, timestamp_max]
+        (and the agents and tl faces of their range) are read.
+        """
+        if self.with_history:
+            raise NotImplementedError
+        frames = self.zarr_root[FRAME_ARRAY_KEY][
+            get_frames_slice_from_scenes(self.zarr_root[SCENE_ARRAY_KEY][scene_index])
+        ]
+        is_in_time_range = np.ones(len(frames), dtype=bool)
+        if timestamp_min is not None:
+            is_in_time_range &= frames["timestamp"] > timestamp_min
+        if timestamp_max is not None:
+            is_in_time_range &= frames["timestamp"] <= timestamp_max
+        state_indices = np.flatnonzero(is_in_time_range)
+        if not len(state_indices):
+            return []
+        first_frame, last_frame = frames[state_indices[0]], frames[state_indices[-1]]
+        # the frames intervals are made relative to the scene blocks
+        tl_faces_start = first_frame["traffic_light_faces_index_interval"][0]
+        tl_faces = self.zarr_root[TL_FACE_ARRAY_KEY][
+            tl_faces_start : last_frame["traffic_light_faces_index_interval"][1]
+        ]
+        frames["traffic_light_faces_index_interval"] -= tl_faces_start
+        if self.agents_from_standard_mask_only:
+            mask_start = first_frame["mask_agent_index_interval"][0]
+            masked_agent_indices = [
+                el[0]
+                for el in self.zarr_root[MASK_AGENT_INDICES_ARRAY_KEY][
+                    mask_start : last_frame["mask_agent_index_interval"][1]
+                ]
+            ]
+            agents = (
+                self.zarr_root[AGENT_ARRAY_KEY].get_coordinate_selection(
+                    masked_agent_indices
+                )
+                if masked_agent_indices
+                else self.zarr_root[AGENT_ARRAY_KEY][:0]
+            )
+            mask_agent_indices = np.arange(len(masked_agent_indices)).reshape(-1, 1)
+            frames["mask_agent_index_interval"] -= mask_start
+        else:
+            agents_start = first_frame["agent_index_interval"][0]
+            agents = self.zarr_root[AGENT_ARRAY_KEY][
+                agents_start : last_frame["agent_index_interval"][1]
+            ]
+            mask_agent_indices = None
+            frames["agent_index_interval"] -= agents_start
+
+        ego_kinematics = get_ego_kinematics(frames)
+        results = []
+        for state_index in state_indices.tolist():
+            timestamp = frames[state_index]["timestamp"]
+            data = generate_frame_sample_without_hist(
+                state_index,
+                frames,
+                tl_faces,
+                agents,
+                agents_from_standard_mask_only=self.agents_from_standard_mask_only,
+                mask_agent_indices=mask_agent_indices,
+                ego_kinematics=ego_kinematics,
+            )
+            results.append(
+                self.get_frame_results(data, timestamp, scene_index, state_index)
+            )
+        return results
+
     def get_scene_indices(self, scene_idx: int) -> np.ndarray:
         scenes = self.zarr_root[SCENE_ARRAY_KEY]
         assert scene_idx < len(
             scenes
         ), f"scene_idx {scene_idx} is over len {len(scenes)}"
         return np.arange(*scenes[scene_idx]["frame_index_interval"])
+
+
+class SceneFramesDataset(Dataset):
+    """
+    Whole scenes of a FramesDataset as items (lists of the scene frames, see FramesDataset.get_scene_frames),
+    so that a DataLoader hands whole scenes to each worker. To be used with batch_size=None,
+    the collate_fn then receives the frames of one scene.
+    With the timestamp bounds, only the scenes overlapping (timestamp_min, timestamp_max] are visited
+    (by the scene time index) and only their frames within the bounds are read.
+    """
+
+    def __init__(
+        self,
+        frame_dataset: FramesDataset,
+        scene_indices: List[int] = None,
+        timestamp_min: int = None,
+        timestamp_max: int = None,
+    ):
+        self.frame_dataset = frame_dataset
+        if scene_indices is None:
+            scene_indices = range(len(frame_dataset.cumulative_sizes))
+        if timestamp_min is not None or timestamp_max is not None:
+            scene_indices = np.intersect1d(
+                scene_indices,
+                frame_dataset.get_scene_indices_in_time_range(
+                    timestamp_min
+                    if timestamp_min is not None
+                    else np.iinfo(np.int64).min,
+                    timestamp_max
+                    if timestamp_max is not None
+                    else np.iinfo(np.int64).max,
+                ),
+            ).tolist()
+        self.scene_indices = list(scene_indices)
+        self.timestamp_min = timestamp_min
+        self.timestamp_max = timestamp_max
+
+    def __len__(self) -> int:
+        return len(self.scene_indices)
+
+    def __getitem__(self, index: int) -> List[dict]:
+        return self.frame_dataset.get_scene_frames(
+            self.scene_indices[index], self.timestamp_min, self.timestamp_max
+        )
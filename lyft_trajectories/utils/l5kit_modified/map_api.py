@@ -1,5 +1,5 @@
 from functools import lru_cache
-from typing import Iterator, Sequence, Union, no_type_check
+from typing import Dict, Iterator, List, Sequence, Union, no_type_check
 
 import numpy as np
 import pymap3d as pm
@@ -12,8 +12,38 @@ from l5kit.data.proto.road_network_pb2 import (
 )
 from l5kit.geometry import transform_points
 
+from lyft_trajectories.data_preprocessing.common.map_artifact import (
+    is_map_artifact_current,
+    load_map_artifact,
+    save_map_artifact,
+)
+from lyft_trajectories.data_preprocessing.common.map_cache import (
+    CacheLock,
+    get_cache_key,
+    get_file_hash,
+)
+
 CACHE_SIZE = int(1e5)
 ENCODING = "utf-8"
+# decoded element table version, part of its key: to be increased whenever the decoded columns change
+ELEMENT_TABLE_VERSION = 2
+ELEMENT_KIND_OTHER = 0
+ELEMENT_KIND_LANE = 1
+ELEMENT_KIND_SEGMENT = 2
+ELEMENT_KIND_JUNCTION = 3
+ELEMENT_KIND_TRAFFIC_CONTROL = 4
+# traffic face colour code is the index in the list
+TRAFFIC_FACE_COLOURS = ["unknown", "green", "yellow", "red"]
+BIKE_ONLY_ACCESS_RESTRICTION = 4
+
+
+def get_str_csr(lists: List[List[str]]) -> Dict[str, np.ndarray]:
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(x) for x in lists], out=offsets[1:])
+    return {
+        "offsets": offsets,
+        "values": np.array([value for x in lists for value in x], dtype=str),
+    }
 
 
 class MapAPI:
@@ -23,6 +53,9 @@ class MapAPI:
         - access to element using ID is O(1);
         - access to coordinates in world ref system for a set of elements is O(1) after first access (lru cache)
         - object support iteration using __getitem__ protocol
+        - element kinds, lane attributes and face colours are served from a decoded columnar table
+          persisted next to the map (protobuf_map_path.elements), the protobuf is parsed on the first access
+          to the elements only
 
         Args:
             protobuf_map_path (str): path to the protobuf file
@@ -30,14 +63,27 @@ class MapAPI:
         """
         self.protobuf_map_path = protobuf_map_path
         self.ecef_to_world = np.linalg.inv(world_to_ecef)
+        self._elements = None
 
-        with open(protobuf_map_path, "rb") as infile:
-            mf = MapFragment()
-            mf.ParseFromString(infile.read())
-
-        self.elements = mf.elements
+        self.element_table_path = f"{protobuf_map_path}.elements"
+        element_table_key = get_cache_key(
+            get_file_hash(protobuf_map_path), ELEMENT_TABLE_VERSION
+        )
+        if not is_map_artifact_current(self.element_table_path, element_table_key):
+            with CacheLock(self.element_table_path):
+                if not is_map_artifact_current(
+                    self.element_table_path, element_table_key
+                ):
+                    save_map_artifact(
+                        self.element_table_path,
+                        arrays=self.decode_element_table(),
+                        objects=dict(),
+                        key=element_table_key,
+                    )
+        self.element_table, _ = load_map_artifact(self.element_table_path)
         self.ids_to_el = {
-            self.id_as_str(el.id): idx for idx, el in enumerate(self.elements)
+            element_id: idx
+            for idx, element_id in enumerate(self.element_table["ids"].tolist())
         }  # store a look-up table
 
         self.lane_orientation_code_2_str = {
@@ -48,6 +94,115 @@ class MapAPI:
             4: "ONE_WAY_REVERSIBLE",
         }
 
+    @property
+    def elements(self):
+        if self._elements is None:
+            with open(self.protobuf_map_path, "rb") as infile:
+                mf = MapFragment()
+                mf.ParseFromString(infile.read())
+            self._elements = mf.elements
+        return self._elements
+
+    def decode_element_table(self) -> Dict[str, np.ndarray]:
+        """
+        Decodes the protobuf elements into columns indexed by the element position in the map.
+
+        Returns:
+            Dict[str, np.ndarray]: element ids, kinds, lane attributes (access restriction, orientation,
+            speed limit of the parent segment (0 if not set), lane change neighbours, lanes ahead, lanes to yield,
+            traffic controls) and traffic face colour codes,
+            list attributes are stored as {name}/offsets and {name}/values
+        """
+        n_elements = len(self.elements)
+        element_ids = [self.id_as_str(element.id) for element in self.elements]
+        # the element table is decoded before the ids look-up table is built
+        element_id_2_idx = {
+            element_id: idx for idx, element_id in enumerate(element_ids)
+        }
+        kinds = np.full(n_elements, ELEMENT_KIND_OTHER, dtype=np.int8)
+        access_restrictions = np.full(n_elements, -1, dtype=np.int16)
+        orientations = np.full(n_elements, -1, dtype=np.int8)
+        speed_limits = np.zeros(n_elements, dtype=np.float32)
+        face_colours = np.zeros(n_elements, dtype=np.int8)
+        lanes_to_left, lanes_to_right = [""] * n_elements, [""] * n_elements
+        lanes_ahead = [[] for _ in range(n_elements)]
+        lanes_to_yield = [[] for _ in range(n_elements)]
+        lane_traffic_controls = [[] for _ in range(n_elements)]
+        for idx, element in enumerate(self.elements):
+            if self.is_lane(element):
+                kinds[idx] = ELEMENT_KIND_LANE
+                lane = element.element.lane
+                access_restrictions[idx] = lane.access_restriction.type
+                orientations[idx] = lane.orientation_in_parent_segment
+                parent_id = self.id_as_str(lane.parent_segment_or_junction)
+                if parent_id in element_id_2_idx:
+                    parent_element = self.elements[element_id_2_idx[parent_id]].element
+                    if parent_element.HasField("segment"):
+                        parent_segment = parent_element.segment
+                        speed_limits[idx] = parent_segment.speed_limit_meters_per_second
+                for lane_change_field, lanes_to_side in [
+                    ("adjacent_lane_change_left", lanes_to_left),
+                    ("adjacent_lane_change_right", lanes_to_right),
+                ]:
+                    if lane.HasField(lane_change_field):
+                        lane_to_side = self.id_as_str(getattr(lane, lane_change_field))
+                        if lane_to_side != "0":
+                            lanes_to_side[idx] = lane_to_side
+                lanes_ahead[idx] = [self.id_as_str(x) for x in lane.lanes_ahead]
+                lanes_to_yield[idx] = [self.id_as_str(x) for x in lane.yield_to_lanes]
+                lane_traffic_controls[idx] = [
+                    self.id_as_str(x) for x in lane.traffic_controls
+                ]
+            elif self.is_road_network_segment(element):
+                kinds[idx] = ELEMENT_KIND_SEGMENT
+            elif self.is_junction(element):
+                kinds[idx] = ELEMENT_KIND_JUNCTION
+            elif element.element.HasField("traffic_control_element"):
+                kinds[idx] = ELEMENT_KIND_TRAFFIC_CONTROL
+                face_colours[idx] = TRAFFIC_FACE_COLOURS.index(
+                    self.get_element_traffic_face_colour(element)
+                )
+        element_table = {
+            "ids": np.array(element_ids, dtype=str),
+            "kind": kinds,
+            "lane_access_restriction": access_restrictions,
+            "lane_orientation": orientations,
+            "lane_speed_limit": speed_limits,
+            "lane_to_left": np.array(lanes_to_left, dtype=str),
+            "lane_to_right": np.array(lanes_to_right, dtype=str),
+            "traffic_face_colour": face_colours,
+        }
+        for name, lists in [
+            ("lanes_ahead", lanes_ahead),
+            ("lanes_to_yield", lanes_to_yield),
+            ("lane_traffic_controls", lane_traffic_controls),
+        ]:
+            for key, values in get_str_csr(lists).items():
+                element_table[f"{name}/{key}"] = values
+        return element_table
+
+    def get_element_kind(self, element_id: str) -> int:
+        return int(self.element_table["kind"][self.ids_to_el[element_id]])
+
+    def get_element_ids(self, kind: int) -> List[str]:
+        """
+        Ids of all elements of the kind (see ELEMENT_KIND_* constants), in the map order
+
+        Args:
+            kind (int): element kind code
+
+        Returns:
+            List[str]: element ids
+        """
+        return self.element_table["ids"][self.element_table["kind"] == kind].tolist()
+
+    def _get_table_list(self, name: str, element_id: str) -> List[str]:
+        idx = self.ids_to_el[element_id]
+        offsets = self.element_table[f"{name}/offsets"]
+        return self.element_table[f"{name}/values"][
+            offsets[idx] : offsets[idx + 1]
+        ].tolist()
+
     @staticmethod
     @no_type_check
     def id_as_str(element_id: GlobalId) -> str:
@@ -154,8 +309,7 @@ class MapAPI:
 
         Returns:
         """
-        element = self[element_id]
-        return bool(element.element.HasField("traffic_control_element"))
+        return self.get_element_kind(element_id) == ELEMENT_KIND_TRAFFIC_CONTROL
 
     def is_primary_road(self, element_id: str) -> bool:
         """
@@ -234,11 +388,8 @@ class MapAPI:
         Returns:
             list: a list with element ids of consequent lanes
         """
-        element = self[element_id]
-        assert self.is_lane(element)
-
-        lane = element.element.lane
-        return [self.id_as_str(x) for x in lane.lanes_ahead]
+        assert self.get_element_kind(element_id) == ELEMENT_KIND_LANE
+        return self._get_table_list("lanes_ahead", element_id)
 
     def get_traffic_control_elements_at_junction(self, element_id: str) -> list:
         """
@@ -318,16 +469,8 @@ class MapAPI:
 
             Returns:
         """
-        element = self[element_id]
-        assert self.is_lane(element)
-
-        lane = element.element.lane
-        return (
-            self.id_as_str(lane.adjacent_lane_change_left)
-            if lane.HasField("adjacent_lane_change_left")
-            and self.id_as_str(lane.adjacent_lane_change_left) != "0"
-            else ""
-        )
+        assert self.get_element_kind(element_id) == ELEMENT_KIND_LANE
+        return str(self.element_table["lane_to_left"][self.ids_to_el[element_id]])
 
     def get_lane_to_right(self, element_id: str) -> str:
         """
@@ -341,16 +484,8 @@ class MapAPI:
 
             Returns:
         """
-        element = self[element_id]
-        assert self.is_lane(element)
-
-        lane = element.element.lane
-        return (
-            self.id_as_str(lane.adjacent_lane_change_right)
-            if lane.HasField("adjacent_lane_change_right")
-            and self.id_as_str(lane.adjacent_lane_change_right) != "0"
-            else ""
-        )
+        assert self.get_element_kind(element_id) == ELEMENT_KIND_LANE
+        return str(self.element_table["lane_to_right"][self.ids_to_el[element_id]])
 
     def get_lanes_to_yield(self, element_id: str) -> list:
         """
@@ -365,11 +500,8 @@ class MapAPI:
 
             Returns:
         """
-        element = self[element_id]
-        assert self.is_lane(element)
-
-        lane = element.element.lane
-        return [self.id_as_str(el) for el in lane.yield_to_lanes]
+        assert self.get_element_kind(element_id) == ELEMENT_KIND_LANE
+        return self._get_table_list("lanes_to_yield", element_id)
 
     def get_lane_traffic_controls(self, element_id: str) -> list:
         """
@@ -390,6 +522,19 @@ class MapAPI:
         lane = element.element.lane
         return list(lane.traffic_controls)
 
+    def get_lane_traffic_control_ids(self, element_id: str) -> list:
+        """
+        Same as get_lane_traffic_controls, as element ids and without the protobuf access
+
+        Args:
+            element_id (str): lane element id
+
+        Returns:
+            list: a list with element ids of the lane traffic controls
+        """
+        assert self.get_element_kind(element_id) == ELEMENT_KIND_LANE
+        return self._get_table_list("lane_traffic_controls", element_id)
+
     def get_traffic_control_lanes_under_control(self, element_id: str) -> list:
         """
             // The lanes that the signal controls. Each sequence starts with the lane in which the car
@@ -417,11 +562,10 @@ class MapAPI:
         Returns:
             list: a list with element ids of consequent lanes
         """
-        element = self[element_id]
-        assert self.is_lane(element)
-
-        lane = element.element.lane
-        return self.lane_orientation_code_2_str[lane.orientation_in_parent_segment]
+        assert self.get_element_kind(element_id) == ELEMENT_KIND_LANE
+        return self.lane_orientation_code_2_str[
+            int(self.element_table["lane_orientation"][self.ids_to_el[element_id]])
+        ]
 
     @staticmethod
     @no_type_check
@@ -501,7 +645,11 @@ class MapAPI:
         Returns:
             True if the element is a traffic light with the given colour
         """
-        element = self[element_id]
+        return self.is_element_traffic_face_colour(self[element_id], colour)
+
+    @staticmethod
+    @no_type_check
+    def is_element_traffic_face_colour(element: MapElement, colour: str) -> bool:
         if not element.element.HasField("traffic_control_element"):
             return False
         traffic_el = element.element.traffic_control_element
@@ -516,15 +664,25 @@ class MapAPI:
             return True
         return False
 
-    def get_traffic_face_colour(self, element_id: str):
+    @staticmethod
+    @no_type_check
+    def get_element_traffic_face_colour(element: MapElement) -> str:
         for color in ["green", "yellow", "red"]:
-            if self.is_traffic_face_colour(element_id, color):
+            if MapAPI.is_element_traffic_face_colour(element, color):
                 return color
         return "unknown"
 
+    def get_traffic_face_colour(self, element_id: str):
+        return TRAFFIC_FACE_COLOURS[
+            self.element_table["traffic_face_colour"][self.ids_to_el[element_id]]
+        ]
+
     def is_bike_only_lane(self, element_id):
-        assert self.is_lane(self[element_id])
-        return self[element_id].element.lane.access_restriction.type == 4
+        assert self.get_element_kind(element_id) == ELEMENT_KIND_LANE
+        return bool(
+            self.element_table["lane_access_restriction"][self.ids_to_el[element_id]]
+            == BIKE_ONLY_ACCESS_RESTRICTION
+        )
 
     def get_traffic_light_face_sets(self, element_id):
         """
@@ -570,16 +728,24 @@ class MapAPI:
         return False
 
     def get_speed_limit(self, lane_id, max_lim=18):
-        if lane_id not in self:
+        """
+        Speed limit of the lane parent segment
+
+        Args:
+            lane_id (str): the id (utf-8 encode) of the lane
+            max_lim: speed limit of the unknown lanes and of the lanes without the parent segment limit
+                (e.g. junction lanes)
+
+        Returns:
+            speed limit in meters per second
+        """
+        if lane_id not in self.ids_to_el:
             return max_lim
-        lane_element = self[lane_id].element.lane
-        parent = lane_element.parent_segment_or_junction
-        parent_id = self.id_as_str(parent)
-        parent_element = self[parent_id].element
-        if parent_element.HasField("segment"):
-            speed_limit = parent_element.segment.speed_limit_meters_per_second
-            if speed_limit != 0:
-                return speed_limit
+        speed_limit = float(
+            self.element_table["lane_speed_limit"][self.ids_to_el[lane_id]]
+        )
+        if speed_limit != 0:
+            return speed_limit
         return max_lim
 
     @staticmethod
@@ -641,7 +807,7 @@ class MapAPI:
         raise TypeError("only str, bytes and int are allowed in API __getitem__")
 
     def __len__(self) -> int:
-        return len(self.elements)
+        return len(self.ids_to_el)
 
     def __iter__(self) -> Iterator:
         for i in range(len(self)):
@@ -1,25 +1,35 @@
 from lyft_trajectories.data_preprocessing.common.map_traffic_lights_data import (
-    find_closest_lane,
+    find_closest_lanes,
     get_lane_center_line,
     get_lane_len,
     get_lane_neighbours_all,
     get_lane_neighbours_based_on_dist,
     lane_2_master_intersection_related_lanes,
     lane_id_2_idx,
+    lane_ids_all,
     match_point_2_map_segment,
     CAR_CLASS,
     BIKE_CLASS,
     ALL_WHEELS_CLASS,
+    COMPILED_MAP_VERSION,
+    MAP_SEGMENTS_FILE_NAMES,
+    compiled_map_key,
 )
-from .l5kit_modified.l5kit_modified import FramesDataset
+from lyft_trajectories.data_preprocessing.common.map_cache import (
+    atomic_pickle_dump,
+    get_cache_key,
+    get_file_hash,
+    load_or_compute,
+)
+from .l5kit_modified.l5kit_modified import FramesDataset, SceneFramesDataset
 import numpy as np
 import pandas as pd
 
 from l5kit.data import LocalDataManager
+from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 
 import os
-import pickle
 from collections import deque, defaultdict
 from sklearn.cluster import KMeans
 
@@ -28,6 +38,7 @@ SEGMENTS_OUTPUT_PATH = "outputs/map_segments/"
 if not os.path.exists(SEGMENTS_OUTPUT_PATH):
     os.makedirs(SEGMENTS_OUTPUT_PATH)
 n_base_segments = 13
+n_workers = 12
 
 dm = LocalDataManager()
 dataset_path = dm.require(
@@ -48,47 +59,52 @@ def get_agents_lanes(frame_sample):
         for agent in frame_sample["agents"]
         if np.nonzero(agent[-1])[0][0] in [CAR_CLASS, BIKE_CLASS]
     ]
-    for agent, agent_class in agents_with_wheels:
-        agent_centroid = agent[0]
-        agent_yaw = agent[2]
-        closest_lane_id = find_closest_lane(
-            agent_centroid,
-            agent_yaw,
-            agent_class,
-            return_point_i=False,
-            return_blocked_tl_signals=False,
-            intersections_only=False,
-        )
-        if closest_lane_id is not None:
-            results.append(closest_lane_id)
+    if len(agents_with_wheels) == 0:
+        return results
+    lane_indices, _ = find_closest_lanes(
+        np.array([agent[0] for agent, _ in agents_with_wheels]),
+        [agent[2] for agent, _ in agents_with_wheels],
+        [agent_class for _, agent_class in agents_with_wheels],
+        return_blocked_tl_signals=False,
+        intersections_only=False,
+    )
+    for lane_idx in lane_indices.tolist():
+        if lane_idx >= 0:
+            results.append(lane_ids_all[lane_idx])
     return results
 
 
-def get_lane_counts(frame_dataset, scene_idx_bounds, scenes_per_video=10):
+def get_scene_agents_lanes(scene_frame_samples):
+    return [get_agents_lanes(frame_sample) for frame_sample in scene_frame_samples]
+
+
+def get_lane_counts(frame_dataset, scene_idx_bounds):
     lane_id_2_count = defaultdict(int)
-    for start_scene in tqdm(
-        range(*scene_idx_bounds, scenes_per_video), desc="Scenes..."
-    ):
-        end_scene = start_scene + scenes_per_video
-        for scene_idx in range(start_scene, end_scene):
-            indexes = frame_dataset.get_scene_indices(scene_idx)
-            for idx in indexes:
-                agents_lanes = get_agents_lanes(frame_dataset[idx])
-                for lane_id in agents_lanes:
-                    lane_id_2_count[lane_id] += 1
+    # whole scenes per worker, each scene read at once
+    dataloader_scenes = DataLoader(
+        SceneFramesDataset(frame_dataset, range(*scene_idx_bounds)),
+        shuffle=False,
+        batch_size=None,
+        num_workers=n_workers,
+        collate_fn=get_scene_agents_lanes,
+    )
+    for scene_agents_lanes in tqdm(dataloader_scenes, desc="Scenes..."):
+        for agents_lanes in scene_agents_lanes:
+            for lane_id in agents_lanes:
+                lane_id_2_count[lane_id] += 1
     return lane_id_2_count
 
 
-lane_id_2_count_val_path = "outputs/lane_id_2_count_val.pkl"
-if os.path.exists(lane_id_2_count_val_path):
-    with open(lane_id_2_count_val_path, "rb") as f:
-        lane_id_2_count_val = pickle.load(f)
-else:
-    lane_id_2_count_val = get_lane_counts(
-        frame_dataset, [0, len(frame_dataset.zarr_root["scenes"])]
-    )
-    with open(lane_id_2_count_val_path, "wb") as f:
-        pickle.dump(lane_id_2_count_val, f)
+lane_id_2_count_val_key = get_cache_key(
+    compiled_map_key,
+    get_file_hash(os.path.join(dataset_path, "agents", ".zarray")),
+    COMPILED_MAP_VERSION,
+)
+lane_id_2_count_val = load_or_compute(
+    "lane_id_2_count_val",
+    lane_id_2_count_val_key,
+    lambda: get_lane_counts(frame_dataset, [0, len(frame_dataset.zarr_root["scenes"])]),
+)
 
 
 def rotate_point(x, y, angle_rad=0.26 * np.pi, back=False):
@@ -254,20 +270,22 @@ for lane_id in lane_id_2_idx.keys():
             segment_x_coords_only,
             segment_y_coords_only,
             interval_2_segments_x,
-            interval_2_segments_y
+            interval_2_segments_y,
+            map_segment_2_lanes,
         )
         for map_segment_idx in map_segment_indices:
             if lane_id not in map_segment_2_lanes[map_segment_idx]:
                 map_segment_2_lanes[map_segment_idx].add(lane_id)
 
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "map_segment_2_lanes.pkl"), "wb") as f:
-    pickle.dump(map_segment_2_lanes, f)
-
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "interval_2_segments_x.pkl"), "wb") as f:
-    pickle.dump(interval_2_segments_x, f)
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "interval_2_segments_y.pkl"), "wb") as f:
-    pickle.dump(interval_2_segments_y, f)
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "segment_x_coords_only.pkl"), "wb") as f:
-    pickle.dump(segment_x_coords_only, f)
-with open(os.path.join(SEGMENTS_OUTPUT_PATH, "segment_y_coords_only.pkl"), "wb") as f:
-    pickle.dump(segment_y_coords_only, f)
+# atomic writes, as the map module might be reading them concurrently (for the map_segment_group labels)
+for file_name, map_segments_data in zip(
+    MAP_SEGMENTS_FILE_NAMES,
+    [
+        map_segment_2_lanes,
+        interval_2_segments_x,
+        interval_2_segments_y,
+        segment_x_coords_only,
+        segment_y_coords_only,
+    ],
+):
+    atomic_pickle_dump(map_segments_data, os.path.join(SEGMENTS_OUTPUT_PATH, file_name))
@@ -4,6 +4,8 @@ python -m lyft_trajectories.utils.dataset_enrichment --add-standard-mask-indices
 python -m lyft_trajectories.utils.dataset_enrichment --add-standard-mask-indices --dataset-path scenes/train_full.zarr --min-frame-history 4
 python -m lyft_trajectories.utils.dataset_enrichment --add-standard-mask-indices --dataset-path scenes/test.zarr --min-frame-history 4 --min-frame-future 0
 
+python -m lyft_trajectories.data_preprocessing.compile_map
+
 bash orchestration_scripts/tl_data_gen_all.sh
 
 bash orchestration_scripts/tl_pred_train_fold_0.sh